@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+"""
+前端资源构建：压缩 + 内容哈希 + 预压缩
+聊天页面 real_llm_chat.html 内联了上千行JS和CSS，原样传输时首屏要下载 40KB+ 的未压缩文本。
+这里在启动前把页面和脚本做保守的压缩（去注释、去缩进、去空行），
+按内容哈希命名写入 dist/，并预先生成 .gz（以及安装了 brotli 时的 .br）同级文件，
+Web服务器按 Accept-Encoding 直接发送预压缩版本，无需在请求时压缩。
+
+- 页面中引用的本地脚本改写为带哈希的地址（dist/<名称>.<哈希>.js），可以长期缓存
+- 页面入口地址不变，由Web服务器按清单映射到最新构建（需要重新验证的缓存）
+- 清单 dist/manifest.json 记录源文件的修改时间和大小，页面或其引用的脚本改动后Web服务器回退到原文件
+
+用法:
+    python build_frontend.py [输出目录]
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import sys
+import tempfile
+from typing import Dict, List, Optional
+
+# brotli 为可选依赖（pip install brotli），没有时只生成 .gz
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# 入口页面（地址保持不变）
+ENTRY_PAGES = ['real_llm_chat.html', 'analytics_dashboard.html']
+
+# 独立脚本（页面中的引用改写为带哈希的地址）
+SCRIPTS = ['config.js', 'real_llm_chat_part2.js']
+
+DIST_DIR = os.getenv("FRONTEND_DIST_DIR", "dist")
+MANIFEST_NAME = 'manifest.json'
+
+# 小于该大小的文件压缩收益有限，不生成预压缩版本
+MIN_COMPRESS_SIZE = 256
+
+CONTENT_TYPES = {
+    '.html': 'text/html; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+}
+
+# 预压缩格式按优先级：Content-Encoding -> 扩展名
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+# 可以出现在正则字面量之前的关键字（其后的 / 不是除号）
+REGEX_KEYWORDS = {'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void',
+                  'throw', 'case', 'do', 'else', 'yield', 'await'}
+
+SCRIPT_BLOCK_PATTERN = re.compile(r'(<script\b([^>]*)>)(.*?)(</script>)', re.S | re.I)
+STYLE_BLOCK_PATTERN = re.compile(r'(<style\b[^>]*>)(.*?)(</style>)', re.S | re.I)
+HTML_COMMENT_PATTERN = re.compile(r'<!--(?!\[if).*?-->', re.S)
+SCRIPT_SRC_PATTERN = re.compile(r'(<script\b[^>]*\bsrc=["\'])([^"\']+)(["\'])', re.I)
+
+
+def minify_js(source: str) -> str:
+    """
+    保守的JS压缩：去掉注释、行首行尾空白和空行
+
+    保留换行（不依赖自动分号插入的规则），字符串、模板字符串和正则字面量原样保留
+    """
+    out: List[str] = []
+    line: List[str] = []
+    # 模板字符串嵌套：栈中记录每层 ${ 表达式开始时的花括号深度
+    template_stack: List[int] = []
+    brace_depth = 0
+    last_token = ''
+    # 当前行以模板字符串正文开头时，行首空白属于字符串内容
+    keep_indent = False
+    i = 0
+    n = len(source)
+
+    def flush_line():
+        nonlocal keep_indent
+        text = ''.join(line)
+        text = text.rstrip() if keep_indent else text.strip()
+        if text:
+            out.append(text)
+        line.clear()
+        keep_indent = False
+
+    while i < n:
+        ch = source[i]
+        nxt = source[i + 1] if i + 1 < n else ''
+
+        if ch == '/' and nxt == '/':
+            end = source.find('\n', i)
+            i = n if end == -1 else end
+            continue
+        if ch == '/' and nxt == '*':
+            end = source.find('*/', i + 2)
+            i = n if end == -1 else end + 2
+            line.append(' ')
+            continue
+        if ch == '\n':
+            flush_line()
+            i += 1
+            continue
+
+        if ch in ('"', "'") or ch == '/' and _regex_allowed(last_token):
+            end = _skip_quoted(source, i, ch)
+            line.append(source[i:end])
+            last_token = 'literal'
+            i = end
+            continue
+
+        if ch == '`' or (ch == '}' and template_stack and template_stack[-1] == brace_depth):
+            if ch == '}':
+                template_stack.pop()
+            # 模板字符串正文原样保留，直到结束的反引号或下一个 ${
+            j = i + 1
+            while j < n:
+                if source[j] == '\\':
+                    j += 2
+                    continue
+                if source[j] == '`':
+                    j += 1
+                    break
+                if source[j] == '$' and j + 1 < n and source[j + 1] == '{':
+                    j += 2
+                    template_stack.append(brace_depth)
+                    break
+                j += 1
+            segment = source[i:j]
+            if '\n' in segment:
+                # 模板正文中的换行和缩进必须保留，不能经过按行处理
+                head, _, tail = segment.rpartition('\n')
+                text = ''.join(line) + head
+                out.append(text if keep_indent else text.lstrip())
+                line[:] = [tail]
+                keep_indent = True
+            else:
+                line.append(segment)
+            last_token = 'literal'
+            i = j
+            continue
+
+        if ch == '{':
+            brace_depth += 1
+        elif ch == '}':
+            brace_depth -= 1
+
+        if ch.isspace():
+            if line and not line[-1].isspace():
+                line.append(' ')
+        else:
+            line.append(ch)
+            if ch.isalnum() or ch in '_$':
+                last_token = last_token + ch if last_token[-1:].isalnum() or last_token[-1:] in ('_', '$') else ch
+            else:
+                last_token = ch
+        i += 1
+
+    flush_line()
+    return '\n'.join(out)
+
+
+def _regex_allowed(last_token: str) -> bool:
+    """根据前一个记号判断 / 是否开始一个正则字面量"""
+    if not last_token:
+        return True
+    if last_token in REGEX_KEYWORDS:
+        return True
+    if last_token == 'literal' or last_token[-1].isalnum() or last_token[-1] in ('_', '$', ')', ']', '}'):
+        return False
+    return True
+
+
+def _skip_quoted(source: str, start: int, quote: str) -> int:
+    """跳过字符串或正则字面量，返回结束位置（不跨行）"""
+    j = start + 1
+    in_class = False
+    while j < len(source):
+        ch = source[j]
+        if ch == '\\':
+            j += 2
+            continue
+        if ch == '\n':
+            return j
+        if quote == '/':
+            if ch == '[':
+                in_class = True
+            elif ch == ']':
+                in_class = False
+            elif ch == '/' and not in_class:
+                j += 1
+                # 正则标志
+                while j < len(source) and source[j].isalpha():
+                    j += 1
+                return j
+        elif ch == quote:
+            return j + 1
+        j += 1
+    return j
+
+
+def minify_css(source: str) -> str:
+    """CSS压缩：去注释、合并空白、去掉 {};, 两侧的空白（字符串原样保留）"""
+    parts = re.split(r'("(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\')', source)
+    out = []
+    for position, part in enumerate(parts):
+        if position % 2:
+            out.append(part)
+            continue
+        part = re.sub(r'/\*.*?\*/', '', part, flags=re.S)
+        part = re.sub(r'\s+', ' ', part)
+        part = re.sub(r'\s*([{};,])\s*', r'\1', part)
+        out.append(part.replace(';}', '}'))
+    return ''.join(out).strip()
+
+
+def minify_html(source: str) -> str:
+    """
+    HTML压缩：压缩内联脚本和样式，去掉注释、行首缩进和空行
+
+    行内的空白保持不变（内联元素之间的空格会影响排版）
+    """
+    blocks: List[str] = []
+
+    def stash(text: str) -> str:
+        blocks.append(text)
+        return f"\x00{len(blocks) - 1}\x00"
+
+    def replace_script(match):
+        open_tag, attrs, body, close_tag = match.groups()
+        type_match = re.search(r'\btype=["\']([^"\']+)', attrs, re.I)
+        script_type = type_match.group(1).lower() if type_match else 'text/javascript'
+        if not body.strip():
+            return stash(open_tag + close_tag)
+        if script_type in ('text/javascript', 'module', 'application/javascript'):
+            body = minify_js(body)
+        elif script_type.endswith('json'):
+            body = json.dumps(json.loads(body), ensure_ascii=False, separators=(',', ':'))
+        return stash(open_tag + body + close_tag)
+
+    def replace_style(match):
+        open_tag, body, close_tag = match.groups()
+        return stash(open_tag + minify_css(body) + close_tag)
+
+    html = SCRIPT_BLOCK_PATTERN.sub(replace_script, source)
+    html = STYLE_BLOCK_PATTERN.sub(replace_style, html)
+    html = HTML_COMMENT_PATTERN.sub('', html)
+    html = '\n'.join(line.strip() for line in html.splitlines() if line.strip())
+    return re.sub(r'\x00(\d+)\x00', lambda m: blocks[int(m.group(1))], html)
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def hashed_name(path: str, digest: str) -> str:
+    """<名称>.<哈希>.<扩展名>"""
+    stem, ext = os.path.splitext(os.path.basename(path))
+    return f"{stem}.{digest}{ext}"
+
+
+def _write_atomic(path: str, data: bytes):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _emit(dist_dir: str, source_path: str, data: bytes) -> Dict[str, object]:
+    """写入带哈希的文件及其预压缩版本，返回清单条目"""
+    digest = content_hash(data)
+    name = hashed_name(source_path, digest)
+    target = os.path.join(dist_dir, name)
+    _write_atomic(target, data)
+
+    encodings = {}
+    if len(data) >= MIN_COMPRESS_SIZE:
+        # mtime=0 保证相同内容生成相同的 .gz
+        compressed = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['br'] = brotli.compress(data, quality=11)
+        for encoding, suffix in ENCODINGS:
+            payload = compressed.get(encoding)
+            # 压缩后反而更大时不提供该编码
+            if payload is not None and len(payload) < len(data):
+                _write_atomic(target + suffix, payload)
+                encodings[encoding] = name + suffix
+
+    stat = os.stat(source_path)
+    return {
+        'file': name,
+        'hash': digest,
+        'size': len(data),
+        'content_type': CONTENT_TYPES[os.path.splitext(source_path)[1]],
+        'encodings': encodings,
+        'source_mtime_ns': stat.st_mtime_ns,
+        'source_size': stat.st_size,
+    }
+
+
+def build(dist_dir: str = DIST_DIR, root: str = '.') -> Dict[str, Dict[str, object]]:
+    """
+    构建全部前端资源并写入清单
+
+    Returns:
+        清单：{源文件相对路径: 条目}
+    """
+    os.makedirs(dist_dir, exist_ok=True)
+    manifest: Dict[str, Dict[str, object]] = {}
+    dist_url = os.path.relpath(dist_dir, root).replace(os.sep, '/')
+
+    for name in SCRIPTS:
+        source_path = os.path.join(root, name)
+        if not os.path.exists(source_path):
+            continue
+        with open(source_path, 'r', encoding='utf-8') as f:
+            data = minify_js(f.read()).encode('utf-8')
+        manifest[name] = _emit(dist_dir, source_path, data)
+
+    for name in ENTRY_PAGES:
+        source_path = os.path.join(root, name)
+        if not os.path.exists(source_path):
+            continue
+        # 页面引用的脚本：任一脚本改动后，页面中带哈希的地址也随之失效
+        dependencies: List[str] = []
+
+        def rewrite_src(match):
+            entry = manifest.get(match.group(2))
+            if entry is None:
+                return match.group(0)
+            dependencies.append(match.group(2))
+            return f"{match.group(1)}{dist_url}/{entry['file']}{match.group(3)}"
+
+        with open(source_path, 'r', encoding='utf-8') as f:
+            html = minify_html(f.read())
+        html = SCRIPT_SRC_PATTERN.sub(rewrite_src, html)
+        manifest[name] = _emit(dist_dir, source_path, html.encode('utf-8'))
+        manifest[name]['dependencies'] = sorted(set(dependencies))
+
+    _write_atomic(os.path.join(dist_dir, MANIFEST_NAME),
+                  json.dumps(manifest, ensure_ascii=False, indent=2).encode('utf-8'))
+    _remove_stale(dist_dir, manifest)
+    return manifest
+
+
+def _remove_stale(dist_dir: str, manifest: Dict[str, Dict[str, object]]):
+    """删除旧版本的构建产物（保留上一版本，避免正在加载旧页面的浏览器取不到脚本）"""
+    current = {MANIFEST_NAME}
+    for entry in manifest.values():
+        current.add(entry['file'])
+        current.update(entry['encodings'].values())
+
+    previous_path = os.path.join(dist_dir, '.previous')
+    previous = set()
+    if os.path.exists(previous_path):
+        with open(previous_path, 'r', encoding='utf-8') as f:
+            previous = set(json.load(f))
+
+    for name in os.listdir(dist_dir):
+        if name not in current and name not in previous and name != '.previous':
+            os.remove(os.path.join(dist_dir, name))
+    _write_atomic(previous_path, json.dumps(sorted(current)).encode('utf-8'))
+
+
+def negotiate_encoding(accept_encoding: Optional[str], available: Dict[str, str]) -> Optional[str]:
+    """按 br > gzip 的顺序选择客户端接受（q>0）且已预压缩的编码，没有时返回 None（不压缩）"""
+    accepted = {}
+    for coding in (accept_encoding or '').split(','):
+        parts = [part.strip() for part in coding.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0]:
+            accepted[parts[0].lower()] = quality
+
+    for encoding, _ in ENCODINGS:
+        if encoding in available and accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+    return None
+
+
+class FrontendBundle:
+    """Web服务器使用的构建清单（清单文件更新后自动重新读取）"""
+
+    def __init__(self, dist_dir: str = DIST_DIR):
+        self.dist_dir = dist_dir
+        # 构建文件的地址前缀（相对站点根目录，与 build() 改写的脚本地址一致）
+        self.url_prefix = os.path.relpath(dist_dir).replace(os.sep, '/') + '/'
+        self._manifest: Dict[str, Dict[str, object]] = {}
+        self._by_file: Dict[str, Dict[str, object]] = {}
+        self._manifest_mtime = None
+
+    def _refresh(self):
+        path = os.path.join(self.dist_dir, MANIFEST_NAME)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self._manifest, self._by_file, self._manifest_mtime = {}, {}, None
+            return
+        if mtime == self._manifest_mtime:
+            return
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 前端构建清单读取失败: {e}")
+            return
+        self._manifest = manifest
+        self._by_file = {entry['file']: entry for entry in manifest.values()}
+        self._manifest_mtime = mtime
+
+    def entry(self, source_name: str) -> Optional[Dict[str, object]]:
+        """入口地址对应的构建条目；未构建或页面及其引用的脚本已改动时返回 None（回退到原文件）"""
+        self._refresh()
+        entry = self._manifest.get(source_name)
+        if entry is None or not self._is_current(source_name, entry):
+            return None
+        for dependency in entry.get('dependencies', ()):
+            dependency_entry = self._manifest.get(dependency)
+            if dependency_entry is None or not self._is_current(dependency, dependency_entry):
+                return None
+        return entry
+
+    @staticmethod
+    def _is_current(source_name: str, entry: Dict[str, object]) -> bool:
+        """源文件的修改时间和大小与构建时相同"""
+        try:
+            stat = os.stat(source_name)
+        except OSError:
+            return False
+        return stat.st_mtime_ns == entry['source_mtime_ns'] and stat.st_size == entry['source_size']
+
+    def hashed(self, file_name: str) -> Optional[Dict[str, object]]:
+        """带哈希的构建文件对应的条目"""
+        self._refresh()
+        return self._by_file.get(file_name)
+
+    def path(self, entry: Dict[str, object], encoding: Optional[str]) -> str:
+        name = entry['encodings'][encoding] if encoding else entry['file']
+        return os.path.join(self.dist_dir, name)
+
+
+if __name__ == "__main__":
+    dist_dir = sys.argv[1] if len(sys.argv) > 1 else DIST_DIR
+    manifest = build(dist_dir)
+    for name, entry in manifest.items():
+        sizes = ', '.join(
+            f"{encoding} {os.path.getsize(os.path.join(dist_dir, file))}B"
+            for encoding, file in entry['encodings'].items()
+        )
+        print(f"📦 {name} -> {entry['file']} ({os.path.getsize(name)}B -> {entry['size']}B{', ' + sizes if sizes else ''})")
+    if brotli is None:
+        print("ℹ️ 未安装brotli，仅生成gzip预压缩版本（pip install brotli）")
+    print(f"✅ 前端资源构建完成，目录 {dist_dir}")
@@ -0,0 +1,125 @@
+"""
+知识库批量检索
+把可检索条目表示为TF-IDF稀疏矩阵，一批查询只需一次矩阵乘法即可完成打分，
+用于离线重放 query_logs.db 中的历史问题做相关性审计
+"""
+
+import math
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from .kb_index import KBIndex, extract_terms
+
+try:
+    import numpy as np
+    from scipy import sparse
+except ImportError:
+    np = None
+    sparse = None
+
+
+def is_available() -> bool:
+    """numpy/scipy 是否可用"""
+    return np is not None and sparse is not None
+
+
+class TfidfMatrix:
+    """文档 × 词项 的TF-IDF稀疏矩阵（行向量L2归一化，打分即余弦相似度）"""
+
+    def __init__(self, index: KBIndex, batch_size: int = 1024):
+        if not is_available():
+            raise RuntimeError("批量检索需要安装 numpy 和 scipy")
+
+        self.index = index
+        self.batch_size = batch_size
+        self.vocabulary: Dict[str, int] = {}
+
+        # 矩阵行号与索引文档编号一致，已删除的文档对应空行
+        doc_tfs = []
+        doc_freqs = Counter()
+        for doc_idx, doc in index.live_documents():
+            tfs = sum(doc['field_terms'].values(), Counter())
+            doc_tfs.append((doc_idx, tfs))
+            doc_freqs.update(tfs.keys())
+
+        for term in doc_freqs:
+            self.vocabulary[term] = len(self.vocabulary)
+
+        doc_count = len(index)
+        self.idf = np.zeros(len(self.vocabulary), dtype=np.float32)
+        for term, df in doc_freqs.items():
+            self.idf[self.vocabulary[term]] = math.log((1 + doc_count) / (1 + df)) + 1
+
+        rows, cols, values = [], [], []
+        for doc_idx, tfs in doc_tfs:
+            for term, tf in tfs.items():
+                col = self.vocabulary[term]
+                rows.append(doc_idx)
+                cols.append(col)
+                values.append((1 + math.log(tf)) * self.idf[col])
+
+        doc_matrix = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), (rows, cols)),
+            shape=(len(index.documents), len(self.vocabulary))
+        )
+        # 预先转置，批量打分时直接 Q @ D^T
+        self.doc_matrix_t = self._normalize(doc_matrix).T.tocsr()
+
+    @staticmethod
+    def _normalize(matrix):
+        """按行做L2归一化"""
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1.0
+        return sparse.diags(1.0 / norms).dot(matrix).tocsr()
+
+    def transform(self, queries: List[str]):
+        """把一批查询转换为TF-IDF稀疏矩阵（未登录词直接丢弃）"""
+        rows, cols, values = [], [], []
+        for row, query in enumerate(queries):
+            tfs = Counter(extract_terms(query.lower()))
+            for term, tf in tfs.items():
+                col = self.vocabulary.get(term)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+                    values.append((1 + math.log(tf)) * self.idf[col])
+
+        query_matrix = sparse.csr_matrix(
+            (np.asarray(values, dtype=np.float32), (rows, cols)),
+            shape=(len(queries), len(self.vocabulary))
+        )
+        return self._normalize(query_matrix)
+
+    def top_k(self, queries: List[str], top_k: int = 3) -> List[List[Tuple[int, float]]]:
+        """
+        批量计算每个查询的前top_k个文档
+
+        Returns:
+            与 queries 一一对应的 [(文档编号, 余弦得分), ...]，按得分降序，只含得分大于0的文档
+        """
+        doc_count = self.doc_matrix_t.shape[1]
+        k = min(top_k, doc_count)
+        results: List[List[Tuple[int, float]]] = []
+        if k <= 0:
+            return [[] for _ in queries]
+
+        # 分批计算，控制稠密得分矩阵的内存占用
+        for start in range(0, len(queries), self.batch_size):
+            batch = queries[start:start + self.batch_size]
+            scores = (self.transform(batch) @ self.doc_matrix_t).toarray()
+
+            if k < doc_count:
+                top_idx = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top_idx = np.tile(np.arange(doc_count), (len(batch), 1))
+            top_scores = np.take_along_axis(scores, top_idx, axis=1)
+            order = np.argsort(-top_scores, axis=1, kind='stable')
+            top_idx = np.take_along_axis(top_idx, order, axis=1)
+            top_scores = np.take_along_axis(top_scores, order, axis=1)
+
+            for doc_ids, doc_scores in zip(top_idx.tolist(), top_scores.tolist()):
+                results.append([
+                    (doc_idx, score) for doc_idx, score in zip(doc_ids, doc_scores) if score > 0
+                ])
+
+        return results
@@ -0,0 +1,156 @@
+"""
+知识库关键词加权
+加权词来自配置文件（kb/boost_terms.json）和XML中的 <keywords>，
+编译成 Aho–Corasick 自动机：查询只需扫描一遍，
+再通过预先计算好的 词 -> 条目 倒排表叠加权重
+"""
+
+import json
+import os
+from collections import deque
+from typing import Dict, List, Iterable, Set, Tuple, Any
+
+from .kb_index import KBIndex
+
+
+def compact_term(text: str) -> str:
+    """加权词匹配时统一小写并去掉空格（"Mo Human" 与 "mohuman" 视为同一词）"""
+    return text.lower().replace(' ', '')
+
+
+def read_boost_terms(path: str) -> List[Tuple[str, float]]:
+    """
+    读取加权词配置文件，保留配置中的原始写法（用于展示）
+
+    格式: {"terms": [{"term": "钱学森", "weight": 0.4}, ...]}
+    文件不存在时返回空列表
+    """
+    if not path or not os.path.exists(path):
+        return []
+
+    with open(path, 'r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    return [(item.get('term', '').strip(), float(item.get('weight', 0.0)))
+            for item in config.get('terms', []) if item.get('term', '').strip()]
+
+
+def load_boost_terms(path: str) -> Dict[str, float]:
+    """读取加权词配置文件，返回 {匹配键: 权重}（键见 compact_term）"""
+    return {compact_term(term): weight for term, weight in read_boost_terms(path)}
+
+
+class AhoCorasick:
+    """Aho–Corasick 多模式匹配自动机"""
+
+    def __init__(self, patterns: Iterable[str]):
+        self.patterns: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._build_fail_links()
+
+    def _add(self, pattern: str):
+        if not pattern:
+            return
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            node = next_node
+        self._output[node].append(len(self.patterns))
+        self.patterns.append(pattern)
+
+    def _build_fail_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+
+    def find(self, text: str) -> Set[int]:
+        """扫描一遍文本，返回命中的模式编号集合"""
+        matched = set()
+        node = 0
+        goto, fail, output = self._goto, self._fail, self._output
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                matched.update(output[node])
+        return matched
+
+
+class BoostIndex:
+    """
+    加权词 -> 条目权重 的倒排表
+
+    - 配置文件中的全局加权词：对正文包含该词的内容条目加权
+    - XML中条目自己声明的 <keyword>：只对声明它的条目加权
+    """
+
+    def __init__(self, index: KBIndex, global_terms: Dict[str, float], default_keyword_weight: float = 0.1):
+        keyword_weights: Dict[int, Dict[str, float]] = {}
+        for doc_idx, doc in index.live_documents():
+            weights = self._declared_keywords(doc['payload'], default_keyword_weight)
+            if weights:
+                keyword_weights[doc_idx] = weights
+
+        all_terms = set(global_terms)
+        for weights in keyword_weights.values():
+            all_terms.update(weights)
+        self.automaton = AhoCorasick(sorted(all_terms))
+        term_ids = {term: term_id for term_id, term in enumerate(self.automaton.patterns)}
+
+        self.postings: Dict[int, Dict[int, float]] = {}
+        global_ids = {term_ids[term]: weight for term, weight in global_terms.items() if weight}
+        for doc_idx, doc in index.live_documents():
+            if doc['type'] != 'content' or not global_ids:
+                continue
+            # 每个条目只扫描一遍，找出它包含的全部全局加权词
+            for term_id in self.automaton.find(compact_term(doc['text'])):
+                if term_id in global_ids:
+                    self._add_posting(term_id, doc_idx, global_ids[term_id])
+
+        for doc_idx, weights in keyword_weights.items():
+            for term, weight in weights.items():
+                self._add_posting(term_ids[term], doc_idx, weight)
+
+    @staticmethod
+    def _declared_keywords(payload: Dict[str, Any], default_weight: float) -> Dict[str, float]:
+        """读取条目在XML中声明的关键词及权重"""
+        entry = payload.get('subsection') or payload.get('link') or {}
+        explicit = entry.get('keyword_weights', {})
+        weights = {}
+        for keyword in entry.get('keywords', []):
+            term = compact_term(keyword)
+            weight = explicit.get(keyword, default_weight)
+            if term and weight:
+                weights[term] = weight
+        return weights
+
+    def _add_posting(self, term_id: int, doc_idx: int, weight: float):
+        postings = self.postings.setdefault(term_id, {})
+        postings[doc_idx] = postings.get(doc_idx, 0.0) + weight
+
+    def boosts(self, query: str) -> Dict[int, float]:
+        """扫描一遍查询，返回 {文档编号: 加权分}"""
+        bonus: Dict[int, float] = {}
+        for term_id in self.automaton.find(compact_term(query)):
+            for doc_idx, weight in self.postings.get(term_id, {}).items():
+                bonus[doc_idx] = bonus.get(doc_idx, 0.0) + weight
+        return bonus
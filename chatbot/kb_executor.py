@@ -0,0 +1,206 @@
+"""
+知识库检索执行器
+知识库打分是纯Python计算，会一直持有GIL；放在默认线程池里时，
+并发对话的检索会和其他阻塞任务挤在一起、互相排队。
+
+这里提供专用的检索执行器：
+- thread：有界的专用线程池，与默认线程池隔离
+- process：进程池，每个工作进程持有一份只读的知识库索引（从快照加载），
+  检索可以利用多个CPU核心
+
+两种模式都限制排队深度，超过上限直接拒绝，并记录排队/执行耗时等指标
+"""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Dict, List, Any
+
+from .kb_cache import QueryCache, normalize_query
+
+EXECUTOR_MODES = ('thread', 'process')
+
+# 工作进程内的知识库加载器（每个进程一份）
+_worker_loader = None
+# 工作进程最近一次按主进程版本同步时的版本号
+_worker_synced_version = None
+
+
+class SearchQueueFull(RuntimeError):
+    """检索排队数超过上限"""
+
+
+def _init_worker(kb_path: str, scorer_name: str):
+    """工作进程初始化：加载一份只读的知识库"""
+    global _worker_loader, _worker_synced_version
+    from .kb_loader import MogineKBLoader
+
+    loader = MogineKBLoader(kb_path, scorer=scorer_name, watch_interval=0)
+    # 主进程负责缓存和写快照，工作进程只做计算
+    loader.query_cache = QueryCache(max_size=0)
+    loader.use_snapshot = False
+    _worker_loader = loader
+    _worker_synced_version = loader.version
+
+
+def _worker_search(version: str, query: str, top_k: int) -> List[Dict[str, Any]]:
+    """
+    在工作进程中执行检索；主进程的知识库版本变化后先增量重新加载
+
+    每个主进程版本只同步一次：主进程还没发现磁盘上的新文件时，
+    工作进程的版本可能领先于主进程，这时不再反复重新解析XML
+    """
+    global _worker_synced_version
+    if version != _worker_synced_version:
+        _worker_loader.reload()
+        _worker_synced_version = version
+    return _worker_loader.search_knowledge(query, top_k)
+
+
+def _worker_ping() -> int:
+    return os.getpid()
+
+
+class SearchExecutor:
+    """知识库检索专用执行器"""
+
+    def __init__(self, kb_loader, mode: str = 'thread', workers: int = 0, max_pending: int = 64):
+        if mode not in EXECUTOR_MODES:
+            raise ValueError(f"未知的检索执行器模式: {mode}，可选: {', '.join(EXECUTOR_MODES)}")
+
+        self.kb_loader = kb_loader
+        self.mode = mode
+        self.workers = workers if workers > 0 else min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._metrics = {
+            'submitted': 0,
+            'completed': 0,
+            'failed': 0,
+            'rejected': 0,
+            'cache_hits': 0,
+            'peak_pending': 0,
+            'queue_seconds': 0.0,
+            'run_seconds': 0.0,
+        }
+
+        if mode == 'process':
+            # 优先用fork启动：spawn会在子进程中重新导入 main.py，把整个应用再初始化一遍
+            context = None
+            if 'fork' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('fork')
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=context,
+                initializer=_init_worker,
+                initargs=(kb_loader.kb_path, kb_loader.scorer_name)
+            )
+        else:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='kb-search')
+        # 只能在主进程中执行的检索任务（向量检索持有ChromaDB连接）：线程模式共用检索线程池，
+        # 进程模式另开一个同样有界的线程池
+        self._local_pool = self._pool if mode == 'thread' else ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix='kb-local'
+        )
+
+    def warm_up(self):
+        """预先启动全部工作进程，避免第一批查询承担加载知识库的耗时"""
+        if self.mode == 'process':
+            futures = [self._pool.submit(_worker_ping) for _ in range(self.workers)]
+            pids = {future.result() for future in futures}
+            print(f"✅ 知识库检索进程池就绪，共 {len(pids)} 个工作进程")
+
+    async def search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        """在专用执行器中检索知识库"""
+        loader = self.kb_loader
+
+        # 结果缓存在提交前查询，命中时不占用执行器（进程模式下也不必跨进程）
+        state = loader.state
+        segments = loader.custom_segments.snapshot()
+        normalized_query = normalize_query(query)
+        cache_key = (state.version, segments.generation, normalized_query, top_k)
+        cached = loader.query_cache.get(cache_key) if loader.query_cache.enabled else None
+        if cached is not None:
+            with self._lock:
+                self._metrics['cache_hits'] += 1
+            return list(cached)
+
+        if self.mode == 'process':
+            # 工作进程只持有XML知识库；运行时写入的分段在主进程检索后合并
+            results = await self._submit(self._pool, _worker_search, state.version, normalized_query, top_k)
+            results = loader.merge_custom_results(results, segments, normalized_query, top_k)
+        else:
+            results = await self._submit(self._pool, loader.search_state, state, segments, normalized_query, top_k)
+
+        if loader.query_cache.enabled:
+            loader.query_cache.put(cache_key, results)
+        return list(results)
+
+    async def run_local(self, fn, *args):
+        """在主进程的专用线程中执行其他检索任务（如向量检索），同样受排队上限约束"""
+        return await self._submit(self._local_pool, fn, *args)
+
+    async def _submit(self, pool, fn, *args):
+        with self._lock:
+            if self._pending >= self.max_pending > 0:
+                self._metrics['rejected'] += 1
+                raise SearchQueueFull(f"知识库检索排队已满（{self.max_pending}），请稍后重试")
+            self._pending += 1
+            self._metrics['submitted'] += 1
+            self._metrics['peak_pending'] = max(self._metrics['peak_pending'], self._pending)
+
+        submitted_at = time.perf_counter()
+        started = {}
+
+        def run():
+            started['at'] = time.perf_counter()
+            return fn(*args)
+
+        loop = asyncio.get_running_loop()
+        succeeded = False
+        try:
+            if isinstance(pool, ProcessPoolExecutor):
+                result = await loop.run_in_executor(pool, fn, *args)
+            else:
+                result = await loop.run_in_executor(pool, run)
+            succeeded = True
+            return result
+        finally:
+            elapsed = time.perf_counter() - submitted_at
+            # 进程池中无法记录开始时间，排队耗时计入执行耗时
+            queue_seconds = started['at'] - submitted_at if 'at' in started else 0.0
+            with self._lock:
+                self._pending -= 1
+                if succeeded:
+                    self._metrics['completed'] += 1
+                    self._metrics['queue_seconds'] += queue_seconds
+                    self._metrics['run_seconds'] += elapsed - queue_seconds
+                else:
+                    self._metrics['failed'] += 1
+
+    def stats(self) -> Dict[str, Any]:
+        """执行器指标"""
+        with self._lock:
+            metrics = dict(self._metrics)
+            pending = self._pending
+
+        completed = metrics['completed']
+        return {
+            'mode': self.mode,
+            'workers': self.workers,
+            'max_pending': self.max_pending,
+            'pending': pending,
+            **metrics,
+            'avg_queue_ms': metrics['queue_seconds'] / completed * 1000 if completed else 0.0,
+            'avg_run_ms': metrics['run_seconds'] / completed * 1000 if completed else 0.0,
+        }
+
+    def shutdown(self, wait: bool = True):
+        self._pool.shutdown(wait=wait)
+        if self._local_pool is not self._pool:
+            self._local_pool.shutdown(wait=wait)
@@ -0,0 +1,533 @@
+"""
+知识库倒排索引与打分器
+在加载知识库时一次性构建，查询时只对倒排表命中的候选条目打分
+"""
+
+import heapq
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Set, Any, Iterable, Optional, Tuple
+
+WORD_PATTERN = re.compile(r'\w+')
+
+# BM25词项：连续汉字切成字符bigram，其余字母数字串整体作为一个词
+TERM_PATTERN = re.compile(r'[\u4e00-\u9fff]+|[^\W\u4e00-\u9fff]+')
+CJK_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+
+# 字符n-gram长度：中文没有空格分词，用2-3字符片段近似词语
+NGRAM_SIZES = (2, 3)
+
+# 上界比较时的浮点误差余量，保证剪枝不会误删
+BOUND_EPSILON = 1e-9
+
+
+def extract_words(text: str) -> Set[str]:
+    """提取词级token（与原有 re.findall(r'\\w+') 的切分方式保持一致）"""
+    return set(WORD_PATTERN.findall(text))
+
+
+def extract_ngrams(text: str, sizes: Iterable[int] = NGRAM_SIZES) -> Set[str]:
+    """提取字符n-gram，不跨越空白字符"""
+    grams = set()
+    for segment in text.split():
+        for n in sizes:
+            for i in range(len(segment) - n + 1):
+                grams.add(segment[i:i + n])
+    return grams
+
+
+def extract_terms(text: str) -> List[str]:
+    """提取BM25词项（保留重复，用于统计词频）"""
+    terms = []
+    for run in TERM_PATTERN.findall(text):
+        if CJK_PATTERN.match(run):
+            if len(run) == 1:
+                terms.append(run)
+            else:
+                terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return terms
+
+
+class KBIndex:
+    """
+    知识库倒排索引：字符bigram/trigram + 词级token + 单字符 -> 文档编号列表
+
+    文档编号在索引生命周期内保持稳定，删除的文档只留下空位（None）。
+    copy() 得到的新索引与原索引共享倒排表，修改时按词项写时复制，
+    因此可以在后台增量更新新索引，而旧索引继续无锁服务查询。
+    """
+
+    def __init__(self):
+        self.documents: List[Optional[Dict[str, Any]]] = []
+        self.gram_postings: Dict[str, List[int]] = {}
+        self.word_postings: Dict[str, List[int]] = {}
+        # 单字符倒排表：查询与条目可能只有单个字符相同（"钱"、"价格"），n-gram 取不到这些文档
+        self.char_postings: Dict[str, List[int]] = {}
+        self.doc_keys: Dict[str, int] = {}
+        # 本索引独占、可以原地追加的倒排表 (类别, 词项)；None 表示全部独占（未被拷贝过）
+        self._owned: Optional[Set[Tuple[str, str]]] = None
+
+    def _append_posting(self, kind: str, postings: Dict[str, List[int]], term: str, doc_idx: int):
+        """向倒排表追加文档编号；与其他索引共享的倒排表先复制再追加"""
+        posting = postings.get(term)
+        if posting is not None and (self._owned is None or (kind, term) in self._owned):
+            posting.append(doc_idx)
+            return
+        postings[term] = (posting or []) + [doc_idx]
+        if self._owned is not None:
+            self._owned.add((kind, term))
+
+    def add_document(self, doc_type: str, fields: Dict[str, str], payload: Dict[str, Any],
+                     key: Optional[str] = None) -> int:
+        """
+        添加一个可检索文档
+
+        Args:
+            doc_type: 文档类型（content / external_link）
+            fields: 分字段文本（如 title / body），按顺序拼接为全文
+            payload: 原始条目数据，打分后用于构建结果
+            key: 条目的稳定标识（如子章节id），用于增量更新
+
+        Returns:
+            文档编号
+        """
+        doc_idx = len(self.documents)
+        fields_lower = {name: value.lower() for name, value in fields.items()}
+        text_lower = ' '.join(fields_lower.values())
+        words = extract_words(text_lower)
+        grams = extract_ngrams(text_lower)
+        chars = set(text_lower.replace(' ', ''))
+
+        self.documents.append({
+            'key': key,
+            'type': doc_type,
+            'text': text_lower,
+            'fields': fields_lower,
+            'field_terms': {name: Counter(extract_terms(value)) for name, value in fields_lower.items()},
+            'chars': chars,
+            'words': words,
+            'payload': payload
+        })
+        if key is not None:
+            self.doc_keys[key] = doc_idx
+
+        for gram in grams:
+            self._append_posting('gram', self.gram_postings, gram, doc_idx)
+        for word in words:
+            self._append_posting('word', self.word_postings, word, doc_idx)
+        for char in chars:
+            self._append_posting('char', self.char_postings, char, doc_idx)
+
+        return doc_idx
+
+    def remove_document(self, doc_idx: int):
+        """删除文档（留下空位，相关倒排表重新生成而不是原地修改）"""
+        doc = self.documents[doc_idx]
+        if doc is None:
+            return
+
+        self.documents[doc_idx] = None
+        if doc['key'] is not None and self.doc_keys.get(doc['key']) == doc_idx:
+            del self.doc_keys[doc['key']]
+
+        for kind, postings, terms in (('gram', self.gram_postings, extract_ngrams(doc['text'])),
+                                      ('word', self.word_postings, doc['words']),
+                                      ('char', self.char_postings, doc['chars'])):
+            for term in terms:
+                remaining = [i for i in postings.get(term, ()) if i != doc_idx]
+                if remaining:
+                    postings[term] = remaining
+                    if self._owned is not None:
+                        self._owned.add((kind, term))
+                else:
+                    postings.pop(term, None)
+
+    def copy(self) -> 'KBIndex':
+        """浅拷贝：共享文档和倒排表，之后的修改不会影响原索引"""
+        index = KBIndex()
+        index.documents = list(self.documents)
+        index.gram_postings = dict(self.gram_postings)
+        index.word_postings = dict(self.word_postings)
+        index.char_postings = dict(self.char_postings)
+        index.doc_keys = dict(self.doc_keys)
+        # 拷贝之后两边的倒排表都是共享的，任何一边追加前都要先复制
+        index._owned = set()
+        self._owned = set()
+        return index
+
+    def live_documents(self) -> Iterable[Tuple[int, Dict[str, Any]]]:
+        """遍历未删除的文档 (文档编号, 文档)"""
+        for doc_idx, doc in enumerate(self.documents):
+            if doc is not None:
+                yield doc_idx, doc
+
+    @property
+    def tombstone_count(self) -> int:
+        return len(self.documents) - len(self)
+
+    def candidates(self, query_lower: str) -> Set[int]:
+        """根据查询的n-gram和词级token从倒排表中取候选文档"""
+        candidate_ids = set()
+        for gram in extract_ngrams(query_lower):
+            candidate_ids.update(self.gram_postings.get(gram, ()))
+        for word in extract_words(query_lower):
+            candidate_ids.update(self.word_postings.get(word, ()))
+        return candidate_ids
+
+    def char_matches(self, query_lower: str) -> Counter:
+        """与查询有相同字符的文档，返回 {文档编号: 相同的（去重）字符数}"""
+        matches = Counter()
+        for char in set(query_lower.replace(' ', '')):
+            matches.update(self.char_postings.get(char, ()))
+        return matches
+
+    def __len__(self) -> int:
+        return sum(1 for doc in self.documents if doc is not None)
+
+
+class TopKHeap:
+    """
+    大小为k的最小堆，只保留得分最高的k个文档
+
+    堆顶即当前第k名的得分，打分器据此跳过上界达不到的文档。
+    同分时文档编号小的优先，与原先"按编号遍历 + 稳定排序"的结果一致。
+    """
+
+    def __init__(self, k: int, floor: float = 0.0):
+        self.k = k
+        self.floor = floor
+        self._heap: List[Tuple[float, int]] = []
+
+    @property
+    def full(self) -> bool:
+        return len(self._heap) >= self.k
+
+    @property
+    def threshold(self) -> float:
+        """进入前k名需要超过的分数"""
+        if self.full:
+            return max(self.floor, self._heap[0][0])
+        return self.floor
+
+    def can_enter(self, upper_bound: float) -> bool:
+        """上界为 upper_bound 的文档是否还有可能进入前k名"""
+        if self.k <= 0:
+            return False
+        if upper_bound + BOUND_EPSILON <= self.floor:
+            return False
+        return not self.full or upper_bound + BOUND_EPSILON >= self._heap[0][0]
+
+    def push(self, score: float, doc_idx: int):
+        if self.k <= 0:
+            return
+        item = (score, -doc_idx)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            heapq.heapreplace(self._heap, item)
+
+    def results(self) -> List[Tuple[float, int]]:
+        """按得分降序返回 [(得分, 文档编号)]"""
+        return [(score, -neg_idx) for score, neg_idx in sorted(self._heap, reverse=True)]
+
+
+class LegacyScorer:
+    """原有打分规则：字符覆盖 + 词覆盖 + 子串加分 + 长度因子"""
+
+    name = 'legacy'
+
+    def __init__(self, index: KBIndex):
+        self.index = index
+        self.thresholds = {'content': 0.15, 'external_link': 0.2}
+
+    def query_features(self, query: str) -> Dict[str, Any]:
+        """预先计算查询侧特征，同一查询对所有候选条目复用"""
+        # 检查2-5字符的子串
+        substrings = []
+        for i in range(2, min(len(query) + 1, 6)):
+            for j in range(len(query) - i + 1):
+                substrings.append(query[j:j + i])
+
+        return {
+            'query': query,
+            'chars': set(query.replace(' ', '')),
+            'words': extract_words(query),
+            'substrings': substrings
+        }
+
+    def _combine(self, char_coverage: float, word_coverage: float, substring_score: float, text: str) -> float:
+        # 综合评分
+        final_score = (char_coverage * 0.3 + word_coverage * 0.4 + substring_score * 0.3)
+
+        # 考虑文本长度的影响
+        length_factor = min(1.0, len(text) / 50)
+
+        return final_score * 0.9 + length_factor * 0.1
+
+    def _coverages(self, query_features: Dict[str, Any], doc: Dict[str, Any]) -> Tuple[float, float]:
+        """字符级和词级覆盖率（集合求交，代价低）"""
+        # 字符级匹配
+        query_chars = query_features['chars']
+        char_matches = query_chars.intersection(doc['chars'])
+        char_coverage = len(char_matches) / len(query_chars) if query_chars else 0
+
+        # 词级匹配
+        query_words = query_features['words']
+        word_matches = query_words.intersection(doc['words'])
+        word_coverage = len(word_matches) / len(query_words) if query_words else 0
+
+        return char_coverage, word_coverage
+
+    def _substring_score(self, query_features: Dict[str, Any], text: str) -> float:
+        """子串匹配得分（逐个子串查找，代价最高的一步）"""
+        query = query_features['query']
+        substring_score = 0
+        for substring in query_features['substrings']:
+            if substring in text:
+                substring_score += len(substring) / len(query)
+        return substring_score
+
+    def score_document(self, query_features: Dict[str, Any], doc: Dict[str, Any]) -> float:
+        """基于预计算特征计算查询与文档的相关性"""
+        query = query_features['query']
+        text = doc['text']
+        if not query or not text:
+            return 0.0
+
+        char_coverage, word_coverage = self._coverages(query_features, doc)
+        substring_score = self._substring_score(query_features, text)
+        return self._combine(char_coverage, word_coverage, substring_score, text)
+
+    def score(self, query_lower: str) -> Dict[int, float]:
+        """对候选文档打分，返回 {文档编号: 相关性}"""
+        features = self.query_features(query_lower)
+        documents = self.index.documents
+        # 没有相同字符的文档得分只剩长度因子，低于阈值，不必打分
+        return {
+            doc_idx: self.score_document(features, documents[doc_idx])
+            for doc_idx in self.index.candidates(query_lower) | self.index.char_matches(query_lower).keys()
+        }
+
+    def top_k(self, query_lower: str, k: int, boosts: Optional[Dict[int, float]] = None) -> List[Tuple[float, int]]:
+        """
+        返回得分（含关键词加权）最高的k个文档 [(得分, 文档编号)]
+
+        先用代价低的字符/词覆盖率加上子串得分的理论最大值算出每个候选的上界，
+        按上界从高到低逐个精算；一旦上界不超过当前第k名，剩余候选全部跳过，
+        不再做子串查找
+
+        与查询只有单个字符相同（没有共同的n-gram和词）的文档同样参与排名：
+        这类文档的词覆盖率为0，不含空白的子串也不可能出现在正文中，
+        字符覆盖率直接由单字符倒排表计数得到，结果与逐条打分全部文档相同
+        """
+        boosts = boosts or {}
+        documents = self.index.documents
+        features = self.query_features(query_lower)
+        query = features['query']
+        heap = TopKHeap(k, min(self.thresholds.values()))
+
+        # 所有子串都命中时的子串得分
+        max_substring_score = sum(len(sub) / len(query) for sub in features['substrings']) if query else 0
+
+        candidates = self.index.candidates(query_lower) | boosts.keys()
+        bounded = []
+        for doc_idx in candidates:
+            doc = documents[doc_idx]
+            if doc is None:
+                continue
+            text = doc['text']
+            if not query or not text:
+                bounded.append((boosts.get(doc_idx, 0.0), doc_idx, 0.0, 0.0, False))
+                continue
+            char_coverage, word_coverage = self._coverages(features, doc)
+            upper_bound = self._combine(char_coverage, word_coverage, max_substring_score, text)
+            bounded.append((upper_bound + boosts.get(doc_idx, 0.0), doc_idx, char_coverage, word_coverage, True))
+
+        # 只有单个字符相同的文档：能命中的子串只有含空白的（n-gram不跨越空白）
+        query_chars = features['chars']
+        space_substring_score = sum(len(sub) / len(query) for sub in features['substrings'] if ' ' in sub)
+        for doc_idx, shared in self.index.char_matches(query_lower).items():
+            doc = documents[doc_idx]
+            if doc_idx in candidates or doc is None or not doc['text']:
+                continue
+            char_coverage = shared / len(query_chars)
+            upper_bound = self._combine(char_coverage, 0.0, space_substring_score, doc['text'])
+            if heap.can_enter(upper_bound):
+                bounded.append((upper_bound, doc_idx, char_coverage, 0.0, space_substring_score > 0))
+
+        bounded.sort(key=lambda item: (-item[0], item[1]))
+        for upper_bound, doc_idx, char_coverage, word_coverage, scan_substrings in bounded:
+            if not heap.can_enter(upper_bound):
+                break
+            doc = documents[doc_idx]
+            text = doc['text']
+            if query and text:
+                substring_score = self._substring_score(features, text) if scan_substrings else 0.0
+                relevance = self._combine(char_coverage, word_coverage, substring_score, text)
+            else:
+                relevance = 0.0
+            score = relevance + boosts.get(doc_idx, 0.0)
+            if score > self.thresholds[doc['type']]:
+                heap.push(score, doc_idx)
+
+        return heap.results()
+
+
+class BM25Scorer:
+    """
+    BM25F打分器
+
+    加载时预计算文档频率、各字段平均长度和IDF，并把每个 (词项, 文档)
+    的BM25权重写进倒排表；查询时每个词项只需一次字典查找。
+    得分除以查询的理论上限（各词项 idf*(k1+1) 之和），归一化到 [0, 1)，
+    不同文档、不同查询之间可以直接比较。
+    """
+
+    name = 'bm25'
+
+    def __init__(self,
+                 index: KBIndex,
+                 k1: float = 1.2,
+                 b: float = 0.75,
+                 field_weights: Optional[Dict[str, float]] = None,
+                 min_score: float = 0.0):
+        self.index = index
+        self.k1 = k1
+        self.b = b
+        self.field_weights = field_weights or {'title': 2.0, 'body': 1.0}
+        self.thresholds = {'content': min_score, 'external_link': min_score}
+
+        self.doc_count = len(index)
+        self.avg_field_lengths: Dict[str, float] = {}
+        self.idf: Dict[str, float] = {}
+        self.postings: Dict[str, Dict[int, float]] = {}
+        self.max_weights: Dict[str, float] = {}
+        self._build()
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+
+    def _build(self):
+        """预计算词频、字段长度、文档频率、IDF和词项权重"""
+        doc_field_tfs = []
+        field_length_totals = Counter()
+        doc_freqs = Counter()
+
+        # 词频在建索引时已按字段统计好，这里只做算术，不再分词
+        for doc_idx, doc in self.index.live_documents():
+            field_tfs = {}
+            doc_terms = set()
+            for field, tfs in doc['field_terms'].items():
+                length = sum(tfs.values())
+                field_tfs[field] = (tfs, length)
+                field_length_totals[field] += length
+                doc_terms.update(tfs)
+            doc_field_tfs.append((doc_idx, field_tfs))
+            doc_freqs.update(doc_terms)
+
+        if self.doc_count:
+            self.avg_field_lengths = {
+                field: total / self.doc_count for field, total in field_length_totals.items()
+            }
+
+        self.idf = {term: self._idf(df) for term, df in doc_freqs.items()}
+
+        for doc_idx, field_tfs in doc_field_tfs:
+            # 各字段按长度归一化后加权合并为伪词频
+            pseudo_tfs = Counter()
+            for field, (tfs, length) in field_tfs.items():
+                avg_length = self.avg_field_lengths.get(field) or 1.0
+                norm = 1 - self.b + self.b * length / avg_length
+                weight = self.field_weights.get(field, 1.0)
+                for term, tf in tfs.items():
+                    pseudo_tfs[term] += weight * tf / norm
+
+            for term, tf in pseudo_tfs.items():
+                term_weight = self.idf[term] * tf * (self.k1 + 1) / (tf + self.k1)
+                self.postings.setdefault(term, {})[doc_idx] = term_weight
+
+        # 每个词项在所有文档中的最大权重，用于MaxScore剪枝
+        self.max_weights = {
+            term: max(weights.values()) for term, weights in self.postings.items()
+        }
+
+    def score(self, query_lower: str) -> Dict[int, float]:
+        """对候选文档打分，返回 {文档编号: 归一化BM25得分}"""
+        query_terms = Counter(extract_terms(query_lower))
+        if not query_terms:
+            return {}
+
+        unseen_idf = self._idf(0)
+        upper_bound = 0.0
+        scores: Dict[int, float] = {}
+        for term, qtf in query_terms.items():
+            upper_bound += qtf * self.idf.get(term, unseen_idf) * (self.k1 + 1)
+            for doc_idx, term_weight in self.postings.get(term, {}).items():
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + qtf * term_weight
+
+        return {doc_idx: score / upper_bound for doc_idx, score in scores.items()}
+
+    def top_k(self, query_lower: str, k: int, boosts: Optional[Dict[int, float]] = None) -> List[Tuple[float, int]]:
+        """
+        MaxScore剪枝的前k名检索，返回 [(得分, 文档编号)]
+
+        词项按最大权重从高到低逐个处理倒排表；没在已处理倒排表中出现过的文档，
+        得分不会超过剩余词项最大权重之和。一旦这个上界（加上最大关键词加权）
+        达不到当前第k名，剩余倒排表中的新文档全部跳过。
+        """
+        boosts = boosts or {}
+        heap = TopKHeap(k, min(self.thresholds.values()))
+        query_terms = Counter(extract_terms(query_lower))
+        documents = self.index.documents
+
+        unseen_idf = self._idf(0)
+        norm = sum(qtf * self.idf.get(term, unseen_idf) * (self.k1 + 1) for term, qtf in query_terms.items())
+
+        terms = sorted(
+            ((qtf * self.max_weights[term], qtf, self.postings[term])
+             for term, qtf in query_terms.items() if term in self.postings),
+            key=lambda item: -item[0]
+        )
+        remaining_bound = sum(bound for bound, _, _ in terms)
+        max_boost = max(boosts.values(), default=0.0)
+
+        seen = set()
+        for position, (term_bound, _, postings) in enumerate(terms):
+            if not heap.can_enter(remaining_bound / norm + max_boost):
+                break
+            for doc_idx in postings:
+                if doc_idx in seen:
+                    continue
+                seen.add(doc_idx)
+                # 文档不在之前处理过的倒排表中，只需累加当前及之后的词项
+                score = sum(qtf * later.get(doc_idx, 0.0) for _, qtf, later in terms[position:])
+                self._offer(heap, documents, doc_idx, score / norm + boosts.get(doc_idx, 0.0))
+            remaining_bound -= term_bound
+
+        # 只靠关键词加权命中的文档
+        for doc_idx, boost in boosts.items():
+            if doc_idx not in seen and heap.can_enter(boost):
+                self._offer(heap, documents, doc_idx, boost)
+
+        return heap.results()
+
+    def _offer(self, heap: TopKHeap, documents, doc_idx: int, score: float):
+        doc = documents[doc_idx]
+        if doc is not None and score > self.thresholds[doc['type']]:
+            heap.push(score, doc_idx)
+
+
+SCORERS = {
+    LegacyScorer.name: LegacyScorer,
+    BM25Scorer.name: BM25Scorer
+}
+
+
+def create_scorer(name: str, index: KBIndex, **options):
+    """按名称创建打分器"""
+    if name not in SCORERS:
+        raise ValueError(f"未知的知识库打分器: {name}，可选: {', '.join(SCORERS)}")
+    return SCORERS[name](index, **options)
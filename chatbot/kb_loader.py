@@ -1,15 +1,142 @@
 import xml.etree.ElementTree as ET
 import os
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Callable, Iterator, Tuple
 import re
+import threading
+from functools import partial
+from config import Config
+from .kb_index import KBIndex, LegacyScorer, SCORERS, create_scorer
+from . import kb_batch
+from . import kb_snapshot
+from .kb_cache import QueryCache, normalize_query
+from .kb_boost import BoostIndex, load_boost_terms
+from .kb_segments import Segment, SegmentSet, SegmentStore
+from .kb_passages import split_passages, passage_text, merge_adjacent
+from .media_variants import media_urls
+from .video_segments import hls_url
+
+# 批量检索模式，以及带过滤条件时的候选倍数和上限
+BATCH_MODES = ('exact', 'tfidf')
+BATCH_FILTER_OVERFETCH = 4
+BATCH_MAX_FETCH = 100
+
+# 支持的结果过滤条件
+RESULT_FILTERS = ('type', 'source', 'min_score', 'has_media')
+
+
+def filter_results(results: List[Dict[str, Any]], filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    按条件过滤检索结果
+    
+    Args:
+        filters: type —— 结果类型或类型列表（content / external_link / company_info）；
+                 source —— 来源（"章节 - 子章节"）中包含的文本；
+                 min_score —— 最低相关性得分；
+                 has_media —— 是否要求带图片或视频
+    """
+    if not filters:
+        return results
+    unknown = set(filters) - set(RESULT_FILTERS)
+    if unknown:
+        raise ValueError(f"不支持的过滤条件: {', '.join(sorted(unknown))}，可选: {', '.join(RESULT_FILTERS)}")
+    
+    types = filters.get('type')
+    if isinstance(types, str):
+        types = [types]
+    source = filters.get('source')
+    min_score = filters.get('min_score')
+    has_media = filters.get('has_media')
+    
+    filtered = []
+    for result in results:
+        if types and result.get('type') not in types:
+            continue
+        if source and source not in result.get('source', ''):
+            continue
+        if min_score is not None and result.get('relevance_score', 0.0) < float(min_score):
+            continue
+        if has_media is not None and bool(result.get('media_files')) != bool(has_media):
+            continue
+        filtered.append(result)
+    return filtered
+
+
+class KBState:
+    """
+    一次加载的完整结果：解析数据 + 倒排索引 + 打分器 + 关键词加权
+    
+    构建完成后不再修改，重新加载时整体替换引用；
+    查询方只需在开始时取一次引用，无需加锁，也不会看到构建到一半的状态
+    """
+    
+    __slots__ = ('knowledge_data', 'search_index', 'scorer', 'boost', 'version')
+    
+    def __init__(self, knowledge_data: Dict[str, Any], search_index: KBIndex, scorer,
+                 boost: Optional[BoostIndex] = None, version: str = ''):
+        self.knowledge_data = knowledge_data
+        self.search_index = search_index
+        self.scorer = scorer
+        self.boost = boost
+        self.version = version
+
 
 class MogineKBLoader:
     """摩泛科技知识库加载器"""
     
-    def __init__(self, kb_path: str = "kb/mogine_unified_kb_fixed.xml"):
+    def __init__(self,
+                 kb_path: str = "kb/mogine_unified_kb_fixed.xml",
+                 scorer: Optional[str] = None,
+                 use_snapshot: Optional[bool] = None,
+                 watch_interval: Optional[float] = None):
         self.kb_path = kb_path
-        self.knowledge_data = {}
+        self.snapshot_path = Config.KB_SNAPSHOT_PATH or kb_snapshot.default_snapshot_path(kb_path)
+        self.boost_terms_path = Config.KB_BOOST_TERMS_PATH
+        self.use_snapshot = Config.KB_USE_SNAPSHOT if use_snapshot is None else use_snapshot
+        self.scorer_name = scorer or Config.KB_SCORER
+        if self.scorer_name not in SCORERS:
+            raise ValueError(f"未知的知识库打分器: {self.scorer_name}，可选: {', '.join(SCORERS)}")
+        
+        empty_index = KBIndex()
+        self._state = KBState({}, empty_index, LegacyScorer(empty_index), BoostIndex(empty_index, {}))
+        self._tfidf_matrix = None
+        self.query_cache = QueryCache(Config.KB_CACHE_SIZE, Config.KB_CACHE_TTL)
+        self._reload_lock = threading.Lock()
+        self._reload_listeners: List[Callable[['MogineKBLoader'], None]] = []
+        self._watcher_thread = None
+        self._watcher_stop = threading.Event()
+        
+        # 运行时（CMS）写入的条目，独立于XML索引，增删改无需重新加载
+        self.custom_segments = SegmentStore(self._build_segment,
+                                            max_segment_docs=Config.KB_SEGMENT_MAX_DOCS,
+                                            max_segments=Config.KB_MAX_SEGMENTS)
+        
         self.load_knowledge_base()
+        
+        watch_interval = Config.KB_WATCH_INTERVAL if watch_interval is None else watch_interval
+        if watch_interval > 0:
+            self.start_watcher(watch_interval)
+    
+    @property
+    def knowledge_data(self) -> Dict[str, Any]:
+        return self._state.knowledge_data
+    
+    @property
+    def search_index(self) -> KBIndex:
+        return self._state.search_index
+    
+    @property
+    def scorer(self):
+        return self._state.scorer
+    
+    @property
+    def state(self) -> KBState:
+        """当前的知识库状态（不可变，重新加载时整体替换）"""
+        return self._state
+    
+    @property
+    def version(self) -> str:
+        """当前加载的知识库版本（源XML的SHA-256）"""
+        return self._state.version
     
     def load_knowledge_base(self):
         """加载XML知识库"""
@@ -18,30 +145,231 @@ class MogineKBLoader:
                 print(f"知识库文件不存在: {self.kb_path}")
                 return
             
-            tree = ET.parse(self.kb_path)
-            root = tree.getroot()
-            
-            # 解析公司基本信息
-            self._parse_metadata(root)
+            # 优先从编译快照加载，跳过XML解析和索引构建
+            digest = kb_snapshot.source_digest(*self._source_paths())
+            if self.use_snapshot:
+                state = self._load_snapshot(digest)
+                if state is not None:
+                    self._state = state
+                    print(f"✅ 从快照加载知识库，共 {len(self.knowledge_data)} 个条目")
+                    return
             
-            # 解析内容结构
-            self._parse_content_structure(root)
+            knowledge_data = self._parse_knowledge_base()
             
-            # 解析外部链接
-            self._parse_external_links(root)
+            # 构建倒排索引
+            index = self._build_search_index(knowledge_data)
+            self._state = KBState(knowledge_data, index, self._create_scorer(index),
+                                  self._create_boost(index), digest.hex())
             
             print(f"✅ 成功加载知识库，共 {len(self.knowledge_data)} 个条目")
             
+            if self.use_snapshot:
+                self.save_snapshot(digest=digest)
+            
         except Exception as e:
             print(f"❌ 加载知识库失败: {e}")
     
-    def _parse_metadata(self, root):
+    def _parse_knowledge_base(self) -> Dict[str, Any]:
+        """解析XML文件，返回新的知识库数据（不修改当前状态）"""
+        tree = ET.parse(self.kb_path)
+        root = tree.getroot()
+        knowledge_data = {}
+        
+        # 解析公司基本信息
+        self._parse_metadata(root, knowledge_data)
+        
+        # 解析内容结构
+        self._parse_content_structure(root, knowledge_data)
+        
+        # 解析外部链接
+        self._parse_external_links(root, knowledge_data)
+        
+        return knowledge_data
+    
+    def reload(self, force: bool = False) -> Dict[str, Any]:
+        """
+        重新加载知识库
+        
+        按条目id与当前索引比对，只对新增、修改、删除的条目更新索引，
+        构建完成后一次性替换状态引用；进行中的查询继续使用旧状态
+        
+        Args:
+            force: 源文件未变化时也重新解析
+            
+        Returns:
+            本次重新加载的统计信息
+        """
+        with self._reload_lock:
+            digest = kb_snapshot.source_digest(*self._source_paths())
+            version = digest.hex()
+            if not force and version == self._state.version:
+                return {'changed': False, 'version': version, 'added': 0, 'updated': 0, 'removed': 0}
+            
+            knowledge_data = self._parse_knowledge_base()
+            old_state = self._state
+            
+            # 在副本上增量更新，旧索引保持不变
+            index = old_state.search_index.copy()
+            stats = {'added': 0, 'updated': 0, 'removed': 0}
+            current_keys = set()
+            for key, doc_type, fields, payload in self._iter_entries(knowledge_data):
+                current_keys.add(key)
+                doc_idx = index.doc_keys.get(key)
+                if doc_idx is not None:
+                    doc = index.documents[doc_idx]
+                    new_fields = {name: value.lower() for name, value in fields.items()}
+                    if doc['type'] == doc_type and doc['fields'] == new_fields and doc['payload'] == payload:
+                        continue
+                    index.remove_document(doc_idx)
+                    stats['updated'] += 1
+                else:
+                    stats['added'] += 1
+                index.add_document(doc_type, fields, payload, key=key)
+            
+            for key, doc_idx in list(index.doc_keys.items()):
+                if key not in current_keys:
+                    index.remove_document(doc_idx)
+                    stats['removed'] += 1
+            
+            # 删除留下的空位过多时整体重建，压缩文档编号
+            if index.tombstone_count > len(index):
+                index = self._build_search_index(knowledge_data)
+            
+            # 原子替换：单次引用赋值
+            self._state = KBState(knowledge_data, index, self._create_scorer(index),
+                                  self._create_boost(index), version)
+            
+            # 缓存键带有版本号，旧结果不会再命中，这里只是尽早释放内存
+            self.query_cache.clear()
+            
+            if self.use_snapshot:
+                self.save_snapshot(digest=digest)
+            
+            print(f"🔄 知识库已重新加载: 新增 {stats['added']}，修改 {stats['updated']}，删除 {stats['removed']}")
+        
+        for listener in list(self._reload_listeners):
+            try:
+                listener(self)
+            except Exception as e:
+                print(f"⚠️ 知识库重新加载回调失败: {e}")
+        
+        return {'changed': True, 'version': version, **stats}
+    
+    def add_reload_listener(self, listener: Callable[['MogineKBLoader'], None]):
+        """注册重新加载完成后的回调"""
+        self._reload_listeners.append(listener)
+    
+    def start_watcher(self, interval: float = 5.0):
+        """启动后台线程，定期检查XML文件并在变化时重新加载"""
+        if self._watcher_thread is not None and self._watcher_thread.is_alive():
+            return
+        
+        self._watcher_stop.clear()
+        self._watcher_thread = threading.Thread(
+            target=self._watch_loop, args=(interval,), name="kb-watcher", daemon=True
+        )
+        self._watcher_thread.start()
+        print(f"👀 知识库文件监控已启动，检查间隔 {interval} 秒")
+    
+    def stop_watcher(self):
+        """停止文件监控线程"""
+        self._watcher_stop.set()
+        if self._watcher_thread is not None:
+            self._watcher_thread.join()
+            self._watcher_thread = None
+    
+    def _watch_loop(self, interval: float):
+        """按修改时间轮询源文件；只有修改时间变化时才计算摘要并重新加载"""
+        last_mtime = self._source_mtime()
+        while not self._watcher_stop.wait(interval):
+            mtime = self._source_mtime()
+            if mtime is None or mtime == last_mtime:
+                continue
+            last_mtime = mtime
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"❌ 重新加载知识库失败: {e}")
+    
+    def _source_paths(self) -> List[str]:
+        """影响检索结果的源文件：XML知识库和加权词配置"""
+        return [self.kb_path, self.boost_terms_path]
+    
+    def _source_mtime(self) -> Optional[tuple]:
+        try:
+            return tuple(
+                os.stat(path).st_mtime if os.path.exists(path) else None
+                for path in self._source_paths()
+            )
+        except OSError:
+            return None
+    
+    def _scorer_key(self) -> tuple:
+        """打分器配置标识，配置变化时快照中的打分器需要重建"""
+        if self.scorer_name == 'bm25':
+            return ('bm25', Config.KB_BM25_K1, Config.KB_BM25_B, Config.KB_BM25_MIN_SCORE)
+        return (self.scorer_name,)
+    
+    def _load_snapshot(self, digest: bytes) -> Optional[KBState]:
+        """从快照恢复解析结果和索引，快照缺失或过期时返回None"""
+        try:
+            snapshot = kb_snapshot.read_snapshot(self.snapshot_path, digest)
+        except Exception as e:
+            print(f"⚠️ 读取知识库快照失败: {e}")
+            return None
+        if snapshot is None:
+            return None
+        
+        index = snapshot['search_index']
+        if snapshot.get('passage_chars') != Config.KB_PASSAGE_CHARS:
+            # 段落切分配置变化：用快照中的解析结果重建索引，无需重新解析XML
+            index = self._build_search_index(snapshot['knowledge_data'])
+            scorer = self._create_scorer(index)
+        else:
+            self._refresh_media_files(index)
+            if snapshot.get('scorer_key') == self._scorer_key():
+                scorer = snapshot['scorer']
+            else:
+                scorer = self._create_scorer(index)
+        return KBState(snapshot['knowledge_data'], index, scorer, self._create_boost(index), digest.hex())
+    
+    def _refresh_media_files(self, index: KBIndex):
+        """重新计算快照中条目的媒体地址（图片、视频文件可能在写快照之后更新）"""
+        media_by_subsection = {}
+        for _, doc in index.live_documents():
+            subsection = doc['payload'].get('subsection')
+            if subsection is None:
+                continue
+            key = id(subsection)
+            if key not in media_by_subsection:
+                media_by_subsection[key] = self._media_files(subsection)
+            doc['payload']['media_files'] = media_by_subsection[key]
+    
+    def save_snapshot(self, snapshot_path: Optional[str] = None, digest: Optional[bytes] = None) -> str:
+        """把当前解析结果和索引写入快照"""
+        snapshot_path = snapshot_path or self.snapshot_path
+        digest = digest or kb_snapshot.source_digest(*self._source_paths())
+        state = self._state
+        snapshot = {
+            'knowledge_data': state.knowledge_data,
+            'search_index': state.search_index,
+            'scorer': state.scorer,
+            'scorer_key': self._scorer_key(),
+            'passage_chars': Config.KB_PASSAGE_CHARS
+        }
+        try:
+            kb_snapshot.write_snapshot(snapshot_path, digest, snapshot)
+        except OSError as e:
+            print(f"⚠️ 写入知识库快照失败: {e}")
+        return snapshot_path
+    
+    def _parse_metadata(self, root, knowledge_data: Dict[str, Any]):
         """解析元数据信息"""
         metadata = root.find('metadata')
         if metadata is not None:
             company = metadata.find('company')
             if company is not None:
-                self.knowledge_data['company_info'] = {
+                knowledge_data['company_info'] = {
                     'name_cn': self._get_text(company, 'name_cn', '摩泛科技'),
                     'name_en': self._get_text(company, 'name_en', 'Mogine'),
                     'full_name_cn': self._get_text(company, 'full_name_cn'),
@@ -52,12 +380,12 @@ class MogineKBLoader:
             
             assistant = metadata.find('assistant')
             if assistant is not None:
-                self.knowledge_data['assistant_info'] = {
+                knowledge_data['assistant_info'] = {
                     'name': self._get_text(assistant, 'n', '小摩'),
                     'full_name': self._get_text(assistant, 'full_name', '摩泛AI小助手')
                 }
     
-    def _parse_content_structure(self, root):
+    def _parse_content_structure(self, root, knowledge_data: Dict[str, Any]):
         """解析内容结构"""
         content_structure = root.find('content_structure')
         if content_structure is not None:
@@ -75,7 +403,7 @@ class MogineKBLoader:
                     subsection_data = self._parse_subsection(subsection)
                     section_data['subsections'].append(subsection_data)
                 
-                self.knowledge_data[section_id] = section_data
+                knowledge_data[section_id] = section_data
     
     def _parse_subsection(self, subsection):
         """解析子章节"""
@@ -86,7 +414,9 @@ class MogineKBLoader:
             'page': subsection.get('page'),
             'content': [],
             'images': [],
-            'solution': []
+            'solution': [],
+            'keywords': [],
+            'keyword_weights': {}
         }
         
         # 解析文本内容
@@ -115,9 +445,29 @@ class MogineKBLoader:
                 }
                 subsection_data['images'].append(image_data)
         
+        # 解析检索关键词（可选 weight 属性指定加权分）
+        self._parse_keywords(subsection, subsection_data)
+        
         return subsection_data
     
-    def _parse_external_links(self, root):
+    def _parse_keywords(self, parent, entry_data: Dict[str, Any]):
+        """解析 <keywords> 下的关键词及可选的 weight 属性"""
+        keywords = parent.find('keywords')
+        if keywords is None:
+            return
+        for keyword in keywords.findall('keyword'):
+            if not keyword.text:
+                continue
+            text = keyword.text.strip()
+            entry_data['keywords'].append(text)
+            weight = keyword.get('weight')
+            if weight is not None:
+                try:
+                    entry_data['keyword_weights'][text] = float(weight)
+                except ValueError:
+                    print(f"⚠️ 关键词权重无效: {text}={weight}")
+    
+    def _parse_external_links(self, root, knowledge_data: Dict[str, Any]):
         """解析外部链接"""
         external_links = root.find('external_links')
         if external_links is not None:
@@ -128,116 +478,402 @@ class MogineKBLoader:
                     'title': self._get_text(link, 'title'),
                     'url': self._get_text(link, 'url'),
                     'description': self._get_text(link, 'description'),
-                    'keywords': []
+                    'keywords': [],
+                    'keyword_weights': {}
                 }
                 
-                keywords = link.find('keywords')
-                if keywords is not None:
-                    for keyword in keywords.findall('keyword'):
-                        if keyword.text:
-                            link_data['keywords'].append(keyword.text.strip())
+                self._parse_keywords(link, link_data)
                 
                 links_data.append(link_data)
             
-            self.knowledge_data['external_links'] = links_data
+            knowledge_data['external_links'] = links_data
     
     def _get_text(self, parent, tag, default=''):
         """安全获取XML元素文本"""
         element = parent.find(tag)
         return element.text.strip() if element is not None and element.text else default
     
+    def _iter_entries(self, knowledge_data: Dict[str, Any]):
+        """遍历可检索条目，产出 (条目标识, 类型, 分字段文本, 原始数据)"""
+        for section_id, section_data in knowledge_data.items():
+            if section_id in ['company_info', 'assistant_info', 'external_links']:
+                continue
+            
+            section_title = section_data.get('title', '')
+            
+            for subsection in section_data.get('subsections', []):
+                content_text = ' '.join(subsection.get('content', []))
+                solution_text = ' '.join(subsection.get('solution', []))
+                # 没有正文的子章节不会出现在结果中，无需索引
+                if not (content_text or solution_text):
+                    continue
+                
+                key = f"content:{subsection.get('id') or section_id + '/' + (subsection.get('title') or '')}"
+                yield from self._content_entries(key, section_title, subsection, content_text, solution_text)
+        
+        for link in knowledge_data.get('external_links', []):
+            fields = {
+                'title': link.get('title', ''),
+                'body': f"{link.get('description', '')} {' '.join(link.get('keywords', []))}"
+            }
+            yield f"external_link:{link.get('id') or link.get('title', '')}", 'external_link', fields, {'link': link}
+    
+    def _content_entries(self, key: str, section_title: str, subsection: Dict[str, Any],
+                         content_text: str, solution_text: str):
+        """
+        产出子章节的可检索条目
+        
+        正文不超过 KB_PASSAGE_CHARS 时整个子章节作为一个条目；
+        否则 content / solution 分别按句子切分为段落，每个段落是一个条目（key#序号）
+        """
+        payload = {
+            'section_title': section_title,
+            'subsection': subsection,
+            'content_text': content_text,
+            'solution_text': solution_text,
+            # 媒体地址需要读取文件状态，建索引时算好，检索时直接使用
+            'media_files': self._media_files(subsection)
+        }
+        title = subsection.get('title', '')
+        max_chars = Config.KB_PASSAGE_CHARS
+        if max_chars <= 0 or len(content_text) + len(solution_text) <= max_chars:
+            yield key, 'content', {'title': title, 'body': f"{content_text} {solution_text}"}, payload
+            return
+        
+        seq = 0
+        for field, text in (('content', content_text), ('solution', solution_text)):
+            for start, end in split_passages(text, max_chars):
+                passage = {
+                    'id': f"{subsection.get('id') or key.split(':', 1)[1]}#{seq}",
+                    'parent': key,
+                    'field': field,
+                    'seq': seq,
+                    'start': start,
+                    'end': end
+                }
+                yield f"{key}#{seq}", 'content', {'title': title, 'body': text[start:end]}, {**payload, 'passage': passage}
+                seq += 1
+    
+    def _build_search_index(self, knowledge_data: Dict[str, Any]) -> KBIndex:
+        """构建倒排索引，检索时只对候选条目打分"""
+        index = KBIndex()
+        for key, doc_type, fields, payload in self._iter_entries(knowledge_data):
+            index.add_document(doc_type, fields, payload, key=key)
+        return index
+    
+    def _create_boost(self, index: KBIndex) -> BoostIndex:
+        """编译关键词加权自动机（配置文件中的加权词 + XML中声明的关键词）"""
+        try:
+            global_terms = load_boost_terms(self.boost_terms_path)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 读取加权词配置失败: {e}")
+            global_terms = {}
+        return BoostIndex(index, global_terms, Config.KB_KEYWORD_BOOST)
+    
+    def _create_scorer(self, index: KBIndex):
+        """按配置创建打分器（legacy / bm25）"""
+        if self.scorer_name == 'bm25':
+            return create_scorer('bm25', index,
+                                 k1=Config.KB_BM25_K1,
+                                 b=Config.KB_BM25_B,
+                                 min_score=Config.KB_BM25_MIN_SCORE)
+        return create_scorer(self.scorer_name, index)
+    
+    def _build_segment(self, index: KBIndex) -> Segment:
+        """为运行时分段创建打分器和关键词加权"""
+        return Segment(index, self._create_scorer(index), self._create_boost(index))
+    
+    def _custom_entries(self, doc_id: str, content: str, metadata: Optional[Dict[str, Any]] = None):
+        """把CMS文档转换为可检索条目 (条目标识, 类型, 分字段文本, 原始数据)，长文档切分为段落"""
+        metadata = metadata or {}
+        # 向量库的元数据只能是标量，关键词用逗号分隔
+        keywords = [k.strip() for k in str(metadata.get('keywords', '')).split(',') if k.strip()]
+        subsection = {
+            'id': doc_id,
+            'title': metadata.get('title', ''),
+            'content': [content],
+            'images': [],
+            'solution': [],
+            'keywords': keywords,
+            'keyword_weights': {}
+        }
+        return self._content_entries(f"custom:{doc_id}", metadata.get('section', '自定义内容'),
+                                     subsection, content, '')
+    
+    def upsert_custom_documents(self, documents: List[Dict[str, Any]]):
+        """
+        运行时新增或更新条目
+        
+        Args:
+            documents: [{'id', 'content', 'metadata'}]
+        """
+        self.custom_segments.upsert([
+            (f"custom:{document['id']}",
+             list(self._custom_entries(document['id'], document['content'], document.get('metadata'))))
+            for document in documents
+        ])
+        self.custom_segments.start_compactor(Config.KB_COMPACT_INTERVAL)
+    
+    def delete_custom_document(self, doc_id: str) -> bool:
+        """运行时删除条目，条目不存在时返回 False"""
+        return self.custom_segments.delete(f"custom:{doc_id}")
+    
     def search_knowledge(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        """搜索知识库"""
+        """搜索知识库（结果按 归一化查询 + top_k + 知识库版本 + 运行时分段版本 缓存）"""
+        # 整个查询只读取一次状态引用，重新加载或运行时写入不会影响进行中的查询
+        state = self._state
+        segments = self.custom_segments.snapshot()
+        normalized_query = normalize_query(query)
+        
+        if not self.query_cache.enabled:
+            return self.search_state(state, segments, normalized_query, top_k)
+        
+        cache_key = (state.version, segments.generation, normalized_query, top_k)
+        results = self.query_cache.get(cache_key)
+        if results is None:
+            results = self.search_state(state, segments, normalized_query, top_k)
+            self.query_cache.put(cache_key, results)
+        # 结果字典在缓存命中之间共享，调用方不应修改
+        return list(results)
+    
+    def search_state(self, state: KBState, segments: SegmentSet,
+                     query: str, top_k: int) -> List[Dict[str, Any]]:
+        """在给定的状态和运行时分段快照上检索（query 需已归一化，不读写查询缓存）"""
+        results = self._search_knowledge(state, query, top_k)
+        return self.merge_custom_results(results, segments, query, top_k)
+    
+    def merge_custom_results(self, results: List[Dict[str, Any]], segments: SegmentSet,
+                             query: str, top_k: int) -> List[Dict[str, Any]]:
+        """把运行时分段的检索结果并入XML知识库的结果"""
+        if not segments.segments:
+            return results
+        hits = segments.search(query.lower(), top_k)
+        if not hits:
+            return results
+        merged = results + self._build_results(hits)
+        merged.sort(key=lambda x: x['relevance_score'], reverse=True)
+        return merged[:top_k]
+    
+    def iter_search(self, query: str, top_k: int = 3) -> Iterator[Dict[str, Any]]:
+        """
+        流式检索：排名确定后逐条构建并产出结果
+        
+        排名阶段只保留 (得分, 构建函数)，媒体元数据等完整结果在产出时才构建，
+        调用方可以边构建边发送；结果与 search_knowledge 相同，但不写入查询缓存
+        """
+        state = self._state
+        segments = self.custom_segments.snapshot()
+        normalized_query = normalize_query(query)
+        
+        if self.query_cache.enabled:
+            cached = self.query_cache.get((state.version, segments.generation, normalized_query, top_k))
+            if cached is not None:
+                yield from cached
+                return
+        
+        ranked = self._rank(state, normalized_query, top_k)
+        if segments.segments:
+            hits = segments.search(normalized_query.lower(), top_k)
+            if hits:
+                ranked = ranked + self._ranked_results(hits)
+                ranked.sort(key=lambda item: item[0], reverse=True)
+                ranked = ranked[:top_k]
+        for _, build in ranked:
+            yield build()
+    
+    def cache_stats(self) -> Dict[str, Any]:
+        """查询缓存统计（命中/未命中次数等）"""
+        return {**self.query_cache.stats(), 'version': self.version}
+    
+    def _search_knowledge(self, state: KBState, query: str, top_k: int) -> List[Dict[str, Any]]:
+        """在给定状态上执行检索打分"""
+        return [build() for _, build in self._rank(state, query, top_k)]
+    
+    def _rank(self, state: KBState, query: str, top_k: int) -> List[Tuple[float, Callable[[], Dict[str, Any]]]]:
+        """检索打分并排名，返回 [(得分, 结果构建函数)]，按得分降序，最多 top_k 个"""
         query_lower = query.lower()
-        results = []
+        
+        # 关键词加权：查询只扫描一遍自动机
+        boosts = state.boost.boosts(query_lower) if state.boost is not None else {}
+        
+        # 有界堆只保留前top_k个条目，上界达不到当前第top_k名的条目直接跳过
+        documents = state.search_index.documents
+        hits = [(relevance, documents[doc_idx])
+                for relevance, doc_idx in state.scorer.top_k(query_lower, top_k, boosts)]
+        return self._rank_hits(state, query_lower, hits, top_k)
+    
+    def _rank_hits(self, state: KBState, query_lower: str, hits: List[tuple],
+                   top_k: int) -> List[Tuple[float, Callable[[], Dict[str, Any]]]]:
+        """把打分器给出的 [(得分, 文档)] 与公司信息一起排名，按配置合并相邻段落"""
+        ranked = []
         
         # 搜索公司信息
         if any(keyword in query_lower for keyword in ['公司', '摩泛', 'mogine', '介绍', '关于', '什么']):
-            company_info = self.knowledge_data.get('company_info', {})
+            company_info = state.knowledge_data.get('company_info', {})
             if company_info:
-                results.append({
+                ranked.append((0.9, partial(dict, {
                     'type': 'company_info',
                     'title': '公司信息',
                     'content': f"{company_info.get('full_name_cn', '')} ({company_info.get('name_en', '')}) - {company_info.get('description', '')}",
                     'relevance_score': 0.9,
                     'source': '公司基本信息'
-                })
+                })))
         
-        # 搜索具体内容 - 改进搜索逻辑
-        for section_id, section_data in self.knowledge_data.items():
-            if section_id in ['company_info', 'assistant_info', 'external_links']:
-                continue
-            
-            section_title = section_data.get('title', '')
-            
-            # 遍历所有子章节
-            for subsection in section_data.get('subsections', []):
-                subsection_title = subsection.get('title', '')
-                content_text = ' '.join(subsection.get('content', []))
-                solution_text = ' '.join(subsection.get('solution', []))
-                full_text = f"{subsection_title} {content_text} {solution_text}"
-                
-                # 计算相关性
-                relevance = self._calculate_relevance(query_lower, full_text.lower())
-                
-                # 特定关键词匹配加分
-                keyword_bonus = 0
-                if '数字孪生' in query_lower and '数字孪生' in full_text.lower():
-                    keyword_bonus += 0.3
-                if 'mohuman' in query_lower.replace(' ', '') and 'mohuman' in full_text.lower():
-                    keyword_bonus += 0.3
-                if 'mobox' in query_lower.replace(' ', '') and 'mobox' in full_text.lower():
-                    keyword_bonus += 0.3
-                if '钱学森' in query_lower and '钱学森' in full_text.lower():
-                    keyword_bonus += 0.4
-                if 'usd' in query_lower and 'usd' in full_text.lower():
-                    keyword_bonus += 0.3
-                if '3d' in query_lower and '3d' in full_text.lower():
-                    keyword_bonus += 0.2
-                if '协作' in query_lower and '协作' in full_text.lower():
-                    keyword_bonus += 0.2
-                
-                final_relevance = relevance + keyword_bonus
-                
-                if final_relevance > 0.15 and (content_text or solution_text):
-                    # 获取相关的图片和视频
-                    media_files = []
-                    for image in subsection.get('images', []):
-                        media_files.append({
-                            'type': 'image' if not image.get('path', '').endswith('.mp4') else 'video',
-                            'path': image.get('path', ''),
-                            'caption': image.get('caption', ''),
-                            'full_path': f"/Users/kangkai/Desktop/AI Projects/academic_agent/sales-agent/kb/{image.get('path', '')}"
-                        })
-                    
-                    results.append({
-                        'type': 'content',
-                        'title': subsection_title,
-                        'content': content_text,
-                        'solution': solution_text,
-                        'media_files': media_files,
-                        'relevance_score': final_relevance,
-                        'source': f"{section_title} - {subsection_title}"
-                    })
-        
-        # 搜索外部链接
-        external_links = self.knowledge_data.get('external_links', [])
-        for link in external_links:
-            link_text = f"{link.get('title', '')} {link.get('description', '')} {' '.join(link.get('keywords', []))}"
-            relevance = self._calculate_relevance(query_lower, link_text.lower())
-            if relevance > 0.2:
-                results.append({
-                    'type': 'external_link',
-                    'title': link.get('title', ''),
-                    'content': link.get('description', ''),
-                    'url': link.get('url', ''),
-                    'relevance_score': relevance,
-                    'source': '外部链接'
-                })
+        ranked.extend(self._ranked_results(hits))
         
         # 按相关性排序并返回前top_k个结果
-        results.sort(key=lambda x: x['relevance_score'], reverse=True)
-        return results[:top_k]
+        ranked.sort(key=lambda item: item[0], reverse=True)
+        return ranked[:top_k]
+    
+    def search_many(self, queries: List[str], top_k: int = 3) -> List[List[Dict[str, Any]]]:
+        """
+        批量搜索知识库
+        
+        所有查询在同一个TF-IDF稀疏矩阵上一次性打分（余弦相似度），
+        适合离线重放大量历史问题；在线单条查询请使用 search_knowledge。
+        打分之后的步骤与 search_knowledge 相同：公司信息、相邻段落合并、运行时分段
+        
+        Args:
+            queries: 查询列表
+            top_k: 每个查询返回的结果数
+            
+        Returns:
+            与 queries 一一对应的结果列表
+        """
+        if not kb_batch.is_available():
+            print("⚠️ 未安装numpy/scipy，批量搜索退化为逐条查询")
+            return [self.search_knowledge(query, top_k) for query in queries]
+        
+        # 整批查询使用同一个状态和运行时分段快照
+        state = self._state
+        segments = self.custom_segments.snapshot()
+        
+        # 矩阵在首次批量查询时构建，索引重建后自动失效
+        index = state.search_index
+        matrix = self._tfidf_matrix
+        if matrix is None or matrix.index is not index:
+            matrix = kb_batch.TfidfMatrix(index)
+            self._tfidf_matrix = matrix
+        
+        normalized_queries = [normalize_query(query) for query in queries]
+        results = []
+        for query, doc_hits in zip(normalized_queries, matrix.top_k(normalized_queries, top_k)):
+            hits = [(score, index.documents[doc_idx]) for doc_idx, score in doc_hits]
+            ranked = self._rank_hits(state, query.lower(), hits, top_k)
+            results.append(self.merge_custom_results([build() for _, build in ranked],
+                                                     segments, query, top_k))
+        return results
+    
+    def search_batch(self, requests: List[Dict[str, Any]], mode: str = 'exact') -> List[List[Dict[str, Any]]]:
+        """
+        一次执行多条带各自 top_k 和过滤条件的查询
+        
+        相同的（归一化查询, 取回数）只检索一次；带过滤条件的查询多取回一些候选再过滤。
+        
+        Args:
+            requests: [{'q': 查询, 'top_k': 结果数, 'filters': 过滤条件}]，过滤条件见 filter_results
+            mode: exact —— 与 search_knowledge 相同的打分（经过查询缓存）；
+                  tfidf —— 全部查询在TF-IDF矩阵上一次性打分（search_many，适合离线大批量）
+        
+        Returns:
+            与 requests 一一对应的结果列表
+        """
+        if mode not in BATCH_MODES:
+            raise ValueError(f"未知的批量检索模式: {mode}，可选: {', '.join(BATCH_MODES)}")
+        
+        fetches = []
+        for request in requests:
+            top_k = request['top_k']
+            if request.get('filters'):
+                top_k = min(top_k * BATCH_FILTER_OVERFETCH, BATCH_MAX_FETCH)
+            fetches.append((normalize_query(request['q']), top_k))
+        unique = list(dict.fromkeys(fetches))
+        
+        if mode == 'tfidf':
+            # 矩阵打分按最大取回数一次完成，再按各自的取回数截断
+            max_k = max((top_k for _, top_k in unique), default=0)
+            ranked = self.search_many([query for query, _ in unique], max_k)
+            fetched = {key: results[:key[1]] for key, results in zip(unique, ranked)}
+        else:
+            fetched = {key: self.search_knowledge(*key) for key in unique}
+        
+        return [
+            filter_results(fetched[key], request.get('filters'))[:request['top_k']]
+            for key, request in zip(fetches, requests)
+        ]
+    
+    def _build_results(self, hits: List[tuple]) -> List[Dict[str, Any]]:
+        """把 [(得分, 文档)] 转换为搜索结果，按配置合并相邻段落"""
+        return [build() for _, build in self._ranked_results(hits)]
+    
+    def _ranked_results(self, hits: List[tuple]) -> List[Tuple[float, Callable[[], Dict[str, Any]]]]:
+        """把 [(得分, 文档)] 转换为 [(得分, 结果构建函数)]，按配置合并相邻段落"""
+        if not Config.KB_PASSAGE_MERGE:
+            return [(relevance, partial(self._build_result, doc, relevance)) for relevance, doc in hits]
+        return [(relevance, partial(self._build_result, doc, relevance, passage))
+                for relevance, doc, passage in merge_adjacent(hits)]
+    
+    def _build_result(self, doc: Dict[str, Any], relevance: float,
+                      passage: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """根据索引文档构建搜索结果（段落条目只返回段落文本）"""
+        payload = doc['payload']
+        
+        if doc['type'] == 'external_link':
+            link = payload['link']
+            return {
+                'type': 'external_link',
+                'title': link.get('title', ''),
+                'content': link.get('description', ''),
+                'url': link.get('url', ''),
+                'relevance_score': relevance,
+                'source': '外部链接'
+            }
+        
+        subsection = payload['subsection']
+        subsection_title = subsection.get('title', '')
+        
+        result = {
+            'type': 'content',
+            'title': subsection_title,
+            'content': payload['content_text'],
+            'solution': payload['solution_text'],
+            # 建索引时已算好（结果之间共享，调用方不应修改）
+            'media_files': payload['media_files'],
+            'relevance_score': relevance,
+            'source': f"{payload['section_title']} - {subsection_title}"
+        }
+        
+        passage = passage or payload.get('passage')
+        if passage is not None:
+            text = passage_text(payload, passage)
+            result['content'] = text if passage['field'] == 'content' else ''
+            result['solution'] = text if passage['field'] == 'solution' else ''
+            result['passage'] = {
+                'id': passage['id'],
+                'ids': passage.get('ids', [passage['id']]),
+                'field': passage['field'],
+                'start': passage['start'],
+                'end': passage['end']
+            }
+        return result
+    
+    def _media_files(self, subsection: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """子章节的图片和视频（含文件服务器上的派生版本地址）"""
+        media_files = []
+        for image in subsection.get('images', []):
+            media_files.append({
+                'type': 'image' if not image.get('path', '').endswith('.mp4') else 'video',
+                'path': image.get('path', ''),
+                'caption': image.get('caption', ''),
+                'full_path': f"/Users/kangkai/Desktop/AI Projects/academic_agent/sales-agent/kb/{image.get('path', '')}",
+                # 文件服务器上的派生版本地址（按宽度缩放，按 Accept 返回 WebP/AVIF）
+                **media_urls(image.get('path', ''))
+            })
+            # 视频已离线切分为HLS分段时附上播放列表地址
+            playlist_url = hls_url(image.get('path', ''))
+            if playlist_url:
+                media_files[-1]['hls_url'] = playlist_url
+        return media_files
     
     def _text_similarity(self, text1: str, text2: str) -> float:
         """简单的文本相似度计算"""
@@ -253,39 +889,14 @@ class MogineKBLoader:
         return len(intersection) / len(union) if union else 0.0
     
     def _calculate_relevance(self, query: str, text: str) -> float:
-        """计算查询与文本的相关性"""
-        if not query or not text:
-            return 0.0
-        
-        # 中文分词简化处理
-        query_chars = set(query.replace(' ', ''))
-        text_chars = set(text.replace(' ', ''))
-        
-        # 字符级匹配
-        char_matches = query_chars.intersection(text_chars)
-        char_coverage = len(char_matches) / len(query_chars) if query_chars else 0
-        
-        # 词级匹配
-        query_words = set(re.findall(r'\w+', query))
-        text_words = set(re.findall(r'\w+', text))
-        word_matches = query_words.intersection(text_words)
-        word_coverage = len(word_matches) / len(query_words) if query_words else 0
-        
-        # 子串匹配
-        substring_score = 0
-        for i in range(2, min(len(query) + 1, 6)):  # 检查2-5字符的子串
-            for j in range(len(query) - i + 1):
-                substring = query[j:j+i]
-                if substring in text:
-                    substring_score += len(substring) / len(query)
-        
-        # 综合评分
-        final_score = (char_coverage * 0.3 + word_coverage * 0.4 + substring_score * 0.3)
-        
-        # 考虑文本长度的影响
-        length_factor = min(1.0, len(text) / 50)
-        
-        return final_score * 0.9 + length_factor * 0.1
+        """计算查询与文本的相关性（原有打分规则）"""
+        doc = {
+            'text': text,
+            'chars': set(text.replace(' ', '')),
+            'words': set(re.findall(r'\w+', text))
+        }
+        scorer = LegacyScorer(self.search_index)
+        return scorer.score_document(scorer.query_features(query), doc)
     
     def get_company_info(self) -> Dict[str, Any]:
         """获取公司基本信息"""
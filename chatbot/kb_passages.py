@@ -0,0 +1,120 @@
+"""
+长条目分段（passage）
+正文超过长度上限的子章节按句子切分成若干段落，每个段落单独建索引、单独打分，
+检索结果和送入大模型的上下文只包含命中的段落，而不是整个子章节。
+
+段落编号为 "<子章节id>#<序号>"，并记录在所属字段（content / solution）全文中的起止偏移，
+同一子章节中相邻的命中段落可以按偏移合并成一段连续文本
+"""
+
+import re
+from typing import Dict, List, Any, Optional, Tuple
+
+# 句子边界：中英文句末标点、分号和换行
+SENTENCE_PATTERN = re.compile(r'[^。！？!?；;\n]*[。！？!?；;\n]+|[^。！？!?；;\n]+')
+
+
+def split_passages(text: str, max_chars: int) -> List[Tuple[int, int]]:
+    """
+    把文本按句子切分并打包成长度不超过 max_chars 的段落
+
+    Returns:
+        [(起始偏移, 结束偏移)]，首尾空白不计入段落
+    """
+    sentences = []
+    for match in SENTENCE_PATTERN.finditer(text):
+        start, end = match.span()
+        # 超长的单句直接按长度硬切
+        while end - start > max_chars:
+            sentences.append((start, start + max_chars))
+            start += max_chars
+        sentences.append((start, end))
+
+    passages = []
+    current = None
+    for start, end in sentences:
+        if current is not None and end - current[0] <= max_chars:
+            current = (current[0], end)
+            continue
+        if current is not None:
+            passages.append(current)
+        current = (start, end)
+    if current is not None:
+        passages.append(current)
+
+    # 去掉段落首尾空白，空段落丢弃
+    trimmed = []
+    for start, end in passages:
+        while start < end and text[start].isspace():
+            start += 1
+        while end > start and text[end - 1].isspace():
+            end -= 1
+        if start < end:
+            trimmed.append((start, end))
+    return trimmed
+
+
+def passage_text(payload: Dict[str, Any], passage: Dict[str, Any]) -> str:
+    """根据偏移从所属字段全文中取出段落文本"""
+    source = payload['content_text'] if passage['field'] == 'content' else payload['solution_text']
+    return source[passage['start']:passage['end']]
+
+
+def merge_adjacent(hits: List[Tuple[float, Dict[str, Any]]]) -> List[Tuple[float, Dict[str, Any], Optional[Dict[str, Any]]]]:
+    """
+    合并同一子章节、同一字段中序号相邻的命中段落
+
+    Args:
+        hits: [(得分, 文档)]，按得分降序
+
+    Returns:
+        [(得分, 文档, 合并后的段落信息)]，合并后的得分取最高者，顺序仍按得分降序；
+        非段落文档的段落信息为 None
+    """
+    groups: Dict[Tuple[str, str], List[Tuple[float, Dict[str, Any]]]] = {}
+    order = []
+    for score, doc in hits:
+        passage = doc['payload'].get('passage')
+        if passage is None:
+            order.append((score, doc, None))
+            continue
+        group_key = (passage['parent'], passage['field'])
+        if group_key not in groups:
+            groups[group_key] = []
+            order.append((score, doc, group_key))
+        groups[group_key].append((score, doc))
+
+    merged = []
+    for score, doc, group_key in order:
+        if group_key is None:
+            merged.append((score, doc, None))
+            continue
+
+        members = sorted(groups[group_key], key=lambda hit: hit[1]['payload']['passage']['seq'])
+        run = [members[0]]
+        for hit in members[1:]:
+            if hit[1]['payload']['passage']['seq'] == run[-1][1]['payload']['passage']['seq'] + 1:
+                run.append(hit)
+            else:
+                merged.append(_merge_run(run))
+                run = [hit]
+        merged.append(_merge_run(run))
+
+    merged.sort(key=lambda item: item[0], reverse=True)
+    return merged
+
+
+def _merge_run(run: List[Tuple[float, Dict[str, Any]]]) -> Tuple[float, Dict[str, Any], Dict[str, Any]]:
+    first = run[0][1]['payload']['passage']
+    last = run[-1][1]['payload']['passage']
+    best_score, best_doc = max(run, key=lambda hit: hit[0])
+    passage = {
+        'id': first['id'],
+        'parent': first['parent'],
+        'ids': [doc['payload']['passage']['id'] for _, doc in run],
+        'field': first['field'],
+        'seq': first['seq'],
+        'start': first['start'],
+        'end': last['end']
+    }
+    return best_score, best_doc, passage
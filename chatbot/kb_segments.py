@@ -0,0 +1,218 @@
+"""
+知识库运行时可变存储（分段 + 墓碑 + 后台合并）
+XML知识库之外，CMS在运行时新增、修改、删除的条目写入这里：
+
+- 新增/修改：写入当前活跃的小分段，只重建这个分段的打分器，代价与分段大小成正比
+- 删除：在所在分段留下墓碑（文档空位），不重建打分器
+- 后台合并：分段数或墓碑数超过阈值时，把所有分段合并为一个
+
+每次写入都生成新的分段集合并整体替换引用，检索读取一次引用即可，全程无锁；
+XML知识库的索引和 MogineKBLoader 不需要重新加载
+"""
+
+import copy
+import threading
+from typing import Callable, Dict, List, Any, Tuple
+
+from .kb_index import KBIndex, TopKHeap
+
+
+class Segment:
+    """一个分段：倒排索引 + 打分器 + 关键词加权（构建后不再修改）"""
+
+    __slots__ = ('index', 'scorer', 'boost')
+
+    def __init__(self, index: KBIndex, scorer, boost):
+        self.index = index
+        self.scorer = scorer
+        self.boost = boost
+
+    def without(self, doc_ids: List[int]) -> 'Segment':
+        """返回删除了指定文档的新分段（留下墓碑，打分器和加权表沿用）"""
+        index = self.index.copy()
+        for doc_idx in doc_ids:
+            index.remove_document(doc_idx)
+        # 打分统计沿用旧值；打分器通过 index 读取文档，墓碑文档自然被跳过
+        scorer = copy.copy(self.scorer)
+        scorer.index = index
+        return Segment(index, scorer, self.boost)
+
+
+class SegmentSet:
+    """某一时刻的分段集合（不可变）"""
+
+    __slots__ = ('segments', 'generation')
+
+    def __init__(self, segments: Tuple[Segment, ...] = (), generation: int = 0):
+        self.segments = segments
+        self.generation = generation
+
+    def __len__(self) -> int:
+        return sum(len(segment.index) for segment in self.segments)
+
+    @property
+    def tombstone_count(self) -> int:
+        return sum(segment.index.tombstone_count for segment in self.segments)
+
+    def search(self, query_lower: str, top_k: int) -> List[Tuple[float, Dict[str, Any]]]:
+        """在所有分段中检索，返回 [(得分, 文档)]，按得分降序"""
+        heap = TopKHeap(top_k)
+        hits = []
+        for segment in self.segments:
+            boosts = segment.boost.boosts(query_lower)
+            for score, doc_idx in segment.scorer.top_k(query_lower, top_k, boosts):
+                heap.push(score, len(hits))
+                hits.append(segment.index.documents[doc_idx])
+        return [(score, hits[position]) for score, position in heap.results()]
+
+
+class SegmentStore:
+    """分段式可变存储"""
+
+    def __init__(self, build_segment: Callable[[KBIndex], Segment],
+                 max_segment_docs: int = 32, max_segments: int = 4):
+        """
+        Args:
+            build_segment: 根据索引构建分段（创建打分器和关键词加权）
+            max_segment_docs: 活跃分段的文档数上限，超过后新开一个分段
+            max_segments: 分段数超过该值（或墓碑多于存活文档）时触发合并
+        """
+        self.build_segment = build_segment
+        self.max_segment_docs = max_segment_docs
+        self.max_segments = max_segments
+
+        self._current = SegmentSet()
+        self._write_lock = threading.Lock()
+        self._compactor_thread = None
+        self._compactor_stop = threading.Event()
+        self._compact_requested = threading.Event()
+
+    def snapshot(self) -> SegmentSet:
+        """当前分段集合（单次引用读取，无锁）"""
+        return self._current
+
+    def upsert(self, documents: List[Tuple[str, List[Tuple[str, str, Dict[str, str], Dict[str, Any]]]]]):
+        """
+        新增或替换文档
+
+        Args:
+            documents: [(文档标识, [(条目标识, 类型, 分字段文本, 原始数据)])]，
+                一个文档可以切分为多个条目（段落），替换时旧条目整体删除
+        """
+        if not documents:
+            return
+        with self._write_lock:
+            segments = list(self._current.segments)
+            for key, _ in documents:
+                self._tombstone(segments, key)
+
+            if segments and len(segments[-1].index) < self.max_segment_docs:
+                index = segments.pop().index.copy()
+            else:
+                index = KBIndex()
+            for _, entries in documents:
+                for key, doc_type, fields, payload in entries:
+                    index.add_document(doc_type, fields, payload, key=key)
+            segments.append(self.build_segment(index))
+
+            self._publish(segments)
+
+    def delete(self, key: str) -> bool:
+        """删除文档的全部条目（留下墓碑），文档不存在时返回 False"""
+        with self._write_lock:
+            segments = list(self._current.segments)
+            if not self._tombstone(segments, key):
+                return False
+            self._publish(segments)
+            return True
+
+    def _tombstone(self, segments: List[Segment], key: str) -> bool:
+        """删除文档标识为 key 的条目及其段落（key#序号）"""
+        found = False
+        prefix = key + '#'
+        for position, segment in enumerate(segments):
+            doc_ids = [doc_idx for doc_key, doc_idx in segment.index.doc_keys.items()
+                       if doc_key == key or doc_key.startswith(prefix)]
+            if doc_ids:
+                segments[position] = segment.without(doc_ids)
+                found = True
+        return found
+
+    def _publish(self, segments: List[Segment]):
+        """原子替换分段集合（调用方持有写锁）"""
+        segments = [segment for segment in segments if len(segment.index)]
+        self._current = SegmentSet(tuple(segments), self._current.generation + 1)
+        if self.needs_compaction():
+            self._compact_requested.set()
+
+    def needs_compaction(self) -> bool:
+        current = self._current
+        return len(current.segments) > self.max_segments or current.tombstone_count > len(current)
+
+    def compact(self) -> bool:
+        """
+        把所有分段合并为一个
+
+        合并在写锁之外进行；替换前如果参与合并的分段已被写入修改，放弃本次合并，等下次再试。
+        合并期间新追加的分段保留在合并结果之后。
+
+        Returns:
+            是否完成了合并
+        """
+        merging = self._current.segments
+        if len(merging) <= 1 and not any(segment.index.tombstone_count for segment in merging):
+            return False
+
+        index = KBIndex()
+        for segment in merging:
+            for _, doc in segment.index.live_documents():
+                index.add_document(doc['type'], doc['fields'], doc['payload'], key=doc['key'])
+        merged = self.build_segment(index)
+
+        with self._write_lock:
+            current = self._current.segments
+            # 合并前的分段原样保留在前面（被修改过的分段是新对象）才能替换
+            if len(current) < len(merging) or any(a is not b for a, b in zip(current, merging)):
+                return False
+            self._current = SegmentSet((merged,) + current[len(merging):], self._current.generation + 1)
+
+        print(f"🗜️ 运行时知识库分段已合并: {len(merging)} 个分段 -> 1 个，共 {len(index)} 个条目")
+        return True
+
+    def start_compactor(self, interval: float = 30.0):
+        """启动后台合并线程：写入触发或每隔 interval 秒检查一次"""
+        if self._compactor_thread is not None:
+            return
+        self._compactor_stop.clear()
+        self._compactor_thread = threading.Thread(
+            target=self._compact_loop, args=(interval,), name='kb-compactor', daemon=True
+        )
+        self._compactor_thread.start()
+
+    def stop_compactor(self):
+        self._compactor_stop.set()
+        self._compact_requested.set()
+        if self._compactor_thread is not None:
+            self._compactor_thread.join()
+            self._compactor_thread = None
+
+    def _compact_loop(self, interval: float):
+        while not self._compactor_stop.is_set():
+            self._compact_requested.wait(interval)
+            self._compact_requested.clear()
+            if self._compactor_stop.is_set():
+                break
+            try:
+                if self.needs_compaction():
+                    self.compact()
+            except Exception as e:
+                print(f"⚠️ 运行时知识库分段合并失败: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        current = self._current
+        return {
+            'segments': len(current.segments),
+            'documents': len(current),
+            'tombstones': current.tombstone_count,
+            'generation': current.generation
+        }
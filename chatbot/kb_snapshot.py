@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+知识库编译快照
+把XML解析结果和预构建的检索索引序列化为二进制快照，
+各服务启动时通过mmap读取快照，无需重复解析XML、重建索引。
+
+快照头部记录源文件（XML及加权词配置）的SHA-256，源文件变化后快照自动失效。
+
+用法:
+    python -m chatbot.kb_snapshot [kb_path] [snapshot_path]
+"""
+
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+from typing import Dict, Any, Optional
+
+# 魔数 + 格式版本 + 源文件SHA-256
+SNAPSHOT_MAGIC = b'MGKBSNAP'
+SNAPSHOT_FORMAT_VERSION = 4
+HEADER_STRUCT = struct.Struct('<8sI32s')
+
+
+def source_digest(*paths: str) -> bytes:
+    """计算源文件（XML及加权词配置等）的内容摘要，不存在的文件跳过"""
+    sha256 = hashlib.sha256()
+    for path in paths:
+        if not path or not os.path.exists(path):
+            continue
+        sha256.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha256.update(block)
+    return sha256.digest()
+
+
+def default_snapshot_path(kb_path: str) -> str:
+    """默认快照路径：与XML同目录、同名，扩展名为 .kbsnap"""
+    return os.path.splitext(kb_path)[0] + '.kbsnap'
+
+
+def write_snapshot(snapshot_path: str, digest: bytes, state: Dict[str, Any]):
+    """原子写入快照（先写临时文件再替换，读取方不会看到半成品）"""
+    directory = os.path.dirname(os.path.abspath(snapshot_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER_STRUCT.pack(SNAPSHOT_MAGIC, SNAPSHOT_FORMAT_VERSION, digest))
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, snapshot_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def read_snapshot(snapshot_path: str, digest: bytes) -> Optional[Dict[str, Any]]:
+    """
+    通过mmap读取快照
+
+    Returns:
+        快照内容；快照不存在、格式不符或已过期时返回 None
+    """
+    if not os.path.exists(snapshot_path):
+        return None
+
+    with open(snapshot_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if len(mm) < HEADER_STRUCT.size:
+                return None
+
+            magic, version, snapshot_digest = HEADER_STRUCT.unpack_from(mm, 0)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_FORMAT_VERSION:
+                return None
+            if snapshot_digest != digest:
+                return None
+
+            # 直接在映射的页面上反序列化，不额外复制文件内容
+            view = memoryview(mm)[HEADER_STRUCT.size:]
+            try:
+                return pickle.loads(view)
+            finally:
+                view.release()
+
+
+def compile_snapshot(kb_path: str, snapshot_path: Optional[str] = None) -> str:
+    """解析XML、构建索引并写出快照，返回快照路径"""
+    from .kb_loader import MogineKBLoader
+
+    loader = MogineKBLoader(kb_path, use_snapshot=False)
+    return loader.save_snapshot(snapshot_path)
+
+
+if __name__ == "__main__":
+    kb_path = sys.argv[1] if len(sys.argv) > 1 else "kb/mogine_unified_kb_fixed.xml"
+    snapshot_path = sys.argv[2] if len(sys.argv) > 2 else None
+    output_path = compile_snapshot(kb_path, snapshot_path)
+    print(f"✅ 知识库快照已生成: {output_path}")
@@ -0,0 +1,220 @@
+"""
+输入联想（type-ahead）
+候选词来自知识库：子章节标题、外部链接标题和关键词、子章节关键词、加权词（产品名等）。
+
+候选词的每个"起始位置"（整词开头、英文单词开头、每个中文字符）各生成一个键，
+所有键排序后存成数组，前缀查询用二分查找定位区间；
+短前缀（区间可能很大）的结果在构建时预先算好，查询只需一次字典查找。
+
+候选词按 query_logs.db 中包含该词的历史查询次数加权，热门的排在前面
+"""
+
+import bisect
+import heapq
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Any, Optional, Tuple
+
+from .kb_boost import AhoCorasick, compact_term, read_boost_terms
+from .kb_cache import normalize_query
+
+# 预先计算结果的前缀长度上限（字符数）
+PRECOMPUTED_PREFIX_CHARS = 2
+
+# 每个前缀预先保留的候选数（不小于接口允许的 limit 上限）
+PRECOMPUTED_LIMIT = 20
+
+# 统计热度时读取的历史查询数上限（按出现次数取最多的）
+POPULARITY_MAX_QUERIES = 50000
+
+CJK_PATTERN = re.compile(r'[㐀-鿿]')
+
+
+def suggestion_keys(text: str) -> List[Tuple[str, bool]]:
+    """
+    候选词的检索键：从整词开头、每个英文单词开头、每个中文字符开始的后缀
+
+    Returns:
+        [(键, 是否为整词开头)]
+    """
+    keys = [(text, True)]
+    for position in range(1, len(text)):
+        char, previous = text[position], text[position - 1]
+        word_start = not char.isspace() and (previous.isspace() or previous in '-_/·')
+        if word_start or CJK_PATTERN.match(char):
+            keys.append((text[position:], False))
+    return keys
+
+
+def load_query_counts(db_path: str, limit: int = POPULARITY_MAX_QUERIES) -> List[Tuple[str, int]]:
+    """读取历史查询及出现次数，数据库不存在时返回空列表"""
+    if not db_path or not os.path.exists(db_path):
+        return []
+    try:
+        with sqlite3.connect(f"file:{db_path}?mode=ro", uri=True) as conn:
+            rows = conn.execute(
+                'SELECT query_text, COUNT(*) AS n FROM user_queries '
+                'GROUP BY query_text ORDER BY n DESC LIMIT ?', (limit,)
+            ).fetchall()
+    except sqlite3.Error as e:
+        print(f"⚠️ 读取查询日志失败，联想不按热度排序: {e}")
+        return []
+    return [(text, count) for text, count in rows if text]
+
+
+class SuggestIndex:
+    """排序数组 + 二分查找的前缀联想索引（构建后不再修改）"""
+
+    def __init__(self, candidates: List[Dict[str, Any]], query_counts: List[Tuple[str, int]] = ()):
+        """
+        Args:
+            candidates: [{'text': 显示文本, 'type': 来源类型}]，相同文本（归一化后）只保留第一个
+            query_counts: [(历史查询, 次数)]，用于计算候选词热度
+        """
+        self.candidates: List[Dict[str, Any]] = []
+        seen = set()
+        for candidate in candidates:
+            normalized = normalize_query(candidate['text'])
+            if normalized and normalized not in seen:
+                seen.add(normalized)
+                self.candidates.append({**candidate, 'normalized': normalized, 'popularity': 0})
+
+        # 热度：包含该候选词的历史查询次数之和（自动机扫描每条查询一遍）
+        if query_counts and self.candidates:
+            automaton = AhoCorasick(candidate['normalized'] for candidate in self.candidates)
+            for text, count in query_counts:
+                for pattern_id in automaton.find(normalize_query(text)):
+                    self.candidates[pattern_id]['popularity'] += count
+
+        # 排序键：热度高、整词开头、文本短的在前
+        entries = []
+        for candidate_id, candidate in enumerate(self.candidates):
+            for key, whole in suggestion_keys(candidate['normalized']):
+                rank = (candidate['popularity'], whole, -len(candidate['normalized']))
+                entries.append((key, rank, candidate_id))
+        entries.sort()
+        self._keys = [key for key, _, _ in entries]
+        self._entries = [(rank, candidate_id) for _, rank, candidate_id in entries]
+
+        self._precomputed: Dict[str, List[int]] = {}
+        prefixes = {key[:length] for key in self._keys
+                    for length in range(1, PRECOMPUTED_PREFIX_CHARS + 1) if len(key) >= length}
+        for prefix in prefixes:
+            self._precomputed[prefix] = self._rank(prefix, PRECOMPUTED_LIMIT)
+
+    def __len__(self) -> int:
+        return len(self.candidates)
+
+    def _rank(self, prefix: str, limit: int) -> List[int]:
+        """二分定位前缀区间，按排序键取前 limit 个不同的候选词"""
+        lo = bisect.bisect_left(self._keys, prefix)
+        hi = bisect.bisect_left(self._keys, prefix + '\U0010ffff', lo)
+        best: Dict[int, tuple] = {}
+        for rank, candidate_id in self._entries[lo:hi]:
+            if candidate_id not in best or rank > best[candidate_id]:
+                best[candidate_id] = rank
+        top = heapq.nlargest(limit, best.items(), key=lambda item: (item[1], -item[0]))
+        return [candidate_id for candidate_id, _ in top]
+
+    def suggest(self, prefix: str, limit: int = 8) -> List[Dict[str, Any]]:
+        """
+        前缀联想
+
+        Returns:
+            [{'text', 'type', 'popularity'}]，按热度降序
+        """
+        prefix = normalize_query(prefix)
+        if not prefix:
+            return []
+        if len(prefix) <= PRECOMPUTED_PREFIX_CHARS and limit <= PRECOMPUTED_LIMIT:
+            ids = self._precomputed.get(prefix, [])
+        else:
+            ids = self._rank(prefix, limit)
+        return [
+            {'text': self.candidates[i]['text'], 'type': self.candidates[i]['type'],
+             'popularity': self.candidates[i]['popularity']}
+            for i in ids[:limit]
+        ]
+
+
+def collect_candidates(knowledge_data: Dict[str, Any], boost_terms_path: Optional[str] = None) -> List[Dict[str, Any]]:
+    """从知识库数据中收集联想候选词（标题优先，关键词其次）"""
+    titles, keywords = [], []
+    for section_id, section in knowledge_data.items():
+        if not isinstance(section, dict) or 'subsections' not in section:
+            continue
+        for subsection in section['subsections']:
+            if subsection.get('title'):
+                titles.append({'text': subsection['title'], 'type': 'subsection'})
+            keywords.extend({'text': keyword, 'type': 'keyword'} for keyword in subsection.get('keywords', []))
+
+    for link in knowledge_data.get('external_links', []):
+        if link.get('title'):
+            titles.append({'text': link['title'], 'type': 'external_link'})
+        keywords.extend({'text': keyword, 'type': 'keyword'} for keyword in link.get('keywords', []))
+
+    # 加权词配置中多为产品名和核心术语；展示配置中的原始写法，压缩后的匹配键只用于去重
+    products, seen = [], set()
+    for term, _ in read_boost_terms(boost_terms_path):
+        key = compact_term(term)
+        if key not in seen:
+            seen.add(key)
+            products.append({'text': term, 'type': 'term'})
+    return titles + products + keywords
+
+
+class SuggestService:
+    """
+    联想服务：知识库版本变化或热度过期时在后台重建索引
+
+    查询只读取当前索引的引用；重建期间继续使用旧索引，不阻塞请求
+    """
+
+    def __init__(self, kb_loader, db_path: str, refresh_interval: float = 600.0):
+        self.kb_loader = kb_loader
+        self.db_path = db_path
+        self.refresh_interval = refresh_interval
+        self._index: Optional[SuggestIndex] = None
+        self._version = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+
+    def _build(self):
+        version = self.kb_loader.version
+        started = time.perf_counter()
+        candidates = collect_candidates(self.kb_loader.knowledge_data, self.kb_loader.boost_terms_path)
+        index = SuggestIndex(candidates, load_query_counts(self.db_path))
+        self._index, self._version, self._built_at = index, version, time.monotonic()
+        print(f"✅ 输入联想索引已构建: {len(index)} 个候选词，耗时 {(time.perf_counter() - started) * 1000:.1f}ms")
+
+    def _refresh_in_background(self):
+        if not self._lock.acquire(blocking=False):
+            return
+
+        def run():
+            try:
+                self._build()
+            except Exception as e:
+                print(f"⚠️ 重建输入联想索引失败: {e}")
+            finally:
+                self._lock.release()
+
+        threading.Thread(target=run, name='kb-suggest', daemon=True).start()
+
+    def warm_up(self):
+        """启动时构建索引（多进程模式下在fork前调用，工作进程共享）"""
+        with self._lock:
+            self._build()
+
+    def suggest(self, prefix: str, limit: int = 8) -> List[Dict[str, Any]]:
+        if self._index is None:
+            # 首次查询同步构建
+            with self._lock:
+                if self._index is None:
+                    self._build()
+        elif self._version != self.kb_loader.version or time.monotonic() - self._built_at > self.refresh_interval:
+            self._refresh_in_background()
+        return self._index.suggest(prefix, limit)
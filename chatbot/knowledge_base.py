@@ -1,7 +1,11 @@
 from typing import List, Dict, Any, Optional
 import os
-import asyncio
+from config import Config
 from .kb_loader import MogineKBLoader
+from .kb_executor import SearchExecutor
+from .kb_passages import passage_text
+from . import vector_store
+from .vector_store import HashedNgramEmbedder
 
 class KnowledgeBase:
     """本地知识库 - 使用摩泛科技知识库"""
@@ -11,16 +15,90 @@ class KnowledgeBase:
         self.kb_loader = MogineKBLoader()
         self.company_info = self.kb_loader.get_company_info()
         self.assistant_info = self.kb_loader.get_assistant_info()
+        
+        # 知识库检索专用执行器（不占用默认线程池）；
+        # 进程池在打开向量索引之前启动，fork时子进程不会继承ChromaDB的后台线程
+        self.search_executor = SearchExecutor(
+            self.kb_loader,
+            mode=Config.KB_SEARCH_EXECUTOR,
+            workers=Config.KB_SEARCH_WORKERS,
+            max_pending=Config.KB_SEARCH_MAX_PENDING
+        )
+        self.search_executor.warm_up()
+        
+        # 持久化向量索引（存放在 KNOWLEDGE_DB_PATH）
+        self.embedder = HashedNgramEmbedder(dim=Config.KB_EMBEDDING_DIM)
+        self.collection = self._init_vector_index()
+        
+        self._load_custom_documents()
+        
+        # 知识库热加载后同步向量索引（只重新嵌入变化的条目）
+        self.kb_loader.add_reload_listener(self._on_kb_reload)
+    
+    def _on_kb_reload(self, kb_loader: MogineKBLoader):
+        """知识库重新加载回调"""
+        self.company_info = kb_loader.get_company_info()
+        self.assistant_info = kb_loader.get_assistant_info()
+        if self.collection is not None:
+            embedded = vector_store.sync_documents(self.collection, self._kb_documents(), source="kb")
+            print(f"✅ 向量索引已同步，本次嵌入 {embedded} 个")
+    
+    def _init_vector_index(self):
+        """打开向量索引并同步知识库条目（只嵌入新增或变化的条目）"""
+        if not vector_store.is_available():
+            print("⚠️ 未安装chromadb，向量检索不可用")
+            return None
+        
+        try:
+            collection = vector_store.open_collection(
+                Config.KNOWLEDGE_DB_PATH, Config.KNOWLEDGE_COLLECTION, self.embedder
+            )
+            embedded = vector_store.sync_documents(collection, self._kb_documents(), source="kb")
+            print(f"✅ 向量索引就绪，共 {collection.count()} 个文档，本次嵌入 {embedded} 个")
+            return collection
+        except Exception as e:
+            print(f"❌ 初始化向量索引失败: {e}")
+            return None
+    
+    def _kb_documents(self) -> List[Dict[str, Any]]:
+        """把知识库检索条目转换为向量索引文档"""
+        documents = []
+        for _, doc in self.kb_loader.search_index.live_documents():
+            payload = doc['payload']
+            if doc['type'] == 'external_link':
+                link = payload['link']
+                ref_id = link.get('id')
+                title = link.get('title', '')
+                text = f"{title} {link.get('description', '')}"
+            elif payload.get('passage'):
+                # 长子章节按段落嵌入
+                ref_id = payload['passage']['id']
+                title = payload['subsection'].get('title', '')
+                text = f"{title} {passage_text(payload, payload['passage'])}"
+            else:
+                subsection = payload['subsection']
+                ref_id = subsection.get('id')
+                title = subsection.get('title', '')
+                text = f"{title} {payload['content_text']} {payload['solution_text']}"
+            
+            documents.append({
+                'id': f"kb:{doc['type']}:{ref_id}",
+                'text': text.strip(),
+                'metadata': {'type': doc['type'], 'title': title or ''}
+            })
+        return documents
+    
+    def semantic_search(self, query_text: str, top_k: int = 3) -> List[Dict[str, Any]]:
+        """基于向量索引的语义检索"""
+        if self.collection is None:
+            return []
+        return vector_store.query_collection(self.collection, self.embedder, query_text, top_k)
     
     async def query(self, query_text: str, top_k: int = 3) -> Dict[str, Any]:
         """查询知识库"""
         try:
-            # 在异步环境中运行知识库搜索
-            loop = asyncio.get_event_loop()
-            results = await loop.run_in_executor(
-                None, 
-                lambda: self.kb_loader.search_knowledge(query_text, top_k)
-            )
+            # 在专用执行器中运行知识库搜索
+            results = await self.search_executor.search(query_text, top_k)
             
             # 格式化结果
             formatted_results = []
@@ -45,8 +123,34 @@ class KnowledgeBase:
                 if result.get('media_files'):
                     formatted_result["media_files"] = result.get('media_files')
                 
+                # 添加段落定位信息（长子章节只返回命中的段落）
+                if result.get('passage'):
+                    formatted_result["passage"] = result.get('passage')
+                
                 formatted_results.append(formatted_result)
             
+            # 关键词检索结果不足时，用向量检索补充（包括运行时添加的文档）
+            if len(formatted_results) < top_k and self.collection is not None:
+                seen_titles = {result['title'] for result in formatted_results}
+                semantic_results = await self.search_executor.run_local(self.semantic_search, query_text, top_k)
+                for hit in semantic_results:
+                    # 相似度过低的结果与查询无关，宁可不返回
+                    if hit['relevance_score'] < Config.KB_VECTOR_MIN_SCORE:
+                        continue
+                    title = hit['metadata'].get('title', '')
+                    if title in seen_titles:
+                        continue
+                    formatted_results.append({
+                        "content": hit['content'],
+                        "title": title,
+                        "type": hit['metadata'].get('type', 'document'),
+                        "source": hit['metadata'].get('source', ''),
+                        "relevance_score": hit['relevance_score']
+                    })
+                    seen_titles.add(title)
+                    if len(formatted_results) >= top_k:
+                        break
+            
             return {
                 "success": True,
                 "query": query_text,
@@ -67,14 +171,45 @@ class KnowledgeBase:
                 "assistant_info": self.assistant_info
             }
     
+    def search_stats(self) -> Dict[str, Any]:
+        """检索执行器与结果缓存的统计"""
+        return {
+            "executor": self.search_executor.stats(),
+            "cache": self.kb_loader.cache_stats(),
+            "segments": self.kb_loader.custom_segments.stats()
+        }
+    
+    def close(self):
+        """关闭检索执行器和后台合并线程"""
+        self.search_executor.shutdown(wait=False)
+        self.kb_loader.custom_segments.stop_compactor()
+    
+    def _load_custom_documents(self):
+        """启动时把向量库中的CMS文档恢复到运行时分段存储（关键词检索）"""
+        if self.collection is None:
+            return
+        try:
+            existing = self.collection.get(where={"source": "custom"}, include=["documents", "metadatas"])
+            documents = [
+                {'id': doc_id, 'content': content or '', 'metadata': metadata or {}}
+                for doc_id, content, metadata in zip(existing["ids"], existing["documents"], existing["metadatas"])
+            ]
+            if documents:
+                self.kb_loader.upsert_custom_documents(documents)
+                print(f"✅ 已恢复 {len(documents)} 个运行时知识库条目")
+        except Exception as e:
+            print(f"⚠️ 恢复运行时知识库条目失败: {e}")
+    
     def add_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None):
-        """添加文档到知识库"""
+        """添加文档到知识库（关键词检索立即可见，向量索引可用时同步写入）"""
         try:
-            self.collection.add(
-                documents=[content],
-                metadatas=[metadata or {}],
-                ids=[doc_id]
-            )
+            self.kb_loader.upsert_custom_documents([{'id': doc_id, 'content': content, 'metadata': metadata}])
+            if self.collection is not None:
+                self.collection.upsert(
+                    documents=[content],
+                    metadatas=[{**(metadata or {}), "source": "custom"}],
+                    ids=[doc_id]
+                )
             return True
         except Exception as e:
             print(f"添加文档错误: {e}")
@@ -83,21 +218,26 @@ class KnowledgeBase:
     def update_document(self, doc_id: str, content: str, metadata: Dict[str, Any] = None):
         """更新知识库中的文档"""
         try:
-            self.collection.update(
-                ids=[doc_id],
-                documents=[content],
-                metadatas=[metadata or {}]
-            )
+            self.kb_loader.upsert_custom_documents([{'id': doc_id, 'content': content, 'metadata': metadata}])
+            if self.collection is not None:
+                self.collection.upsert(
+                    ids=[doc_id],
+                    documents=[content],
+                    metadatas=[{**(metadata or {}), "source": "custom"}]
+                )
             return True
         except Exception as e:
             print(f"更新文档错误: {e}")
             return False
     
     def delete_document(self, doc_id: str):
-        """从知识库删除文档"""
+        """从知识库删除文档，返回是否确实删除了文档（不存在时返回 False）"""
         try:
-            self.collection.delete(ids=[doc_id])
-            return True
+            deleted = self.kb_loader.delete_custom_document(doc_id)
+            if self.collection is not None and self.collection.get(ids=[doc_id], include=[])["ids"]:
+                self.collection.delete(ids=[doc_id])
+                deleted = True
+            return deleted
         except Exception as e:
             print(f"删除文档错误: {e}")
-            return False
\ No newline at end of file
+            return False
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+知识库图片派生版本（缩略图 / WebP / AVIF / 多尺寸）
+kb/assets 下的原图多为 0.3–2MB 的PNG，聊天气泡里只需要几百像素宽的图。
+这里按需（或离线批量）生成缩放、重新压缩后的版本并缓存在磁盘上，
+文件服务器根据 Accept 头和 w 参数选择最合适的版本。
+
+缓存文件名包含原图的修改时间和大小，原图更新后自动生成新版本。
+
+用法（离线预生成全部版本）:
+    python -m chatbot.media_variants [assets_dir]
+"""
+
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# 旧版Pillow需要插件才能编码AVIF（pip install pillow-avif-plugin），没有时只提供WebP
+try:
+    import pillow_avif  # noqa: F401
+except ImportError:
+    pillow_avif = None
+
+SOURCE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+# 格式 -> (Pillow编码器名, 扩展名, Content-Type)
+FORMATS = {
+    'avif': ('AVIF', '.avif', 'image/avif'),
+    'webp': ('WEBP', '.webp', 'image/webp'),
+    'jpeg': ('JPEG', '.jpg', 'image/jpeg'),
+    'png': ('PNG', '.png', 'image/png'),
+}
+
+# 按压缩率从高到低尝试
+PREFERRED_FORMATS = ('avif', 'webp')
+
+_generate_locks: Dict[str, threading.Lock] = {}
+_generate_locks_guard = threading.Lock()
+
+
+def is_available() -> bool:
+    """Pillow 是否可用"""
+    return Image is not None
+
+
+def supported_formats() -> List[str]:
+    """当前Pillow能编码的派生格式"""
+    if Image is None:
+        return []
+    Image.init()
+    return [fmt for fmt, (encoder, _, _) in FORMATS.items() if encoder in Image.SAVE]
+
+
+def variant_widths() -> List[int]:
+    """配置的派生宽度档位（升序）"""
+    return sorted(int(w) for w in Config.MEDIA_VARIANT_WIDTHS.split(',') if w.strip())
+
+
+def is_variant_source(path: str) -> bool:
+    """是否是可以生成派生版本的图片"""
+    return path.lower().endswith(SOURCE_EXTENSIONS)
+
+
+def original_format(path: str) -> str:
+    return 'png' if path.lower().endswith('.png') else 'jpeg'
+
+
+def negotiate_format(accept: Optional[str], source_path: str) -> str:
+    """
+    根据 Accept 头选择输出格式
+
+    按 AVIF > WebP 的顺序选择客户端接受（q>0）且本机能编码的格式，否则沿用原图格式
+    """
+    accepted = {}
+    for media_range in (accept or '').split(','):
+        parts = [part.strip() for part in media_range.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        if parts[0]:
+            accepted[parts[0].lower()] = quality
+
+    available = supported_formats()
+    for fmt in PREFERRED_FORMATS:
+        if fmt in available and accepted.get(FORMATS[fmt][2], 0.0) > 0:
+            return fmt
+    return original_format(source_path)
+
+
+def choose_width(requested: Optional[int]) -> Optional[int]:
+    """
+    把请求宽度归到不小于它的最近档位，限制缓存文件的数量
+
+    Returns:
+        档位宽度；未指定宽度或超过最大档位时返回 None（保持原图尺寸）
+    """
+    if not requested or requested <= 0:
+        return None
+    for width in variant_widths():
+        if width >= requested:
+            return width
+    return None
+
+
+def variant_path(source_path: str, width: Optional[int], fmt: str, cache_dir: Optional[str] = None) -> str:
+    """派生版本的缓存路径：<缓存目录>/<原图名>.<宽度>w.<原图版本>.<扩展名>"""
+    cache_dir = cache_dir or Config.MEDIA_VARIANT_DIR
+    stat = os.stat(source_path)
+    version = hashlib.sha1(
+        f"{os.path.abspath(source_path)}:{stat.st_mtime_ns}:{stat.st_size}:{Config.MEDIA_VARIANT_QUALITY}".encode('utf-8')
+    ).hexdigest()[:12]
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    size = f"{width}w" if width else "full"
+    return os.path.join(cache_dir, f"{stem}.{size}.{version}{FORMATS[fmt][1]}")
+
+
+def generate_variant(source_path: str, target_path: str, width: Optional[int], fmt: str):
+    """缩放并重新编码原图，原子写入目标路径（只缩小，不放大）"""
+    encoder = FORMATS[fmt][0]
+    with Image.open(source_path) as image:
+        image.load()
+        if width and image.width > width:
+            height = max(1, round(image.height * width / image.width))
+            image = image.resize((width, height), Image.LANCZOS)
+
+        if encoder == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        elif image.mode not in ('RGB', 'RGBA', 'L', 'LA'):
+            image = image.convert('RGBA')
+
+        save_options = {'optimize': True} if encoder in ('PNG', 'JPEG') else {}
+        if encoder != 'PNG':
+            save_options['quality'] = Config.MEDIA_VARIANT_QUALITY
+
+        directory = os.path.dirname(os.path.abspath(target_path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                image.save(f, format=encoder, **save_options)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, target_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+def get_variant(source_path: str, width: Optional[int], accept: Optional[str]) -> Optional[Tuple[str, str]]:
+    """
+    取得（必要时生成）最合适的派生版本
+
+    Returns:
+        (文件路径, Content-Type)；不需要派生（原尺寸原格式）或 Pillow 不可用时返回 None，调用方直接返回原图
+    """
+    if Image is None or not is_variant_source(source_path):
+        return None
+
+    width = choose_width(width)
+    fmt = negotiate_format(accept, source_path)
+    if width is None and fmt == original_format(source_path):
+        return None
+
+    target_path = variant_path(source_path, width, fmt)
+    if not os.path.exists(target_path):
+        # 同一版本只生成一次，并发请求等待第一个请求生成完毕
+        with _generate_locks_guard:
+            lock = _generate_locks.setdefault(target_path, threading.Lock())
+        with lock:
+            if not os.path.exists(target_path):
+                generate_variant(source_path, target_path, width, fmt)
+        with _generate_locks_guard:
+            _generate_locks.pop(target_path, None)
+
+    return target_path, FORMATS[fmt][2]
+
+
+def asset_version(source_path: str) -> Optional[str]:
+    """原图版本摘要（修改时间 + 大小），文件不存在时返回 None"""
+    try:
+        stat = os.stat(source_path)
+    except OSError:
+        return None
+    return hashlib.sha1(f"{stat.st_mtime_ns}:{stat.st_size}".encode('utf-8')).hexdigest()[:10]
+
+
+def media_urls(path: str) -> Dict[str, object]:
+    """
+    知识库 media_files 中图片的派生版本地址（相对文件服务器根目录）
+
+    地址带原图版本参数 v，文件服务器对这类地址返回长期缓存头；原图更新后地址随之变化
+
+    Returns:
+        {'url': 默认宽度的地址, 'srcset': [{'width', 'url'}]}
+    """
+    base_url = f"kb/{path}"
+    version = asset_version(os.path.join('kb', path))
+    suffix = f"&v={version}" if version else ''
+    if not is_variant_source(path):
+        return {'url': f"{base_url}?v={version}" if version else base_url, 'srcset': []}
+    return {
+        'url': f"{base_url}?w={Config.MEDIA_DEFAULT_WIDTH}{suffix}",
+        'srcset': [{'width': width, 'url': f"{base_url}?w={width}{suffix}"} for width in variant_widths()]
+    }
+
+
+def pregenerate(assets_dir: str) -> int:
+    """离线生成目录下所有图片的全部档位和格式，返回新生成的文件数"""
+    created = 0
+    formats = supported_formats()
+    for root, _, files in os.walk(assets_dir):
+        for name in sorted(files):
+            source_path = os.path.join(root, name)
+            if not is_variant_source(source_path):
+                continue
+            for width in variant_widths():
+                for fmt in [f for f in PREFERRED_FORMATS if f in formats] + [original_format(source_path)]:
+                    target_path = variant_path(source_path, width, fmt)
+                    if not os.path.exists(target_path):
+                        generate_variant(source_path, target_path, width, fmt)
+                        created += 1
+    return created
+
+
+if __name__ == "__main__":
+    if not is_available():
+        print("❌ 生成图片派生版本需要安装 Pillow")
+        sys.exit(1)
+    assets_dir = sys.argv[1] if len(sys.argv) > 1 else "kb/assets"
+    created = pregenerate(assets_dir)
+    print(f"✅ 图片派生版本已生成: 新增 {created} 个，格式 {', '.join(supported_formats())}，目录 {Config.MEDIA_VARIANT_DIR}")
@@ -75,7 +75,8 @@ class ResponseIntegrator:
         if knowledge_result and knowledge_result.get('success'):
             context_parts.append("\\n知识库信息:")
             for i, result in enumerate(knowledge_result.get('results', []), 1):
-                context_parts.append(f"{i}. {result['content']}")
+                # 命中解决方案段落时 content 为空，使用 solution 文本
+                context_parts.append(f"{i}. {result['content'] or result.get('solution', '')}")
                 if result.get('metadata'):
                     context_parts.append(f"   来源: {result['metadata']}")
         
@@ -0,0 +1,153 @@
+"""
+本地向量索引
+使用哈希字符n-gram做离线嵌入（不依赖任何模型或外部API），
+向量持久化在 ChromaDB（HNSW近似最近邻）中，重启后无需重新嵌入
+"""
+
+import hashlib
+import math
+import zlib
+from typing import Dict, List, Any, Iterable, Optional
+
+try:
+    import chromadb
+    from chromadb.config import Settings
+except ImportError:
+    chromadb = None
+    Settings = None
+
+
+def is_available() -> bool:
+    """chromadb 是否可用"""
+    return chromadb is not None
+
+
+def content_hash(text: str) -> str:
+    """文档内容摘要，用于判断是否需要重新嵌入"""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+class HashedNgramEmbedder:
+    """
+    哈希字符n-gram嵌入器
+
+    每个字符n-gram经 crc32 映射到固定维度的一个桶，再用另一位哈希决定正负号，
+    最后做L2归一化。结果是确定性的（不受 PYTHONHASHSEED 影响），可以安全持久化。
+    """
+
+    def __init__(self, dim: int = 512, ngram_sizes: Iterable[int] = (1, 2, 3)):
+        self.dim = dim
+        self.ngram_sizes = tuple(ngram_sizes)
+
+    @property
+    def name(self) -> str:
+        return f"hashed-ngram-{self.dim}-{'-'.join(map(str, self.ngram_sizes))}"
+
+    def embed(self, text: str) -> List[float]:
+        """把单条文本映射为向量"""
+        vector = [0.0] * self.dim
+        for segment in text.lower().split():
+            for n in self.ngram_sizes:
+                for i in range(len(segment) - n + 1):
+                    h = zlib.crc32(segment[i:i + n].encode('utf-8'))
+                    vector[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+
+        norm = math.sqrt(sum(v * v for v in vector))
+        if norm:
+            vector = [v / norm for v in vector]
+        return vector
+
+    def __call__(self, texts: List[str]) -> List[List[float]]:
+        """ChromaDB EmbeddingFunction 接口"""
+        return [self.embed(text) for text in texts]
+
+
+def open_collection(path: str, name: str, embedder: HashedNgramEmbedder):
+    """
+    打开（或创建）持久化的向量集合
+
+    集合元数据中记录嵌入器名称；如果嵌入器配置变化，旧向量已不可比较，集合会被重建
+    """
+    client = chromadb.PersistentClient(path=path, settings=Settings(anonymized_telemetry=False))
+    collection_metadata = {"hnsw:space": "cosine", "embedder": embedder.name}
+
+    collection = client.get_or_create_collection(
+        name=name,
+        embedding_function=embedder,
+        metadata=collection_metadata
+    )
+    if (collection.metadata or {}).get("embedder") != embedder.name:
+        print(f"⚠️ 向量集合 {name} 的嵌入器已变更，重建索引")
+        client.delete_collection(name)
+        collection = client.create_collection(
+            name=name,
+            embedding_function=embedder,
+            metadata=collection_metadata
+        )
+    return collection
+
+
+def sync_documents(collection, documents: List[Dict[str, Any]], source: str) -> int:
+    """
+    把一组文档同步到向量集合，只嵌入新增或内容变化的文档
+
+    Args:
+        collection: ChromaDB集合
+        documents: [{'id', 'text', 'metadata'}]
+        source: 文档来源标记，同来源中已不存在的文档会被删除
+
+    Returns:
+        本次重新嵌入的文档数
+    """
+    existing = collection.get(where={"source": source}, include=["metadatas"])
+    existing_hashes = {
+        doc_id: (metadata or {}).get("content_hash")
+        for doc_id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+
+    ids, texts, metadatas = [], [], []
+    for document in documents:
+        digest = content_hash(document['text'])
+        if existing_hashes.get(document['id']) == digest:
+            continue
+        ids.append(document['id'])
+        texts.append(document['text'])
+        metadatas.append({**document.get('metadata', {}), "source": source, "content_hash": digest})
+
+    if ids:
+        collection.upsert(ids=ids, documents=texts, metadatas=metadatas)
+
+    current_ids = {document['id'] for document in documents}
+    stale_ids = [doc_id for doc_id in existing_hashes if doc_id not in current_ids]
+    if stale_ids:
+        collection.delete(ids=stale_ids)
+
+    return len(ids)
+
+
+def query_collection(collection, embedder: HashedNgramEmbedder, query: str,
+                     top_k: int = 3, where: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """近似最近邻检索，返回 [{'id', 'content', 'metadata', 'relevance_score'}]"""
+    count = collection.count()
+    if not count:
+        return []
+
+    response = collection.query(
+        query_embeddings=[embedder.embed(query)],
+        n_results=min(top_k, count),
+        where=where,
+        include=["documents", "metadatas", "distances"]
+    )
+
+    results = []
+    for doc_id, document, metadata, distance in zip(
+        response["ids"][0], response["documents"][0],
+        response["metadatas"][0], response["distances"][0]
+    ):
+        results.append({
+            'id': doc_id,
+            'content': document,
+            'metadata': metadata or {},
+            'relevance_score': 1.0 - distance
+        })
+    return results
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+知识库视频HLS分段（可选）
+把 kb/assets 下的 mp4 离线切分为几秒一段的 HLS 分段和 m3u8 播放列表，
+播放器下载完第一个分段即可开始播放。分段只做封装转换（-c copy），不重新编码。
+
+依赖本机安装的 ffmpeg；没有 ffmpeg 时跳过，视频仍可通过 Range 请求边下边播。
+分段目录名包含原视频的版本摘要，原视频更新后重新生成。
+
+用法:
+    python -m chatbot.video_segments [assets_dir]
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from typing import Optional
+
+from config import Config
+from .media_variants import asset_version
+
+VIDEO_EXTENSIONS = ('.mp4',)
+
+# 每个分段的目标时长（秒）
+SEGMENT_SECONDS = 4
+
+
+def is_available() -> bool:
+    """ffmpeg 是否可用"""
+    return shutil.which('ffmpeg') is not None
+
+
+def playlist_path(source_path: str, cache_dir: Optional[str] = None) -> Optional[str]:
+    """视频对应的播放列表路径：<缓存目录>/hls/<视频名>.<版本>/index.m3u8"""
+    version = asset_version(source_path)
+    if version is None:
+        return None
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(cache_dir or Config.MEDIA_VARIANT_DIR, 'hls', f"{stem}.{version}", 'index.m3u8')
+
+
+def segment_video(source_path: str, target_playlist: str):
+    """调用 ffmpeg 切分视频；先输出到临时目录，完成后整体改名，播放方不会看到半成品"""
+    target_dir = os.path.dirname(target_playlist)
+    parent_dir = os.path.dirname(target_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(dir=parent_dir, suffix='.tmp')
+    try:
+        subprocess.run([
+            'ffmpeg', '-loglevel', 'error', '-y', '-i', source_path,
+            '-c', 'copy', '-f', 'hls',
+            '-hls_time', str(SEGMENT_SECONDS),
+            '-hls_playlist_type', 'vod',
+            '-hls_segment_filename', os.path.join(tmp_dir, 'segment_%04d.ts'),
+            os.path.join(tmp_dir, 'index.m3u8')
+        ], check=True)
+        os.replace(tmp_dir, target_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+
+def hls_url(path: str) -> Optional[str]:
+    """知识库视频的HLS播放列表地址（相对文件服务器根目录），尚未生成时返回 None"""
+    if not path.lower().endswith(VIDEO_EXTENSIONS):
+        return None
+    playlist = playlist_path(os.path.join('kb', path))
+    if playlist is None or not os.path.exists(playlist):
+        return None
+    return playlist.replace(os.sep, '/')
+
+
+def pregenerate(assets_dir: str) -> int:
+    """切分目录下所有尚未分段的视频，返回本次处理的视频数"""
+    created = 0
+    for root, _, files in os.walk(assets_dir):
+        for name in sorted(files):
+            source_path = os.path.join(root, name)
+            if not name.lower().endswith(VIDEO_EXTENSIONS):
+                continue
+            playlist = playlist_path(source_path)
+            if playlist and not os.path.exists(playlist):
+                segment_video(source_path, playlist)
+                created += 1
+    return created
+
+
+if __name__ == "__main__":
+    if not is_available():
+        print("⚠️ 未安装ffmpeg，跳过视频分段（视频仍可通过Range请求播放）")
+        sys.exit(0)
+    assets_dir = sys.argv[1] if len(sys.argv) > 1 else "kb/assets"
+    created = pregenerate(assets_dir)
+    print(f"✅ 视频HLS分段完成: 新增 {created} 个，目录 {os.path.join(Config.MEDIA_VARIANT_DIR, 'hls')}")
@@ -23,6 +23,8 @@ class ProductionConfig {
             servers: {
                 kbServer: '/~temp/mogine_agent/api',
                 fileServer: '/~temp/mogine_agent/kb/assets',
+                // 文件服务器根目录（知识库返回的图片地址 media.url 相对于这里）
+                mediaServer: '/~temp/mogine_agent/api/files',
                 mainServer: '/~temp/mogine_agent'
             },
             
@@ -11,6 +11,54 @@ class Config:
     
     # 知识库配置
     KNOWLEDGE_DB_PATH = os.getenv("KNOWLEDGE_DB_PATH", "./knowledge_db")
+    KNOWLEDGE_COLLECTION = os.getenv("KNOWLEDGE_COLLECTION", "mogine_kb")
+    KB_EMBEDDING_DIM = int(os.getenv("KB_EMBEDDING_DIM", 512))  # 哈希n-gram向量维度
+    KB_VECTOR_MIN_SCORE = float(os.getenv("KB_VECTOR_MIN_SCORE", 0.15))  # 向量补充结果的最低余弦相似度
+    
+    # 知识库检索打分器: legacy（原有规则）或 bm25
+    KB_SCORER = os.getenv("KB_SCORER", "legacy")
+    KB_BM25_K1 = float(os.getenv("KB_BM25_K1", 1.2))
+    KB_BM25_B = float(os.getenv("KB_BM25_B", 0.75))
+    KB_BM25_MIN_SCORE = float(os.getenv("KB_BM25_MIN_SCORE", 0.0))  # 归一化得分阈值
+    
+    # 知识库编译快照（为空时使用 XML 同名的 .kbsnap 文件）
+    KB_USE_SNAPSHOT = os.getenv("KB_USE_SNAPSHOT", "true").lower() == "true"
+    KB_SNAPSHOT_PATH = os.getenv("KB_SNAPSHOT_PATH", "")
+    
+    # 知识库文件监控间隔（秒），0表示不监控；变化后增量重建索引并原子替换
+    KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", 0))
+    
+    # 检索加权词：配置文件中的全局加权词 + XML <keyword> 的默认加权分
+    KB_BOOST_TERMS_PATH = os.getenv("KB_BOOST_TERMS_PATH", "kb/boost_terms.json")
+    KB_KEYWORD_BOOST = float(os.getenv("KB_KEYWORD_BOOST", 0.1))
+    
+    # 知识库查询结果缓存（条目数为0时关闭）
+    KB_CACHE_SIZE = int(os.getenv("KB_CACHE_SIZE", 1024))
+    KB_CACHE_TTL = float(os.getenv("KB_CACHE_TTL", 300))  # 秒
+    
+    # 长子章节切分为段落的长度上限（字符数，0表示不切分），以及是否合并相邻的命中段落
+    KB_PASSAGE_CHARS = int(os.getenv("KB_PASSAGE_CHARS", 300))
+    KB_PASSAGE_MERGE = os.getenv("KB_PASSAGE_MERGE", "true").lower() == "true"
+    
+    # 运行时（CMS）条目的分段存储：活跃分段文档数上限、触发合并的分段数、后台合并检查间隔（秒）
+    KB_SEGMENT_MAX_DOCS = int(os.getenv("KB_SEGMENT_MAX_DOCS", 32))
+    KB_MAX_SEGMENTS = int(os.getenv("KB_MAX_SEGMENTS", 4))
+    KB_COMPACT_INTERVAL = float(os.getenv("KB_COMPACT_INTERVAL", 30))
+    
+    # 知识库检索执行器: thread（专用线程池）或 process（多进程，每个进程一份只读索引）
+    KB_SEARCH_EXECUTOR = os.getenv("KB_SEARCH_EXECUTOR", "thread")
+    KB_SEARCH_WORKERS = int(os.getenv("KB_SEARCH_WORKERS", 0))  # 0表示 min(4, CPU核数)
+    KB_SEARCH_MAX_PENDING = int(os.getenv("KB_SEARCH_MAX_PENDING", 64))  # 排队上限，0表示不限制
+    
+    # 输入联想：热度统计使用的查询日志库、索引重建间隔（秒）
+    KB_SUGGEST_DB_PATH = os.getenv("KB_SUGGEST_DB_PATH", "data/query_logs.db")
+    KB_SUGGEST_REFRESH = float(os.getenv("KB_SUGGEST_REFRESH", 600))
+    
+    # 知识库图片派生版本（缩略图 / WebP / AVIF）：缓存目录、宽度档位、默认宽度、压缩质量
+    MEDIA_VARIANT_DIR = os.getenv("MEDIA_VARIANT_DIR", "kb/.variants")
+    MEDIA_VARIANT_WIDTHS = os.getenv("MEDIA_VARIANT_WIDTHS", "320,640,1280")
+    MEDIA_DEFAULT_WIDTH = int(os.getenv("MEDIA_DEFAULT_WIDTH", 640))
+    MEDIA_VARIANT_QUALITY = int(os.getenv("MEDIA_VARIANT_QUALITY", 80))
     
     # 服务器配置
     HOST = os.getenv("HOST", "0.0.0.0")
@@ -23,6 +23,8 @@ class SecureConfig {
             servers: {
                 kbServer: this.getSecureEndpoint('api'),
                 fileServer: this.getSecureEndpoint('kb', 'assets'),
+                // 文件服务器根目录（知识库返回的图片地址 media.url 相对于这里）
+                mediaServer: this.getSecureEndpoint('api', 'files'),
                 mainServer: this.getSecureEndpoint(),
                 analyticsServer: this.getSecureEndpoint('api', 'analytics')
             },
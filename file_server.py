@@ -4,21 +4,342 @@
 """
 
 import os
+import re
+import threading
+import uuid
 import mimetypes
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import unquote
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from http import HTTPStatus
+from http.server import HTTPServer, ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import unquote, urlparse, parse_qs
 from dotenv import load_dotenv
 
 # 加载环境变量
 load_dotenv()
 
+# 配置在导入时读取环境变量，需在 load_dotenv 之后导入
+from chatbot import media_variants
+
+# 文件名或查询参数中带内容摘要的地址，内容变化时地址也会变化，可以长期缓存
+HASHED_NAME_PATTERN = re.compile(r'\.[0-9a-f]{8,}\.[A-Za-z0-9]+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE_CONTROL = 'public, no-cache'
+
+
+# 单个请求最多允许的区间数，防止大量细碎区间放大开销
+MAX_RANGES = 16
+
+
+def parse_range_header(header: str, size: int):
+    """
+    解析 Range 请求头
+    
+    Returns:
+        [(起始, 结束)]（结束偏移包含在内，重叠区间已合并）；
+        格式不合法时返回 None（按规范忽略 Range，返回完整文件）；
+        所有区间都无法满足时返回空列表（416）
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip().lower() != 'bytes' or not spec.strip():
+        return None
+    
+    ranges = []
+    for part in spec.split(','):
+        first, dash, last = part.strip().partition('-')
+        if not dash:
+            return None
+        try:
+            if first:
+                start = int(first)
+                end = int(last) if last else size - 1
+                if start > end and last:
+                    return None
+            else:
+                # 后缀区间：最后 N 个字节
+                suffix = int(last)
+                if suffix <= 0:
+                    continue
+                start, end = max(0, size - suffix), size - 1
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    
+    if len(ranges) > MAX_RANGES:
+        return None
+    
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class ResponseBody:
+    """响应体：由内存数据和文件区间拼接而成，copyfile 对文件区间使用 sendfile 发送"""
+    
+    def __init__(self, pieces, file=None):
+        # pieces: bytes 或 (文件偏移, 长度)
+        self.pieces = pieces
+        self.file = file
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class SmallFileCache:
+    """小文件内存缓存（按总字节数淘汰最久未使用的文件），键包含修改时间和大小，文件更新后自动失效"""
+    
+    def __init__(self, max_bytes: int, max_file_size: int):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    def get(self, path: str, fs: os.stat_result):
+        """读取缓存的文件内容；文件过大或未命中时返回 None"""
+        if fs.st_size > self.max_file_size or self.max_bytes <= 0:
+            return None
+        key = (path, fs.st_mtime_ns, fs.st_size)
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+        
+        with open(path, 'rb') as f:
+            data = f.read()
+        if len(data) != fs.st_size:
+            # 读取期间文件被修改，本次不缓存
+            return data
+        
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = data
+                self._size += len(data)
+                while self._size > self.max_bytes:
+                    _, evicted = self._entries.popitem(last=False)
+                    self._size -= len(evicted)
+        return data
+
+
+file_cache = SmallFileCache(
+    max_bytes=int(os.getenv("FILE_CACHE_MAX_BYTES", 32 * 1024 * 1024)),
+    max_file_size=int(os.getenv("FILE_CACHE_MAX_FILE_SIZE", 256 * 1024))
+)
+
+
 class MediaFileHandler(SimpleHTTPRequestHandler):
     """媒体文件处理器"""
     
+    # HLS播放列表和分段
+    extensions_map = {
+        **SimpleHTTPRequestHandler.extensions_map,
+        '.m3u8': 'application/vnd.apple.mpegurl',
+        '.ts': 'video/mp2t',
+        '.mp4': 'video/mp4',
+    }
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.getcwd(), **kwargs)
     
+    def send_head(self):
+        """
+        返回文件响应头，响应体由 copyfile 发送
+        
+        - 知识库图片按 Accept 和 ?w= 参数返回派生版本
+        - 支持 ETag/If-None-Match 与 Last-Modified/If-Modified-Since 条件请求
+        - 支持单区间和多区间 Range 请求（206），视频可以拖动进度、边下边播
+        - 带内容摘要的地址返回长期缓存头，其余地址每次重新验证
+        """
+        self._vary_accept = False
+        parsed = urlparse(self.path)
+        path = self.translate_path(parsed.path)
+        
+        # 目录（列表、index.html、补全斜杠重定向）沿用默认处理
+        if os.path.isdir(path) or parsed.path.endswith('/'):
+            return super().send_head()
+        if not os.path.isfile(path):
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        
+        content_type = self.guess_type(path)
+        assets_dir = os.path.join(self.directory, 'kb', 'assets') + os.sep
+        if path.startswith(assets_dir) and media_variants.is_variant_source(path):
+            self._vary_accept = True
+            width = parse_qs(parsed.query).get('w', [''])[0]
+            try:
+                variant = media_variants.get_variant(
+                    path, int(width) if width.isdigit() else None, self.headers.get('Accept')
+                )
+            except Exception as e:
+                print(f"⚠️ 生成图片派生版本失败: {e}")
+                variant = None
+            if variant is not None:
+                path, content_type = variant
+        
+        return self._send_file(path, content_type, self._is_hashed_url(parsed))
+    
+    @staticmethod
+    def _is_hashed_url(parsed) -> bool:
+        return 'v' in parse_qs(parsed.query) or bool(HASHED_NAME_PATTERN.search(parsed.path))
+    
+    def _send_file(self, path, content_type, immutable=False):
+        """发送文件响应头（含条件请求处理），返回响应体"""
+        try:
+            fs = os.stat(path)
+        except OSError:
+            self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            return None
+        
+        etag = f'"{fs.st_mtime_ns:x}-{fs.st_size:x}"'
+        cache_control = IMMUTABLE_CACHE_CONTROL if immutable else REVALIDATE_CACHE_CONTROL
+        
+        if self._not_modified(etag, fs.st_mtime):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            return None
+        
+        # 小文件直接从内存返回，大文件交给 copyfile 用 sendfile 发送
+        data = file_cache.get(path, fs)
+        file = open(path, 'rb') if data is None else None
+        size = fs.st_size if data is None else len(data)
+        
+        def piece(start, end):
+            return data[start:end + 1] if data is not None else (start, end - start + 1)
+        
+        ranges = self._requested_ranges(etag, fs.st_mtime, size)
+        if ranges is not None and not ranges:
+            if file is not None:
+                file.close()
+            self.send_response(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE)
+            self.send_header('Content-Range', f'bytes */{size}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return None
+        
+        if ranges is None:
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', content_type)
+            pieces = [piece(0, size - 1)] if size else []
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            pieces = [piece(start, end)]
+        else:
+            # 多区间：multipart/byteranges
+            boundary = uuid.uuid4().hex
+            pieces = []
+            for start, end in ranges:
+                pieces.append((f'--{boundary}\r\nContent-Type: {content_type}\r\n'
+                               f'Content-Range: bytes {start}-{end}/{size}\r\n\r\n').encode('latin-1'))
+                pieces.append(piece(start, end))
+                pieces.append(b'\r\n')
+            pieces.append(f'--{boundary}--\r\n'.encode('latin-1'))
+            self.send_response(HTTPStatus.PARTIAL_CONTENT)
+            self.send_header('Content-Type', f'multipart/byteranges; boundary={boundary}')
+        
+        length = sum(len(p) if isinstance(p, bytes) else p[1] for p in pieces)
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', self.date_time_string(fs.st_mtime))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.end_headers()
+        return ResponseBody(pieces, file)
+    
+    def _requested_ranges(self, etag: str, mtime: float, size: int):
+        """
+        本次请求需要返回的区间
+        
+        Returns:
+            None 表示返回完整文件；空列表表示区间无法满足（416）
+        """
+        range_header = self.headers.get('Range')
+        if not range_header:
+            return None
+        
+        # If-Range 与当前版本不一致时忽略 Range，返回完整的新文件（ETag 需强比较）
+        if_range = self.headers.get('If-Range')
+        if if_range:
+            if_range = if_range.strip()
+            if if_range.startswith('"') or if_range.startswith('W/'):
+                if if_range != etag:
+                    return None
+            elif if_range != self.date_time_string(mtime):
+                return None
+        
+        return parse_range_header(range_header, size)
+    
+    def _not_modified(self, etag: str, mtime: float) -> bool:
+        """条件请求是否命中（If-None-Match 优先于 If-Modified-Since）"""
+        if_none_match = self.headers.get('If-None-Match')
+        if if_none_match is not None:
+            candidates = [tag.strip() for tag in if_none_match.split(',')]
+            # 弱比较：忽略 W/ 前缀
+            return '*' in candidates or any(tag.removeprefix('W/') == etag for tag in candidates)
+        
+        if_modified_since = self.headers.get('If-Modified-Since')
+        if if_modified_since:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError, IndexError, OverflowError):
+                return False
+            return since is not None and int(mtime) <= since.timestamp()
+        return False
+    
+    def copyfile(self, source, outputfile):
+        """发送响应体：内存数据直接写出，文件区间用 os.sendfile 零拷贝发送"""
+        if not isinstance(source, ResponseBody):
+            return super().copyfile(source, outputfile)
+        
+        for piece in source.pieces:
+            if isinstance(piece, bytes):
+                outputfile.write(piece)
+            else:
+                self._send_file_range(source.file, piece[0], piece[1], outputfile)
+    
+    def _send_file_range(self, file, offset, length, outputfile):
+        """发送文件的一个区间；不支持 sendfile 时退回普通复制"""
+        start = offset
+        if hasattr(os, 'sendfile'):
+            outputfile.flush()
+            in_fd, out_fd = file.fileno(), self.connection.fileno()
+            while length > 0:
+                try:
+                    sent = os.sendfile(out_fd, in_fd, offset, length)
+                except OSError:
+                    # 还没发送任何数据时（如套接字不支持 sendfile）退回普通复制
+                    if offset == start:
+                        break
+                    raise
+                if sent == 0:
+                    return
+                offset += sent
+                length -= sent
+        
+        file.seek(offset)
+        while length > 0:
+            chunk = file.read(min(length, 64 * 1024))
+            if not chunk:
+                return
+            outputfile.write(chunk)
+            length -= len(chunk)
+    
     def end_headers(self):
+        # 同一地址按 Accept 返回不同格式，缓存需要区分
+        if getattr(self, '_vary_accept', False):
+            self.send_header('Vary', 'Accept')
         # 添加CORS头
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
@@ -45,14 +366,20 @@ def start_file_server():
     host = os.getenv("FILE_SERVER_HOST", "localhost")
     port = int(os.getenv("FILE_SERVER_PORT", "8740"))
     
-    # 创建服务器
+    # 创建服务器（默认每个连接一个线程，慢速下载不会阻塞其他请求）
     server_address = (host if host != "localhost" else '', port)
-    httpd = HTTPServer(server_address, MediaFileHandler)
+    threaded = os.getenv("FILE_SERVER_THREADED", "true").lower() == "true"
+    server_class = ThreadingHTTPServer if threaded else HTTPServer
+    httpd = server_class(server_address, MediaFileHandler)
     
     print(f"✅ 文件服务器启动成功！")
     print(f"📁 服务目录: {os.getcwd()}")
+    print(f"🧵 并发模式: {'多线程' if threaded else '单线程'}，sendfile: {'启用' if hasattr(os, 'sendfile') else '不可用'}")
     print(f"🌐 访问地址: http://{host}:{port}")
     print(f"🖼️  图片示例: http://{host}:{port}/kb/assets/cases/case4_great_person_digital_human.png")
+    print(f"🖼️  缩略图示例: http://{host}:{port}/kb/assets/cases/case4_great_person_digital_human.png?w=320")
+    if not media_variants.is_available():
+        print("⚠️ 未安装Pillow，图片将按原图返回")
     print(f"🎥 视频示例: http://{host}:{port}/kb/assets/products_tech/mohuman_ai_agent_realistic.mp4")
     print(f"⏹️  按 Ctrl+C 停止服务器")
     
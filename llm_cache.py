@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+大模型响应缓存（默认关闭，LLM_CACHE_ENABLED=true 开启）
+
+键为请求的规范化哈希：上游地址 + 去掉 stream 等传输字段后的请求体（模型、消息、采样参数），
+字段顺序和 0 / 0.0 之类的写法不影响结果。
+只缓存确定性的请求（temperature 为 0 或 top_k 为 1），其他请求需要客户端显式允许（X-LLM-Cache: allow）。
+
+条目写在磁盘上（每个键一个JSON文件，重启后仍然有效），最近使用的条目同时保存在内存LRU中；
+流式响应按原来的分块（每个SSE事件一块）保存，命中时按同样的分块回放
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from chatbot.kb_cache import QueryCache
+
+ENABLED = os.getenv("LLM_CACHE_ENABLED", "false").lower() == "true"
+CACHE_DIR = os.getenv("LLM_CACHE_DIR", "data/llm_cache")
+TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "512"))
+# 单个条目的最大字节数，超长回答不缓存
+MAX_ENTRY_BYTES = int(os.getenv("LLM_CACHE_MAX_ENTRY_BYTES", "262144"))
+
+# 缓存策略（请求头 X-LLM-Cache）：auto 只缓存确定性请求，allow 显式允许，bypass 不读也不写
+CACHE_POLICIES = ('auto', 'allow', 'bypass')
+
+# 只影响传输方式、不影响生成内容的字段，不参与缓存键
+TRANSPORT_FIELDS = ('stream', 'stream_options', 'user')
+
+# 缓存键格式版本，条目结构变化时递增使旧条目失效
+KEY_VERSION = 1
+
+
+def _canonical(value):
+    """规范化JSON值：整数值的浮点数写成整数（0.0 与 0 视为相同）"""
+    if isinstance(value, dict):
+        return {key: _canonical(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_canonical(item) for item in value]
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def cache_key(url: str, request_data: Dict[str, Any]) -> str:
+    """请求的规范化哈希"""
+    body = {key: value for key, value in request_data.items() if key not in TRANSPORT_FIELDS}
+    canonical = json.dumps([KEY_VERSION, url, _canonical(body)], sort_keys=True,
+                           ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_deterministic(request_data: Dict[str, Any]) -> bool:
+    """贪心解码（temperature 为 0 或 top_k 为 1）且只要一个候选时，相同请求的结果相同"""
+    # DashScope 应用接口的采样参数在 parameters 中
+    params = {**request_data.get('parameters', {}), **request_data}
+    if params.get('n', 1) != 1:
+        return False
+    return params.get('temperature') == 0 or params.get('top_k') == 1
+
+
+class ResponseCache:
+    """磁盘 + 内存LRU 的响应缓存（线程安全，网关在线程池中调用读写方法）"""
+
+    def __init__(self, cache_dir: str = CACHE_DIR, ttl: float = TTL,
+                 memory_entries: int = MEMORY_ENTRIES, max_entry_bytes: int = MAX_ENTRY_BYTES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entry_bytes = max_entry_bytes
+        self.memory = QueryCache(max_size=memory_entries, ttl=ttl)
+        self._lock = threading.Lock()
+        self._metrics = {'disk_hits': 0, 'stores': 0, 'too_large': 0, 'uncacheable': 0, 'bypassed': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _count(self, metric: str):
+        with self._lock:
+            self._metrics[metric] += 1
+
+    def skip(self, policy: str):
+        """记录未使用缓存的请求（bypass 或非确定性请求）"""
+        self._count('bypassed' if policy == 'bypass' else 'uncacheable')
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取未过期的条目：先查内存，再查磁盘（命中后放入内存）"""
+        entry = self.memory.get(key)
+        if entry is not None and entry['expires_at'] > time.time():
+            return entry
+
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry.get('expires_at', 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        self._count('disk_hits')
+        self.memory.put(key, entry)
+        return entry
+
+    def put(self, key: str, entry: Dict[str, Any]) -> bool:
+        """
+        写入条目
+
+        Args:
+            entry: {'lines': [SSE事件, ...]}（流式）或 {'response': JSON响应}（非流式）
+        """
+        now = time.time()
+        entry = {**entry, 'created_at': now, 'expires_at': now + self.ttl}
+        data = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        if len(data) > self.max_entry_bytes:
+            self._count('too_large')
+            return False
+
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            # 磁盘写入失败时只保留在内存中
+            print(f"⚠️ 写入大模型响应缓存失败: {e}")
+        self.memory.put(key, entry)
+        self._count('stores')
+        return True
+
+    def prune(self) -> int:
+        """删除磁盘上已过期的条目，返回删除数量"""
+        removed = 0
+        now = time.time()
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        expired = json.load(f).get('expires_at', 0) <= now
+                except (OSError, ValueError):
+                    expired = name.endswith('.tmp')
+                if expired:
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+        return removed
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            metrics = dict(self._metrics)
+        return {'dir': self.cache_dir, 'ttl': self.ttl, 'memory': self.memory.stats(), **metrics}
@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""
+大模型上游网关
+每个上游（豆包 / DashScope）一个长期存在、带连接池的 httpx.AsyncClient，
+对话之间复用已建立的 TCP+TLS 连接；安装了 h2（pip install httpx[http2]）时使用 HTTP/2，
+多个并发流复用同一条连接。
+
+每个上游同时进行的请求数有上限，超出的请求按客户端IP轮流排队（同一IP内先到先得），
+队列已满或排队超时立即返回 429 + Retry-After，而不是把突发流量全部打到上游配额上。
+
+开启响应缓存（llm_cache）时，命中的请求直接回放，不占用上游名额；
+与进行中的请求完全相同（规范化哈希一致）的请求共用那一次上游调用，
+后加入的请求先收到已生成的部分，再接着接收实时生成的内容。
+
+Web服务器的两种模式共用这里的网关：
+- asyncio 模式：直接在 uvicorn 的事件循环中 await
+- 多线程模式：网关运行在一个后台事件循环线程中，请求线程通过 GatewayLoop 提交协程
+"""
+
+import asyncio
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional
+
+import httpx
+
+from llm_cache import ResponseCache, cache_key, is_deterministic
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+PROVIDERS = ('doubao', 'dashscope')
+
+# 连接池：每个上游的最大连接数、保持空闲连接数、空闲连接保留时间（秒）
+MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+USE_HTTP2 = HTTP2_AVAILABLE and os.getenv("LLM_HTTP2", "true").lower() == "true"
+
+# 并发控制：每个上游同时进行的请求数（可用 LLM_<上游>_MAX_IN_FLIGHT 单独设置），
+# 排队总数、单个客户端排队数、最长排队时间（秒）
+MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "16"))
+MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "200"))
+MAX_QUEUE_PER_CLIENT = int(os.getenv("LLM_MAX_QUEUE_PER_CLIENT", "8"))
+MAX_QUEUE_WAIT = float(os.getenv("LLM_MAX_QUEUE_WAIT", "15"))
+
+# 排队时间统计的样本窗口
+WAIT_SAMPLES = 1024
+
+# 流式响应的结束事件
+STREAM_DONE = "data: [DONE]\n\n"
+
+# 合并进行中的相同请求（同一时刻多人问同一个问题时只调用一次上游）
+COALESCE = os.getenv("LLM_COALESCE", "true").lower() == "true"
+
+
+def provider_endpoint(provider: str) -> Dict[str, Any]:
+    """上游地址、请求头和超时（每次读取环境变量，便于修改 .env 后重启生效）"""
+    if provider == 'doubao':
+        base_url = os.getenv("DOUBAO_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
+        return {
+            'url': f"{base_url}/chat/completions",
+            'headers': {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {os.getenv('DOUBAO_API_KEY')}"
+            },
+            'timeout': 60.0
+        }
+    if provider == 'dashscope':
+        return {
+            'url': f"https://dashscope.aliyuncs.com/api/v1/apps/{os.getenv('DASHSCOPE_APP_ID')}/completion",
+            'headers': {
+                "Content-Type": "application/json",
+                "Authorization": f"Bearer {os.getenv('DASHSCOPE_API_KEY')}"
+            },
+            'timeout': 30.0
+        }
+    raise ValueError(f"未知的大模型上游: {provider}，可选: {', '.join(PROVIDERS)}")
+
+
+class GatewayOverloaded(Exception):
+    """上游并发已满且无法排队（队列已满或排队超时），应返回 429"""
+
+    def __init__(self, provider: str, reason: str, retry_after: int):
+        super().__init__(f"{provider} 上游繁忙（{reason}），请 {retry_after} 秒后重试")
+        self.provider = provider
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def client_key(peer_ip: str, forwarded_for: Optional[str] = None) -> str:
+    """
+    排队公平性使用的客户端标识
+
+    只有来自本机反向代理（Nginx）的请求才采用 X-Forwarded-For 中最后一跳的地址，
+    其他来源的该请求头可以伪造，直接使用对端地址
+    """
+    if forwarded_for:
+        try:
+            trusted = ipaddress.ip_address(peer_ip).is_loopback
+        except ValueError:
+            trusted = False
+        if trusted:
+            return forwarded_for.split(',')[-1].strip() or peer_ip
+    return peer_ip
+
+
+class ConcurrencyLimiter:
+    """
+    单个上游的并发上限 + 公平排队
+
+    空闲时直接放行；满载时请求进入所属客户端的FIFO队列，
+    释放名额时按客户端轮流唤醒（每个客户端一次一个），一个客户端的大量请求不会饿死其他人。
+    所有方法都在同一个事件循环中调用，不需要加锁
+    """
+
+    def __init__(self, provider: str, limit: int, max_queue: int = MAX_QUEUE,
+                 max_queue_per_client: int = MAX_QUEUE_PER_CLIENT, max_wait: float = MAX_QUEUE_WAIT):
+        self.provider = provider
+        self.limit = max(1, limit)
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.max_wait = max_wait
+        self._in_flight = 0
+        self._waiting = 0
+        # 客户端 -> 等待中的Future；字典顺序即轮转顺序
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._waits: Deque[float] = deque(maxlen=WAIT_SAMPLES)
+        self._avg_hold = 1.0
+        self._metrics = {'admitted': 0, 'queued': 0, 'rejected_queue_full': 0,
+                         'rejected_timeout': 0, 'peak_queue_depth': 0}
+
+    def retry_after(self) -> int:
+        """按当前排队长度和平均占用时长估算的重试等待秒数"""
+        estimate = self._avg_hold * (self._waiting + 1) / self.limit
+        return max(1, min(math.ceil(estimate), math.ceil(self.max_wait) or 1))
+
+    def _reject(self, reason: str):
+        self._metrics[f'rejected_{reason}'] += 1
+        raise GatewayOverloaded(self.provider, '排队已满' if reason == 'queue_full' else '排队超时',
+                                self.retry_after())
+
+    async def acquire(self, client: str):
+        if self._in_flight < self.limit and not self._waiting:
+            self._in_flight += 1
+            self._metrics['admitted'] += 1
+            self._waits.append(0.0)
+            return
+
+        queue = self._queues.get(client)
+        if self._waiting >= self.max_queue or (queue is not None and len(queue) >= self.max_queue_per_client):
+            self._reject('queue_full')
+
+        future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[client] = deque()
+        queue.append(future)
+        self._waiting += 1
+        self._metrics['queued'] += 1
+        self._metrics['peak_queue_depth'] = max(self._metrics['peak_queue_depth'], self._waiting)
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(future, self.max_wait)
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 名额刚分配到就放弃了，转给下一个
+                self._release()
+            else:
+                self._discard(client, future)
+            if isinstance(e, asyncio.TimeoutError):
+                self._reject('timeout')
+            raise
+        self._metrics['admitted'] += 1
+        self._waits.append(time.monotonic() - started)
+
+    def _discard(self, client: str, future: asyncio.Future):
+        queue = self._queues.get(client)
+        if queue is not None and future in queue:
+            queue.remove(future)
+            self._waiting -= 1
+            if not queue:
+                del self._queues[client]
+
+    def _release(self):
+        self._in_flight -= 1
+        while self._in_flight < self.limit and self._queues:
+            client, queue = self._queues.popitem(last=False)
+            future = queue.popleft()
+            self._waiting -= 1
+            if queue:
+                # 该客户端还有请求在排队，排到轮转末尾
+                self._queues[client] = queue
+            if not future.done():
+                self._in_flight += 1
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, client: str):
+        """占用一个上游名额直到退出（流式请求在整个流结束后才释放）"""
+        await self.acquire(client)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self._avg_hold = 0.8 * self._avg_hold + 0.2 * (time.monotonic() - started)
+            self._release()
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+        return {
+            'limit': self.limit,
+            'in_flight': self._in_flight,
+            'queue_depth': self._waiting,
+            'queued_clients': len(self._queues),
+            **self._metrics,
+            'wait_ms': {
+                'avg': round(sum(waits) / len(waits) * 1000, 1) if waits else 0.0,
+                'p95': round(waits[int(len(waits) * 0.95)] * 1000, 1) if waits else 0.0,
+                'max': round(waits[-1] * 1000, 1) if waits else 0.0
+            },
+            'avg_hold_s': round(self._avg_hold, 3)
+        }
+
+
+class SharedStream:
+    """
+    一次上游流式调用的扇出缓冲
+
+    上游的每个事件追加到缓冲区并唤醒所有订阅者；每个订阅者从头读取，
+    中途加入的订阅者先回放已缓冲的前缀，再接着接收实时事件。
+    所有订阅者都断开时取消上游调用
+    """
+
+    def __init__(self):
+        self.lines: List[str] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._updated = asyncio.Event()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def append(self, line: str):
+        self.lines.append(line)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None):
+        self.done = True
+        self.error = error
+        self._notify()
+
+    async def subscribe(self) -> AsyncIterator[str]:
+        self.subscribers += 1
+        position = 0
+        try:
+            while True:
+                if position < len(self.lines):
+                    position += 1
+                    yield self.lines[position - 1]
+                elif self.error is not None:
+                    raise self.error
+                elif self.done:
+                    return
+                else:
+                    await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self.task.cancel()
+
+
+class LLMGateway:
+    """按上游复用连接池的大模型客户端（客户端绑定在首次使用它的事件循环上）"""
+
+    def __init__(self, cache: Optional[ResponseCache] = None, coalesce: bool = COALESCE):
+        self.cache = cache
+        self.coalesce = coalesce
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._metrics = {provider: {'requests': 0, 'streams': 0, 'errors': 0, 'coalesced': 0}
+                         for provider in PROVIDERS}
+        self.limiters = {
+            provider: ConcurrencyLimiter(
+                provider, int(os.getenv(f"LLM_{provider.upper()}_MAX_IN_FLIGHT", str(MAX_IN_FLIGHT)))
+            )
+            for provider in PROVIDERS
+        }
+        # 进行中的上游调用（合并键 -> 非流式调用的Task / 流式调用的扇出缓冲）
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, SharedStream] = {}
+
+    def client(self, provider: str) -> httpx.AsyncClient:
+        client = self._clients.get(provider)
+        if client is None:
+            endpoint = provider_endpoint(provider)
+            client = httpx.AsyncClient(
+                http2=USE_HTTP2,
+                timeout=endpoint['timeout'],
+                limits=httpx.Limits(
+                    max_connections=MAX_CONNECTIONS,
+                    max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=KEEPALIVE_EXPIRY
+                )
+            )
+            self._clients[provider] = client
+        return client
+
+    def _cache_key(self, url: str, request_data: Dict[str, Any], cache_policy: str) -> Optional[str]:
+        """可以使用缓存时返回缓存键，否则返回 None"""
+        if self.cache is None:
+            return None
+        if cache_policy == 'bypass' or (cache_policy != 'allow' and not is_deterministic(request_data)):
+            self.cache.skip(cache_policy)
+            return None
+        return cache_key(url, request_data)
+
+    def _coalesce_key(self, provider: str, url: str, request_data: Dict[str, Any],
+                      cache_policy: str, key: Optional[str]) -> Optional[str]:
+        """可以与进行中的相同请求合并时返回合并键（与缓存键相同的规范化哈希）"""
+        if not self.coalesce or cache_policy == 'bypass':
+            return None
+        return key or cache_key(url, request_data)
+
+    async def complete(self, provider: str, request_data: Dict[str, Any], client_id: str = '',
+                       cache_policy: str = 'auto') -> Dict[str, Any]:
+        """
+        非流式调用，返回上游的JSON响应；上游繁忙时抛出 GatewayOverloaded
+
+        与进行中的相同请求共用一次上游调用
+        """
+        endpoint = provider_endpoint(provider)
+        key = self._cache_key(endpoint['url'], request_data, cache_policy)
+        if key is not None:
+            entry = await asyncio.to_thread(self.cache.get, key)
+            if entry is not None and 'response' in entry:
+                return entry['response']
+
+        flight = self._coalesce_key(provider, endpoint['url'], request_data, cache_policy, key)
+        if flight is None:
+            return await self._complete_upstream(provider, endpoint, request_data, client_id, key)
+
+        task = self._calls.get(flight)
+        if task is None:
+            task = asyncio.create_task(self._complete_upstream(provider, endpoint, request_data, client_id, key))
+            self._calls[flight] = task
+            task.add_done_callback(lambda _: self._calls.pop(flight, None))
+        else:
+            self._metrics[provider]['coalesced'] += 1
+        # 一个调用方断开不影响共用同一调用的其他人
+        return await asyncio.shield(task)
+
+    async def _complete_upstream(self, provider: str, endpoint: Dict[str, Any], request_data: Dict[str, Any],
+                                 client_id: str, key: Optional[str]) -> Dict[str, Any]:
+        async with self.limiters[provider].slot(client_id):
+            self._metrics[provider]['requests'] += 1
+            try:
+                response = await self.client(provider).post(endpoint['url'], headers=endpoint['headers'], json=request_data)
+                response.raise_for_status()
+                result = response.json()
+            except Exception:
+                self._metrics[provider]['errors'] += 1
+                raise
+
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, {'response': result})
+        return result
+
+    async def stream(self, provider: str, request_data: Dict[str, Any], client_id: str = '',
+                     cache_policy: str = 'auto') -> AsyncIterator[str]:
+        """
+        流式调用，上游每到一行SSE数据就产出一行（"data: ...\\n\\n"）
+
+        上游繁忙（GatewayOverloaded）或返回错误状态时在产出第一行之前抛出异常；
+        调用方提前关闭生成器时上游连接和并发名额随之释放。
+        缓存命中时按原来的分块回放；只有完整结束（收到 [DONE]）的流才写入缓存。
+        与进行中的相同请求共用一次上游调用（SharedStream 扇出），X-LLM-Cache: bypass 时单独调用
+        """
+        endpoint = provider_endpoint(provider)
+        key = self._cache_key(endpoint['url'], request_data, cache_policy)
+        if key is not None:
+            entry = await asyncio.to_thread(self.cache.get, key)
+            if entry is not None and 'lines' in entry:
+                for line in entry['lines']:
+                    yield line
+                return
+
+        flight = self._coalesce_key(provider, endpoint['url'], request_data, cache_policy, key)
+        if flight is None:
+            lines = self._stream_upstream(provider, endpoint, request_data, client_id, key)
+            try:
+                async for line in lines:
+                    yield line
+            finally:
+                await lines.aclose()
+            return
+
+        shared = self._streams.get(flight)
+        if shared is None:
+            shared = SharedStream()
+            self._streams[flight] = shared
+            upstream = self._stream_upstream(provider, endpoint, request_data, client_id, key)
+            shared.task = asyncio.create_task(self._fan_out(flight, shared, upstream))
+        else:
+            self._metrics[provider]['coalesced'] += 1
+
+        lines = shared.subscribe()
+        try:
+            async for line in lines:
+                yield line
+        finally:
+            await lines.aclose()
+            if shared.subscribers == 0 and not shared.done and self._streams.get(flight) is shared:
+                # 所有订阅者都已断开（上游调用随之取消），后来的相同请求重新发起调用
+                del self._streams[flight]
+
+    async def _fan_out(self, flight: str, shared: SharedStream, upstream: AsyncIterator[str]):
+        """读取上游流写入扇出缓冲，结束（或出错）后从进行中的调用中移除"""
+        try:
+            async for line in upstream:
+                shared.append(line)
+            shared.finish()
+        except asyncio.CancelledError:
+            shared.finish(ConnectionAbortedError("上游流式调用已取消"))
+            raise
+        except Exception as e:
+            shared.finish(e)
+        finally:
+            if self._streams.get(flight) is shared:
+                del self._streams[flight]
+            await upstream.aclose()
+
+    async def _stream_upstream(self, provider: str, endpoint: Dict[str, Any], request_data: Dict[str, Any],
+                               client_id: str, key: Optional[str]) -> AsyncIterator[str]:
+        lines = [] if key is not None else None
+        async with self.limiters[provider].slot(client_id):
+            self._metrics[provider]['streams'] += 1
+            try:
+                async with self.client(provider).stream(
+                    "POST", endpoint['url'], headers=endpoint['headers'], json=request_data
+                ) as response:
+                    response.raise_for_status()
+                    async for line in response.aiter_lines():
+                        if line.startswith("data: "):
+                            chunk = line + "\n\n"
+                            if lines is not None:
+                                lines.append(chunk)
+                            yield chunk
+            except (httpx.HTTPError, OSError):
+                self._metrics[provider]['errors'] += 1
+                raise
+
+        if lines and lines[-1] == STREAM_DONE:
+            await asyncio.to_thread(self.cache.put, key, {'lines': lines})
+
+    async def aclose(self):
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            await client.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            'http2': USE_HTTP2,
+            'max_connections': MAX_CONNECTIONS,
+            'cache': self.cache.stats() if self.cache is not None else None,
+            'coalesce': self.coalesce,
+            'shared_streams': len(self._streams),
+            'shared_subscribers': sum(shared.subscribers for shared in self._streams.values()),
+            'providers': {
+                provider: {**metrics, 'limiter': self.limiters[provider].stats()}
+                for provider, metrics in self._metrics.items()
+            }
+        }
+
+
+class GatewayLoop:
+    """多线程模式下承载网关的后台事件循环；请求线程同步等待协程结果"""
+
+    def __init__(self, gateway: LLMGateway):
+        self.gateway = gateway
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name='llm-gateway', daemon=True)
+        self._thread.start()
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """在网关事件循环中执行协程并等待结果"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def next(self, lines: AsyncIterator[str]) -> Optional[str]:
+        """取异步生成器的下一项，结束时返回 None"""
+        return self.run(next_item(lines))
+
+    def close(self):
+        self.run(self.gateway.aclose())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+
+async def next_item(iterator):
+    try:
+        return await iterator.__anext__()
+    except StopAsyncIteration:
+        return None
@@ -234,6 +234,15 @@ async def chat_stream(request: ChatRequest, client_request: Request):
     
     return StreamingResponse(generate_response(), media_type="text/plain")
 
+@app.get("/kb/stats")
+async def kb_stats():
+    """知识库检索执行器与缓存指标"""
+    return knowledge_base.search_stats()
+
+@app.on_event("shutdown")
+async def shutdown():
+    knowledge_base.close()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
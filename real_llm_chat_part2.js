@@ -22,6 +22,7 @@ const DASHSCOPE_CONFIG = AppConfig ? AppConfig.getDashScopeConfig() : {
 const SERVER_CONFIG = AppConfig ? AppConfig.getServerConfig() : {
     kbServer: 'http://localhost:8739',
     fileServer: 'http://localhost:8740',
+    mediaServer: 'http://localhost:8740',
     mainServer: 'http://localhost:8741'
 };
 
@@ -58,10 +59,16 @@ function addMessage(content, isUser = false, mediaFiles = null) {
             
             if (media.type === 'image') {
                 const img = document.createElement('img');
-                img.src = media.path;
+                img.src = media.thumb || media.path;
                 img.alt = media.caption;
                 img.onclick = () => openModal(media.path);
                 img.onerror = function() {
+                    // 缩略图加载失败时改用原图（只回退一次）
+                    if (media.thumb && !img.dataset.fallback) {
+                        img.dataset.fallback = '1';
+                        img.src = media.path;
+                        return;
+                    }
                     console.error('图片加载失败:', media.path);
                 };
                 img.onload = function() {
@@ -234,9 +241,14 @@ async function streamLLMResponse(messages, targetElement, mediaFiles = []) {
                 
                 if (media.type === 'image') {
                     const img = document.createElement('img');
-                    img.src = media.path;
+                    img.src = media.thumb || media.path;
                     img.alt = media.caption;
                     img.onclick = () => openModal(media.path);
+                    // 缩略图加载失败时改用原图
+                    img.onerror = () => {
+                        img.onerror = null;
+                        if (media.thumb) img.src = media.path;
+                    };
                     mediaItem.appendChild(img);
                 } else if (media.type === 'video') {
                     const video = document.createElement('video');
@@ -316,6 +328,7 @@ async function sendMessage() {
                         mediaFiles.push({
                             type: media.type,
                             path: `${SERVER_CONFIG.fileServer}/${media.path}`,
+                            thumb: media.url ? `${SERVER_CONFIG.mediaServer}/${media.url}` : null,
                             caption: media.caption
                         });
                     });
@@ -1,52 +1,144 @@
 #!/usr/bin/env python3
 """
 简化的知识库API服务器
+
+- 默认多线程（每个连接一个线程），支持 HTTP/1.1 keep-alive
+- KB_SERVER_PROCESSES > 1 时预先fork多个工作进程共享同一个监听端口，
+  知识库在fork前加载一次，各进程以写时复制方式共享只读索引
+- 访问日志为结构化的单行JSON，按比例采样；错误和慢请求总是记录
 """
 
 import asyncio
+import hmac
+import ipaddress
 import json
+import random
+import signal
+import time
 from typing import Dict, Any
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import HTTPServer, ThreadingHTTPServer, BaseHTTPRequestHandler
 from urllib.parse import urlparse, parse_qs
 import threading
 import sys
 import os
 
+from dotenv import load_dotenv
+
 # 添加项目根目录到Python路径
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from chatbot.kb_loader import MogineKBLoader
+# 加载环境变量（Config 和本模块的配置在导入时读取环境变量，需在 load_dotenv 之后导入）
+load_dotenv()
+
+from chatbot.kb_loader import MogineKBLoader, BATCH_MODES
+from chatbot.kb_suggest import SuggestService
+from config import Config
+
+# 访问日志采样率（0~1），以及总是记录的慢请求阈值
+LOG_SAMPLE_RATE = float(os.getenv("KB_SERVER_LOG_SAMPLE_RATE", "0.01"))
+SLOW_REQUEST_MS = float(os.getenv("KB_SERVER_SLOW_REQUEST_MS", "200"))
+
+# 日志中查询文本的最大长度
+LOG_QUERY_CHARS = 50
+
+# 批量检索：单次请求的查询数上限、单条查询的 top_k 上限
+BATCH_MAX_QUERIES = int(os.getenv("KB_BATCH_MAX_QUERIES", "256"))
+BATCH_MAX_TOP_K = 50
+
+# 流式检索的 top_k 上限（流式模式不缓存结果，内存与 top_k 无关，允许远大于普通查询）
+STREAM_MAX_TOP_K = 1000
+
+# 输入联想单次返回的候选数上限
+SUGGEST_MAX_LIMIT = 20
+
+# POST /api/reload 的口令（请求头 X-Reload-Token）；未配置时只接受本机直接发起、非浏览器的请求
+RELOAD_TOKEN = os.getenv("KB_RELOAD_TOKEN", "")
+
+# 经过反向代理或由浏览器发起的请求带有这些请求头，不能视为本机请求
+NON_LOCAL_HEADERS = ('X-Forwarded-For', 'X-Real-IP', 'Forwarded', 'Origin')
+
+CORS_HEADERS = [
+    ('Access-Control-Allow-Origin', '*'),
+    ('Access-Control-Allow-Methods', 'GET, POST, OPTIONS'),
+    ('Access-Control-Allow-Headers', 'Content-Type'),
+]
+
+
+class StaticResponses:
+    """内容只随知识库版本变化的接口，预先序列化为字节，按版本缓存"""
+    
+    def __init__(self, kb_loader):
+        self.kb_loader = kb_loader
+        self._lock = threading.Lock()
+        self._cache: Dict[str, tuple] = {}
+    
+    def get(self, name: str, build) -> bytes:
+        version = self.kb_loader.version
+        cached = self._cache.get(name)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        body = json.dumps(build(), ensure_ascii=False).encode('utf-8')
+        with self._lock:
+            self._cache[name] = (version, body)
+        return body
+
 
 class KnowledgeBaseHandler(BaseHTTPRequestHandler):
     """知识库API处理器"""
     
-    def __init__(self, *args, kb_loader=None, **kwargs):
+    # HTTP/1.1：连接默认保持，每个响应都必须带 Content-Length
+    protocol_version = 'HTTP/1.1'
+    # 响应头和正文分两次写出，关闭Nagle算法避免与延迟ACK叠加出现40ms停顿
+    disable_nagle_algorithm = True
+    
+    def __init__(self, *args, kb_loader=None, static_responses=None, suggest_service=None, **kwargs):
         self.kb_loader = kb_loader
+        self.static_responses = static_responses
+        self.suggest_service = suggest_service
+        self._log_fields = {}
         super().__init__(*args, **kwargs)
     
+    def handle_one_request(self):
+        """处理一个请求并记录结构化访问日志"""
+        self._started_at = time.perf_counter()
+        self._status = None
+        self._body_size = 0
+        self._log_fields = {}
+        super().handle_one_request()
+        if self._status is not None:
+            self._log_access()
+    
+    def parse_request(self):
+        # 从读到请求行开始计时（keep-alive 连接上等待下一个请求的时间不计入）
+        self._started_at = time.perf_counter()
+        return super().parse_request()
+    
     def do_GET(self):
         """处理GET请求"""
         parsed_path = urlparse(self.path)
         
-        # 设置CORS头
-        self.send_response(200)
-        self.send_header('Content-type', 'application/json; charset=utf-8')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
-        
         if parsed_path.path == '/api/search':
             # 搜索知识库
             query_params = parse_qs(parsed_path.query, encoding='utf-8')
             query = query_params.get('q', [''])[0]
-            top_k = int(query_params.get('top_k', ['3'])[0])
+            try:
+                top_k = int(query_params.get('top_k', ['3'])[0])
+            except ValueError:
+                top_k = 3
+            
+            self._log_fields['query'] = query[:LOG_QUERY_CHARS]
+            self._log_fields['top_k'] = top_k
             
-            print(f"收到搜索请求: {query}")
-            print(f"查询参数: {query_params}")
+            # 流式模式：?stream=1 或 Accept: application/x-ndjson，每条结果一行JSON
+            stream = query_params.get('stream', ['0'])[0] in ('1', 'true') or \
+                'application/x-ndjson' in (self.headers.get('Accept') or '')
+            if query and stream:
+                self._stream_search(query, top_k)
+                return
             
             if query:
                 results = self.kb_loader.search_knowledge(query, top_k)
+                self._log_fields['hits'] = len(results)
                 response = {
                     'success': True,
                     'query': query,
@@ -60,71 +152,388 @@ class KnowledgeBaseHandler(BaseHTTPRequestHandler):
                     'results': []
                 }
             
-            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+            self._send_json(200, response)
+        
+        elif parsed_path.path == '/api/suggest':
+            # 输入联想（每次按键调用，只做前缀查找，不执行检索）
+            query_params = parse_qs(parsed_path.query, encoding='utf-8')
+            prefix = query_params.get('prefix', [''])[0]
+            try:
+                limit = min(max(int(query_params.get('limit', ['8'])[0]), 1), SUGGEST_MAX_LIMIT)
+            except ValueError:
+                limit = 8
             
-        elif parsed_path.path == '/api/company_info':
-            # 获取公司信息
-            company_info = self.kb_loader.get_company_info()
-            assistant_info = self.kb_loader.get_assistant_info()
+            suggestions = self.suggest_service.suggest(prefix, limit)
+            self._log_fields['prefix'] = prefix[:LOG_QUERY_CHARS]
+            response = {
+                'success': True,
+                'prefix': prefix,
+                'suggestions': suggestions
+            }
             
+            self._send_json(200, response)
+        
+        elif parsed_path.path == '/api/cache_stats':
+            # 查询缓存统计
             response = {
                 'success': True,
-                'company_info': company_info,
-                'assistant_info': assistant_info
+                'cache': self.kb_loader.cache_stats(),
+                'pid': os.getpid()
             }
             
-            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8'))
+            self._send_json(200, response)
+        
+        elif parsed_path.path == '/api/company_info':
+            # 获取公司信息（内容只随知识库版本变化，直接返回预先序列化的字节）
+            body = self.static_responses.get('company_info', lambda: {
+                'success': True,
+                'company_info': self.kb_loader.get_company_info(),
+                'assistant_info': self.kb_loader.get_assistant_info()
+            })
+            
+            self._send_body(200, body)
+        
+        else:
+            self._send_not_found()
+    
+    def do_POST(self):
+        """处理POST请求"""
+        parsed_path = urlparse(self.path)
+        # 先读完请求体，keep-alive 连接上的下一个请求才能正确解析
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+            if content_length < 0:
+                raise ValueError(content_length)
+        except ValueError:
+            # 无法确定请求体的边界，回复后关闭连接
+            self.close_connection = True
+            self._send_json(400, {'success': False, 'error': 'Invalid Content-Length'})
+            return
+        body = self.rfile.read(content_length) if content_length > 0 else b''
+        
+        if parsed_path.path == '/api/reload':
+            if not self._reload_allowed():
+                self._send_json(403, {'success': False, 'error': 'Reload not allowed'})
+                return
+            # 重新加载知识库（增量更新索引，进行中的查询不受影响）
+            try:
+                stats = self.kb_loader.reload()
+                status, response = 200, {'success': True, **stats}
+                # 多进程模式下通知主进程，由主进程转发给其他工作进程
+                if self.server.prefork:
+                    os.kill(os.getppid(), signal.SIGHUP)
+            except Exception as e:
+                print(f"❌ 重新加载知识库失败: {e}")
+                status, response = 500, {'success': False, 'error': 'Reload failed'}
             
+            self._send_json(status, response)
+        
+        elif parsed_path.path == '/api/search/batch':
+            self.handle_search_batch(body)
         else:
-            # 404
-            self.send_response(404)
-            self.end_headers()
-            self.wfile.write(b'Not Found')
+            self._send_not_found()
+    
+    def _reload_allowed(self) -> bool:
+        """
+        重新加载会让所有工作进程重建索引，不对外开放：
+        配置了 KB_RELOAD_TOKEN 时校验口令，否则只接受本机直接发起的请求
+        （经反向代理转发或浏览器跨站发起的请求即使来自本机也拒绝）
+        """
+        if RELOAD_TOKEN:
+            return hmac.compare_digest(self.headers.get('X-Reload-Token', '').encode('utf-8'), RELOAD_TOKEN.encode('utf-8'))
+        if any(self.headers.get(name) for name in NON_LOCAL_HEADERS):
+            return False
+        try:
+            return ipaddress.ip_address(self.client_address[0]).is_loopback
+        except ValueError:
+            return False
+    
+    def handle_search_batch(self, body: bytes):
+        """
+        批量搜索：一次请求执行多条查询
+        
+        请求体: {"queries": ["查询", {"q": "查询", "top_k": 5, "filters": {"type": "content"}}],
+                 "top_k": 3, "filters": {...}, "mode": "exact" | "tfidf"}
+        外层的 top_k / filters 作为每条查询的默认值
+        """
+        try:
+            requests, mode = self._parse_batch(json.loads(body.decode('utf-8') or '{}'))
+        except (ValueError, TypeError, AttributeError) as e:
+            self._send_json(400, {'success': False, 'error': f'Invalid batch request: {e}', 'results': []})
+            return
+        
+        self._log_fields['queries'] = len(requests)
+        self._log_fields['mode'] = mode
+        
+        try:
+            batch_results = self.kb_loader.search_batch(requests, mode)
+        except ValueError as e:
+            # 过滤条件不合法
+            self._send_json(400, {'success': False, 'error': str(e), 'results': []})
+            return
+        
+        response = {
+            'success': True,
+            'mode': mode,
+            'total_queries': len(requests),
+            'results': [
+                {'query': request['q'], 'results': results, 'total_found': len(results)}
+                for request, results in zip(requests, batch_results)
+            ]
+        }
+        self._send_json(200, response)
+    
+    def _parse_batch(self, body):
+        """校验批量请求，返回 ([{'q', 'top_k', 'filters'}], 模式)"""
+        queries = body.get('queries')
+        if not isinstance(queries, list) or not queries:
+            raise ValueError('queries must be a non-empty list')
+        if len(queries) > BATCH_MAX_QUERIES:
+            raise ValueError(f'too many queries ({len(queries)} > {BATCH_MAX_QUERIES})')
+        
+        mode = body.get('mode', 'exact')
+        if mode not in BATCH_MODES:
+            raise ValueError(f"mode must be one of {', '.join(BATCH_MODES)}")
+        default_top_k = int(body.get('top_k', 3))
+        default_filters = body.get('filters') or {}
+        
+        requests = []
+        for item in queries:
+            if isinstance(item, str):
+                item = {'q': item}
+            query = item.get('q')
+            if not isinstance(query, str) or not query.strip():
+                raise ValueError('each query needs a non-empty "q"')
+            top_k = int(item.get('top_k', default_top_k))
+            if not 0 < top_k <= BATCH_MAX_TOP_K:
+                raise ValueError(f'top_k must be between 1 and {BATCH_MAX_TOP_K}')
+            filters = item.get('filters', default_filters)
+            if not isinstance(filters, dict):
+                raise ValueError('filters must be an object')
+            requests.append({'q': query, 'top_k': top_k, 'filters': filters})
+        return requests, mode
     
     def do_OPTIONS(self):
         """处理OPTIONS请求（CORS预检）"""
+        self._send_body(200, b'')
+    
+    def _stream_search(self, query: str, top_k: int):
+        """
+        以 NDJSON 流式返回检索结果
+        
+        排名确定后每构建好一条结果就写出一行，最后一行为 {"done": true, "query", "total_found"}；
+        HTTP/1.1 使用分块传输，HTTP/1.0 写完后关闭连接
+        """
+        top_k = min(max(top_k, 1), STREAM_MAX_TOP_K)
+        chunked = self.request_version != 'HTTP/1.0'
+        
         self.send_response(200)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Content-type', 'application/x-ndjson; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        if chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.close_connection = True
+            self.send_header('Connection', 'close')
+        for name, value in CORS_HEADERS:
+            self.send_header(name, value)
+        self.end_headers()
+        self._status = 200
+        
+        def write_line(record):
+            line = json.dumps(record, ensure_ascii=False).encode('utf-8') + b'\n'
+            if chunked:
+                line = f"{len(line):x}\r\n".encode('ascii') + line + b'\r\n'
+            self.wfile.write(line)
+            self._body_size += len(line)
+        
+        total_found = 0
+        for result in self.kb_loader.iter_search(query, top_k):
+            write_line(result)
+            total_found += 1
+        write_line({'done': True, 'query': query, 'total_found': total_found})
+        if chunked:
+            self.wfile.write(b'0\r\n\r\n')
+        
+        self._log_fields['hits'] = total_found
+        self._log_fields['stream'] = True
+    
+    def _send_json(self, status: int, response: Dict[str, Any]):
+        self._send_body(status, json.dumps(response, ensure_ascii=False).encode('utf-8'))
+    
+    def _send_not_found(self):
+        self._send_body(404, b'Not Found', content_type='text/plain; charset=utf-8')
+    
+    def _send_body(self, status: int, body: bytes, content_type: str = 'application/json; charset=utf-8'):
+        """发送完整响应（带 Content-Length，连接可以继续复用）"""
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in CORS_HEADERS:
+            self.send_header(name, value)
         self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+        self._status = status
+        self._body_size = len(body)
+    
+    def send_error(self, code, message=None, explain=None):
+        self._status = code
+        super().send_error(code, message, explain)
+    
+    def log_request(self, code='-', size='-'):
+        """访问日志由 _log_access 统一记录"""
+    
+    def _log_access(self):
+        """结构化访问日志：按采样率记录，错误和慢请求总是记录"""
+        elapsed_ms = (time.perf_counter() - self._started_at) * 1000
+        if self._status < 500 and elapsed_ms < SLOW_REQUEST_MS and random.random() >= LOG_SAMPLE_RATE:
+            return
+        record = {
+            'ts': round(time.time(), 3),
+            'pid': os.getpid(),
+            'client': self.client_address[0],
+            'method': self.command,
+            'path': urlparse(getattr(self, 'path', '')).path,
+            'status': self._status,
+            'ms': round(elapsed_ms, 2),
+            'bytes': self._body_size,
+            **self._log_fields
+        }
+        if LOG_SAMPLE_RATE < 1 and self._status < 500 and elapsed_ms < SLOW_REQUEST_MS:
+            record['sample_rate'] = LOG_SAMPLE_RATE
+        print(json.dumps(record, ensure_ascii=False), flush=True)
     
     def log_message(self, format, *args):
         """自定义日志格式"""
         print(f"[{self.address_string()}] {format % args}")
 
-def create_handler(kb_loader):
+class KnowledgeBaseServer(ThreadingHTTPServer):
+    """多线程知识库服务器（每个连接一个线程，共享同一个只读的知识库加载器）"""
+    
+    request_queue_size = 128
+    prefork = False
+
+class SingleThreadKnowledgeBaseServer(HTTPServer):
+    """单线程知识库服务器（KB_SERVER_THREADED=false）"""
+    
+    request_queue_size = 128
+    prefork = False
+
+def create_handler(kb_loader, suggest_service):
     """创建处理器工厂函数"""
+    static_responses = StaticResponses(kb_loader)
     def handler(*args, **kwargs):
-        return KnowledgeBaseHandler(*args, kb_loader=kb_loader, **kwargs)
+        return KnowledgeBaseHandler(*args, kb_loader=kb_loader, static_responses=static_responses,
+                                    suggest_service=suggest_service, **kwargs)
     return handler
 
+def run_prefork(httpd, kb_loader, processes: int):
+    """
+    预先fork多个工作进程，在同一个监听套接字上接受连接
+    
+    主进程只负责监督：工作进程异常退出时重新fork；收到 SIGHUP（某个工作进程执行了
+    /api/reload）时转发给所有工作进程，各自重新加载知识库
+    """
+    httpd.prefork = True
+    workers = set()
+    stopping = False
+    # 加载器的文件监听线程不会被fork到子进程，需要在子进程中重新启动
+    watch_interval = Config.KB_WATCH_INTERVAL
+    
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGHUP, lambda *_: threading.Thread(target=kb_loader.reload, daemon=True).start())
+            if watch_interval > 0:
+                kb_loader.start_watcher(watch_interval)
+            try:
+                httpd.serve_forever()
+            finally:
+                os._exit(0)
+        workers.add(pid)
+    
+    def forward_reload(signum, frame):
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+    
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    
+    signal.signal(signal.SIGHUP, forward_reload)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    
+    for _ in range(processes):
+        spawn()
+    print(f"👷 已启动 {processes} 个工作进程: {', '.join(str(pid) for pid in sorted(workers))}")
+    
+    while workers:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        workers.discard(pid)
+        if not stopping:
+            print(f"⚠️ 工作进程 {pid} 已退出（状态 {status}），重新启动")
+            spawn()
+    httpd.server_close()
+
 def start_server():
     """启动服务器"""
     print("🚀 启动摩泛知识库API服务器...")
     
-    # 加载环境变量
-    from dotenv import load_dotenv
-    load_dotenv()
-    
-    # 初始化知识库
-    kb_loader = MogineKBLoader()
-    
     # 从环境变量获取配置
     host = os.getenv("KB_SERVER_HOST", "localhost")
     port = int(os.getenv("KB_SERVER_PORT", "8739"))
+    threaded = os.getenv("KB_SERVER_THREADED", "true").lower() == "true"
+    processes = int(os.getenv("KB_SERVER_PROCESSES", "1"))
+    if processes > 1 and not hasattr(os, 'fork'):
+        print("⚠️ 当前平台不支持fork，使用单进程模式")
+        processes = 1
+    
+    # 初始化知识库（多进程模式下在fork前加载，工作进程共享只读索引；文件监听由各工作进程启动）
+    kb_loader = MogineKBLoader(watch_interval=0 if processes > 1 else None)
     
     # 创建服务器
     server_address = (host if host != "localhost" else '', port)
-    handler_class = create_handler(kb_loader)
-    httpd = HTTPServer(server_address, handler_class)
+    suggest_service = SuggestService(kb_loader, Config.KB_SUGGEST_DB_PATH, Config.KB_SUGGEST_REFRESH)
+    suggest_service.warm_up()
+    handler_class = create_handler(kb_loader, suggest_service)
+    server_class = KnowledgeBaseServer if threaded else SingleThreadKnowledgeBaseServer
+    httpd = server_class(server_address, handler_class)
     
     print(f"✅ 服务器启动成功！")
+    print(f"🧵 并发模式: {'多线程' if threaded else '单线程'} × {processes} 个进程，HTTP/1.1 keep-alive")
+    print(f"📝 访问日志: 采样率 {LOG_SAMPLE_RATE:g}，慢请求阈值 {SLOW_REQUEST_MS:g}ms")
     print(f"📡 API地址: http://{host}:{port}")
     print(f"🔍 搜索接口: http://{host}:{port}/api/search?q=钱学森数字人")
+    print(f"🌊 流式搜索: http://{host}:{port}/api/search?q=数字人&top_k=100&stream=1")
+    print(f"💡 输入联想: http://{host}:{port}/api/suggest?prefix=数字")
     print(f"🏢 公司信息: http://{host}:{port}/api/company_info")
+    print(f"📦 批量搜索: POST http://{host}:{port}/api/search/batch")
+    print(f"🔄 重新加载: POST http://{host}:{port}/api/reload")
+    print(f"📊 缓存统计: http://{host}:{port}/api/cache_stats")
     print(f"⏹️  按 Ctrl+C 停止服务器")
     
+    if processes > 1:
+        run_prefork(httpd, kb_loader, processes)
+        print(f"\n🛑 服务器已停止")
+        return
+    
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
@@ -132,4 +541,4 @@ def start_server():
         httpd.shutdown()
 
 if __name__ == "__main__":
-    start_server()
\ No newline at end of file
+    start_server()
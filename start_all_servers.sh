@@ -24,6 +24,18 @@ pkill -f "file_server.py" 2>/dev/null
 pkill -f "web_server.py" 2>/dev/null
 sleep 2
 
+# 编译知识库快照（各服务启动时直接mmap加载，无需重复解析XML）
+echo "📦 编译知识库快照..."
+python -m chatbot.kb_snapshot
+
+# 视频HLS分段（需要ffmpeg，已分段的视频会跳过）
+echo "🎞️  切分知识库视频..."
+python -m chatbot.video_segments
+
+# 压缩前端页面并生成预压缩版本（Web服务器按Accept-Encoding直接发送）
+echo "🗜️  构建前端资源..."
+python build_frontend.py
+
 # 启动知识库服务器
 echo "📚 启动知识库服务器 (端口 8739)..."
 python simple_server.py &
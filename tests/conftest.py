@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 测试从项目根目录导入模块（与各服务脚本的做法一致）
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
@@ -0,0 +1,60 @@
+"""Range 请求头解析"""
+
+import pytest
+
+from file_server import MAX_RANGES, parse_range_header
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', [(0, 99)]),
+    ('bytes=900-', [(900, 999)]),
+    # 后缀区间：最后 N 个字节，超过文件大小时取整个文件
+    ('bytes=-100', [(900, 999)]),
+    ('bytes=-5000', [(0, 999)]),
+    # 结束偏移超出文件时截断到文件末尾
+    ('bytes=990-2000', [(990, 999)]),
+    ('bytes=999-999', [(999, 999)]),
+    # 单位和空白不区分大小写
+    ('Bytes = 0-0', [(0, 0)]),
+    # 重叠和相邻的区间合并
+    ('bytes=0-10,5-20', [(0, 20)]),
+    ('bytes=0-10,11-20', [(0, 20)]),
+    ('bytes=500-600,0-10', [(0, 10), (500, 600)]),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range_header(header, SIZE) == expected
+
+
+@pytest.mark.parametrize('header', [
+    'items=0-10',
+    'bytes=',
+    'bytes=abc',
+    'bytes=10',
+    'bytes=a-b',
+    'bytes=20-10',
+    'bytes=0-1x',
+])
+def test_malformed_header_is_ignored(header):
+    assert parse_range_header(header, SIZE) is None
+
+
+@pytest.mark.parametrize('header', [
+    'bytes=1000-',
+    'bytes=1000-2000',
+    'bytes=-0',
+])
+def test_unsatisfiable_ranges(header):
+    assert parse_range_header(header, SIZE) == []
+
+
+def test_empty_file_is_unsatisfiable():
+    assert parse_range_header('bytes=0-0', 0) == []
+
+
+def test_too_many_ranges_is_ignored():
+    header = 'bytes=' + ','.join(f"{i * 10}-{i * 10 + 1}" for i in range(MAX_RANGES + 1))
+    assert parse_range_header(header, SIZE) is None
+    header = 'bytes=' + ','.join(f"{i * 10}-{i * 10 + 1}" for i in range(MAX_RANGES))
+    assert len(parse_range_header(header, SIZE)) == MAX_RANGES
@@ -0,0 +1,88 @@
+"""查询缓存的 LRU 淘汰、TTL 过期和查询归一化"""
+
+import pytest
+
+from chatbot import kb_cache
+from chatbot.kb_cache import QueryCache, normalize_query
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """可手动推进的单调时钟"""
+    now = [1000.0]
+    monkeypatch.setattr(kb_cache.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_lru_evicts_least_recently_used():
+    cache = QueryCache(max_size=2, ttl=0)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    # 读取 a 之后，最久未使用的是 b
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert cache.stats()['evictions'] == 1
+
+
+def test_put_existing_key_refreshes_position():
+    cache = QueryCache(max_size=2, ttl=0)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.put('a', 10)
+    cache.put('c', 3)
+
+    assert cache.get('a') == 10
+    assert cache.get('b') is None
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = QueryCache(max_size=4, ttl=10)
+    cache.put('a', 1)
+
+    clock[0] += 9.9
+    assert cache.get('a') == 1
+    clock[0] += 0.2
+    assert cache.get('a') is None
+    # 过期条目在读取时删除
+    assert cache.stats()['size'] == 0
+
+
+def test_zero_ttl_never_expires(clock):
+    cache = QueryCache(max_size=4, ttl=0)
+    cache.put('a', 1)
+    clock[0] += 10 ** 6
+    assert cache.get('a') == 1
+
+
+def test_disabled_cache_stores_nothing():
+    cache = QueryCache(max_size=0)
+    cache.put('a', 1)
+    assert not cache.enabled
+    assert cache.get('a') is None
+
+
+def test_stats_count_hits_and_misses():
+    cache = QueryCache(max_size=4, ttl=0)
+    cache.put('a', 1)
+    cache.get('a')
+    cache.get('b')
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['hit_rate']) == (1, 1, 0.5)
+
+    cache.clear()
+    assert cache.get('a') is None
+    assert cache.stats()['hits'] == 1
+
+
+@pytest.mark.parametrize('query, expected', [
+    ('  数字人   价格 ', '数字人 价格'),
+    ('MoHuman\tAI\n', 'mohuman ai'),
+    # 全角字母、数字和空格转为半角
+    ('ＵＳＤ　３Ｄ', 'usd 3d'),
+])
+def test_normalize_query(query, expected):
+    assert normalize_query(query) == expected
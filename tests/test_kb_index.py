@@ -0,0 +1,90 @@
+"""
+倒排索引检索与逐条打分全部文档的结果一致性
+
+倒排表只负责缩小候选范围，排名必须与原先对全部文档逐条打分的结果相同
+"""
+
+import os
+import random
+
+import pytest
+
+from chatbot.kb_index import KBIndex, LegacyScorer
+from chatbot.kb_loader import MogineKBLoader
+
+KB_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                       'kb', 'mogine_unified_kb_fixed.xml')
+
+
+def full_scan(scorer: LegacyScorer, query: str, k: int, boosts=None):
+    """原先的检索方式：逐条打分全部文档，过阈值后按得分降序（同分按文档顺序）"""
+    boosts = boosts or {}
+    features = scorer.query_features(query)
+    scored = []
+    for doc_idx, doc in scorer.index.live_documents():
+        score = scorer.score_document(features, doc) + boosts.get(doc_idx, 0.0)
+        if score > scorer.thresholds[doc['type']]:
+            scored.append((score, doc_idx))
+    scored.sort(key=lambda item: (-item[0], item[1]))
+    return scored[:k]
+
+
+def assert_same_ranking(actual, expected):
+    assert [doc_idx for _, doc_idx in actual] == [doc_idx for _, doc_idx in expected]
+    assert [score for score, _ in actual] == pytest.approx([score for score, _ in expected])
+
+
+@pytest.fixture(scope='module')
+def kb_state():
+    loader = MogineKBLoader(KB_PATH, watch_interval=0, use_snapshot=False)
+    return loader.state
+
+
+@pytest.mark.parametrize('query', [
+    # 与条目只有单个字符相同的短查询
+    '价格', '钱', '联系方式', '案例', '合作',
+    # 超过短查询长度、部分条目只有单个字符相同
+    'usd 建模', '数字人多少钱', '3d 协作 平台',
+    '数字人', 'mohuman', '你好',
+])
+def test_top_k_matches_full_scan(kb_state, query):
+    for k in (1, 3, 10):
+        assert_same_ranking(kb_state.scorer.top_k(query, k), full_scan(kb_state.scorer, query, k))
+
+
+def test_top_k_matches_full_scan_with_boosts(kb_state):
+    for query in ('mobox 价格', '钱学森 数字人', '3d 建模'):
+        boosts = kb_state.boost.boosts(query)
+        assert_same_ranking(kb_state.scorer.top_k(query, 5, boosts),
+                            full_scan(kb_state.scorer, query, 5, boosts))
+
+
+def test_top_k_matches_full_scan_on_random_queries(kb_state):
+    text = ''.join(doc['text'] for _, doc in kb_state.search_index.live_documents())
+    rng = random.Random(7)
+    for i in range(500):
+        length = rng.randint(1, 12)
+        if i % 2:
+            # 随机字符拼成的查询，多数文档只有单个字符相同
+            query = ''.join(rng.choice(text) for _ in range(length))
+        else:
+            start = rng.randrange(len(text) - length)
+            query = text[start:start + length]
+        query = ' '.join(query.split())
+        if not query:
+            continue
+        k = rng.randint(1, 6)
+        assert_same_ranking(kb_state.scorer.top_k(query, k), full_scan(kb_state.scorer, query, k))
+
+
+def test_incremental_update_keeps_old_index_intact():
+    index = KBIndex()
+    index.add_document('content', {'title': '价格', 'body': '数字人报价'}, {}, key='a')
+    snapshot = index.copy()
+    index.add_document('content', {'title': '价格说明', 'body': '收费标准'}, {}, key='b')
+    index.remove_document(0)
+
+    # 拷贝出的索引不受之后的增删影响
+    assert snapshot.char_matches('价') == {0: 1}
+    assert index.char_matches('价') == {1: 1}
+    assert_same_ranking(LegacyScorer(index).top_k('价格', 3), full_scan(LegacyScorer(index), '价格', 3))
@@ -0,0 +1,49 @@
+"""大模型响应缓存的缓存键与确定性判断"""
+
+from llm_cache import TRANSPORT_FIELDS, cache_key, is_deterministic
+
+URL = 'https://example.com/v1/chat/completions'
+
+REQUEST = {
+    'model': 'doubao',
+    'messages': [{'role': 'user', 'content': '你好'}],
+    'temperature': 0,
+}
+
+
+def test_transport_fields_do_not_change_key():
+    base = cache_key(URL, REQUEST)
+    for field in TRANSPORT_FIELDS:
+        assert cache_key(URL, {**REQUEST, field: True}) == base
+    assert cache_key(URL, {**REQUEST, 'stream': True, 'stream_options': {'include_usage': True},
+                           'user': 'u-1'}) == base
+
+
+def test_field_order_and_integral_floats_do_not_change_key():
+    reordered = {'temperature': 0.0, 'messages': REQUEST['messages'], 'model': 'doubao'}
+    assert cache_key(URL, reordered) == cache_key(URL, REQUEST)
+
+
+def test_generation_fields_change_key():
+    base = cache_key(URL, REQUEST)
+    assert cache_key(URL, {**REQUEST, 'temperature': 0.5}) != base
+    assert cache_key(URL, {**REQUEST, 'model': 'other'}) != base
+    assert cache_key(URL, {**REQUEST, 'messages': [{'role': 'user', 'content': '您好'}]}) != base
+    assert cache_key(URL + '?x=1', REQUEST) != base
+
+
+def test_key_does_not_modify_request():
+    request = {**REQUEST, 'stream': True}
+    cache_key(URL, request)
+    assert request['stream'] is True
+
+
+def test_is_deterministic():
+    assert is_deterministic({'temperature': 0})
+    assert is_deterministic({'temperature': 0.0})
+    assert is_deterministic({'top_k': 1})
+    # DashScope 应用接口的采样参数在 parameters 中
+    assert is_deterministic({'parameters': {'temperature': 0}})
+    assert not is_deterministic({'temperature': 0.7})
+    assert not is_deterministic({})
+    assert not is_deterministic({'temperature': 0, 'n': 2})
@@ -5,26 +5,118 @@ Web服务器 - 提供HTML文件和处理API代理
 
 import os
 import json
-import asyncio
-import httpx
-from http.server import HTTPServer, SimpleHTTPRequestHandler
-from urllib.parse import urlparse, parse_qs
+import threading
+from http import HTTPStatus
+from http.server import HTTPServer, ThreadingHTTPServer, SimpleHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
 from dotenv import load_dotenv
 
+from build_frontend import FrontendBundle, negotiate_encoding
+
 # 加载环境变量
 load_dotenv()
 
+# 网关配置在导入时读取环境变量，需在 load_dotenv 之后导入
+import llm_cache
+from llm_cache import CACHE_POLICIES, ResponseCache
+from llm_gateway import LLMGateway, GatewayLoop, GatewayOverloaded, client_key, next_item
+
+# 前端构建产物（python build_frontend.py 生成，未构建时直接提供原文件）
+frontend_bundle = FrontendBundle()
+
+# 带内容哈希的构建文件内容不会变化，可以长期缓存
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# 页面入口地址不变，每次使用前向服务器验证（命中时返回304）
+REVALIDATE_CACHE_CONTROL = 'no-cache'
+
+# 大模型响应缓存（LLM_CACHE_ENABLED=true 时开启）
+response_cache = ResponseCache() if llm_cache.ENABLED else None
+
+# 大模型上游网关（每个上游一个长期复用的连接池）
+llm_gateway = LLMGateway(response_cache)
+
+def cache_policy(header_value):
+    """请求头 X-LLM-Cache 指定的缓存策略，缺省或无效时为 auto（只缓存确定性请求）"""
+    policy = (header_value or 'auto').strip().lower()
+    return policy if policy in CACHE_POLICIES else 'auto'
+
+def resolve_bundle(request_path, accept_encoding, if_none_match):
+    """
+    查找请求路径对应的前端构建产物
+    
+    Returns:
+        None 表示不在构建产物中（按原文件提供）；
+        否则为 (状态码, 响应头, 文件路径)，304时文件路径为 None
+    """
+    path = unquote(urlparse(request_path).path).lstrip('/')
+    if path.startswith(frontend_bundle.url_prefix):
+        entry = frontend_bundle.hashed(path[len(frontend_bundle.url_prefix):])
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        entry = frontend_bundle.entry(path)
+        cache_control = REVALIDATE_CACHE_CONTROL
+    if entry is None:
+        return None
+    
+    encoding = negotiate_encoding(accept_encoding, entry['encodings'])
+    etag = f'"{entry["hash"]}{"-" + encoding if encoding else ""}"'
+    headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    
+    if if_none_match and (if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]):
+        return HTTPStatus.NOT_MODIFIED, headers, None
+    
+    headers = {'Content-Type': entry['content_type'], **headers}
+    if encoding:
+        headers['Content-Encoding'] = encoding
+    return HTTPStatus.OK, headers, frontend_bundle.path(entry, encoding)
+
+def proxy_error(message, code=500, error_type="proxy_error"):
+    """代理错误的JSON响应体"""
+    return {"error": {"message": message, "type": error_type, "code": code}}
+
+def overloaded_error(error):
+    """上游繁忙（并发已满且无法排队）的JSON响应体，配合 429 + Retry-After 返回"""
+    return proxy_error(str(error), 429, "overloaded")
+
 class WebHandler(SimpleHTTPRequestHandler):
     """Web请求处理器"""
     
+    # 流式响应逐行写出，关闭Nagle算法避免小数据包被延迟发送
+    disable_nagle_algorithm = True
+    _chunked = False
+    # 承载上游网关的后台事件循环（start_web_server 中创建）
+    gateway_loop = None
+    
     def __init__(self, *args, **kwargs):
         super().__init__(*args, directory=os.getcwd(), **kwargs)
     
+    def send_head(self):
+        """页面和脚本优先返回构建后的预压缩版本，其余文件按原样提供"""
+        resolved = resolve_bundle(self.path, self.headers.get('Accept-Encoding'), self.headers.get('If-None-Match'))
+        if resolved is None:
+            return super().send_head()
+        
+        status, headers, file_path = resolved
+        f = None
+        if file_path is not None:
+            try:
+                f = open(file_path, 'rb')
+            except OSError:
+                # 构建产物被清理时回退到原文件
+                return super().send_head()
+            headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+        
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        return f
+    
     def end_headers(self):
         # 添加CORS头
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-LLM-Cache')
         super().end_headers()
     
     def do_OPTIONS(self):
@@ -32,6 +124,18 @@ class WebHandler(SimpleHTTPRequestHandler):
         self.send_response(200)
         self.end_headers()
     
+    def do_GET(self):
+        """上游网关指标（连接池、并发排队），其余按静态文件处理"""
+        if urlparse(self.path).path == '/api/llm/stats':
+            body = json.dumps(llm_gateway.stats()).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            super().do_GET()
+    
     def do_POST(self):
         """处理POST请求"""
         parsed_path = urlparse(self.path)
@@ -54,43 +158,105 @@ class WebHandler(SimpleHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             request_data = json.loads(post_data.decode('utf-8'))
             
-            # 异步调用豆包API
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            response = loop.run_until_complete(self.call_doubao_api(request_data))
-            loop.close()
-            
             if request_data.get('stream', False):
-                # 流式响应
-                self.send_response(200)
-                self.send_header('Content-Type', 'text/plain; charset=utf-8')
-                self.send_header('Cache-Control', 'no-cache')
-                self.end_headers()
-                
-                # 转发流式数据
-                for chunk in response:
-                    self.wfile.write(chunk.encode('utf-8'))
-                    self.wfile.flush()
-            else:
-                # 普通响应
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps(response).encode('utf-8'))
+                # 流式响应：上游每到一行立即转发
+                self.relay_doubao_stream(request_data)
+                return
+            
+            response = self.gateway_loop.run(llm_gateway.complete(
+                'doubao', request_data, self.client_id(), cache_policy(self.headers.get('X-LLM-Cache'))
+            ))
+            
+            # 普通响应
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(response).encode('utf-8'))
                 
+        except GatewayOverloaded as e:
+            self.send_overloaded(e)
         except Exception as e:
             # 返回JSON格式的错误响应
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
-            error_response = {
-                "error": {
-                    "message": f"API proxy error: {str(e)}",
-                    "type": "proxy_error",
-                    "code": 500
-                }
-            }
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
+            self.wfile.write(json.dumps(proxy_error(f"API proxy error: {str(e)}")).encode('utf-8'))
+    
+    def client_id(self):
+        """排队公平性使用的客户端标识（经本机Nginx转发时取真实客户端IP）"""
+        return client_key(self.client_address[0], self.headers.get('X-Forwarded-For'))
+    
+    def send_overloaded(self, error):
+        """上游繁忙：快速返回 429，Retry-After 为按排队情况估算的等待秒数"""
+        print(f"[Web服务器] {error}")
+        self.send_response(429)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Retry-After', str(error.retry_after))
+        self.end_headers()
+        self.wfile.write(json.dumps(overloaded_error(error)).encode('utf-8'))
+    
+    def relay_doubao_stream(self, request_data):
+        """
+        逐行转发豆包的SSE流
+        
+        上游每读到一行就写给客户端并立即发送，写完才读取下一行，
+        每个流占用的内存与生成长度无关；客户端断开时关闭上游连接（连接归还连接池）。
+        上游在第一行之前出错时抛出异常，由调用方返回JSON错误
+        """
+        lines = llm_gateway.stream('doubao', request_data, self.client_id(), cache_policy(self.headers.get('X-LLM-Cache')))
+        headers_sent = False
+        try:
+            line = self.gateway_loop.next(lines)
+            self.start_event_stream()
+            headers_sent = True
+            while line is not None:
+                self.write_stream_chunk(line.encode('utf-8'))
+                line = self.gateway_loop.next(lines)
+            self.end_event_stream()
+        except (BrokenPipeError, ConnectionResetError):
+            print("[Web服务器] 客户端已断开，停止转发豆包流式响应")
+            self.close_connection = True
+        except Exception as e:
+            if not headers_sent:
+                raise
+            # 响应头已发出，只能在流中告知错误并结束
+            print(f"[Web服务器] 豆包流式响应中断: {e}")
+            error_event = proxy_error(f"API proxy error: {str(e)}", 502)
+            try:
+                self.write_stream_chunk(f"data: {json.dumps(error_event)}\n\n".encode('utf-8'))
+                self.end_event_stream()
+            except OSError:
+                self.close_connection = True
+        finally:
+            self.gateway_loop.run(lines.aclose())
+    
+    def start_event_stream(self):
+        """发送流式响应头：HTTP/1.1 客户端使用分块传输，HTTP/1.0 客户端写完后关闭连接"""
+        self._chunked = self.request_version == 'HTTP/1.1'
+        if self._chunked:
+            # 只对本次响应使用 HTTP/1.1（分块传输需要），其余响应仍按 HTTP/1.0 处理
+            self.protocol_version = 'HTTP/1.1'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream; charset=utf-8')
+        self.send_header('Cache-Control', 'no-cache')
+        # 经过Nginx时关闭代理缓冲，每一行都能立即到达浏览器
+        self.send_header('X-Accel-Buffering', 'no')
+        if self._chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.close_connection = True
+        self.end_headers()
+    
+    def write_stream_chunk(self, data: bytes):
+        if self._chunked:
+            data = f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n"
+        self.wfile.write(data)
+        self.wfile.flush()
+    
+    def end_event_stream(self):
+        if self._chunked:
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
     
     def handle_dashscope_proxy(self):
         """处理DashScope API代理"""
@@ -103,88 +269,142 @@ class WebHandler(SimpleHTTPRequestHandler):
             post_data = self.rfile.read(content_length)
             request_data = json.loads(post_data.decode('utf-8'))
             
-            # 异步调用DashScope API
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            response = loop.run_until_complete(self.call_dashscope_api(request_data))
-            loop.close()
+            response = self.gateway_loop.run(llm_gateway.complete(
+                'dashscope', request_data, self.client_id(), cache_policy(self.headers.get('X-LLM-Cache'))
+            ))
             
             self.send_response(200)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
             self.wfile.write(json.dumps(response).encode('utf-8'))
             
+        except GatewayOverloaded as e:
+            self.send_overloaded(e)
         except Exception as e:
             # 返回JSON格式的错误响应
             self.send_response(500)
             self.send_header('Content-Type', 'application/json')
             self.end_headers()
-            error_response = {
-                "error": {
-                    "message": f"DashScope proxy error: {str(e)}",
-                    "type": "proxy_error", 
-                    "code": 500
-                }
-            }
-            self.wfile.write(json.dumps(error_response).encode('utf-8'))
-    
-    async def call_doubao_api(self, request_data):
-        """调用豆包API"""
-        api_key = os.getenv("DOUBAO_API_KEY")
-        base_url = os.getenv("DOUBAO_BASE_URL", "https://ark.cn-beijing.volces.com/api/v3")
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            if request_data.get('stream', False):
-                # 流式请求
-                async with client.stream(
-                    "POST",
-                    f"{base_url}/chat/completions",
-                    headers=headers,
-                    json=request_data
-                ) as response:
-                    response.raise_for_status()
-                    
-                    chunks = []
-                    async for line in response.aiter_lines():
-                        if line.startswith("data: "):
-                            chunks.append(line + "\n\n")
-                    
-                    return chunks
-            else:
-                # 普通请求
-                response = await client.post(
-                    f"{base_url}/chat/completions",
-                    headers=headers,
-                    json=request_data
-                )
-                response.raise_for_status()
-                return response.json()
-    
-    async def call_dashscope_api(self, request_data):
-        """调用DashScope API"""
-        api_key = os.getenv("DASHSCOPE_API_KEY")
-        app_id = os.getenv("DASHSCOPE_APP_ID")
-        base_url = f"https://dashscope.aliyuncs.com/api/v1/apps/{app_id}/completion"
-        
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}"
-        }
-        
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            response = await client.post(base_url, headers=headers, json=request_data)
-            response.raise_for_status()
-            return response.json()
+            self.wfile.write(json.dumps(proxy_error(f"DashScope proxy error: {str(e)}")).encode('utf-8'))
     
     def log_message(self, format, *args):
         """自定义日志格式"""
         print(f"[Web服务器] {format % args}")
 
+async def relay_event_stream(first_line, lines):
+    """asyncio 模式的SSE转发：先发已取到的第一行，再逐行转发；结束或客户端断开时关闭上游流"""
+    try:
+        line = first_line
+        while line is not None:
+            yield line
+            line = await next_item(lines)
+    except Exception as e:
+        # 响应头已发出，只能在流中告知错误并结束
+        print(f"[Web服务器] 豆包流式响应中断: {e}")
+        yield f"data: {json.dumps(proxy_error(f'API proxy error: {str(e)}', 502))}\n\n"
+    finally:
+        await lines.aclose()
+
+def create_app():
+    """
+    asyncio 模式的Web应用（FastAPI + uvicorn）
+    
+    所有连接在一个事件循环中处理，流式对话不占用线程；
+    上游请求通过 llm_gateway 的长期连接池发出，热连接在对话之间复用
+    """
+    from contextlib import asynccontextmanager
+    from fastapi import FastAPI, Request
+    from fastapi.middleware.cors import CORSMiddleware
+    from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+    
+    @asynccontextmanager
+    async def lifespan(app):
+        yield
+        await llm_gateway.aclose()
+    
+    app = FastAPI(title="Web服务器", lifespan=lifespan, docs_url=None, redoc_url=None, openapi_url=None)
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_methods=["GET", "POST", "OPTIONS"],
+        allow_headers=["Content-Type", "Authorization", "X-LLM-Cache"]
+    )
+    root = os.getcwd()
+    
+    def request_client_id(request: Request):
+        return client_key(request.client.host if request.client else '', request.headers.get('x-forwarded-for'))
+    
+    def overloaded_response(error: GatewayOverloaded):
+        print(f"[Web服务器] {error}")
+        return JSONResponse(overloaded_error(error), status_code=429,
+                            headers={'Retry-After': str(error.retry_after)})
+    
+    @app.post("/api/llm/doubao")
+    async def doubao_proxy(request: Request):
+        """处理豆包API代理"""
+        try:
+            request_data = json.loads(await request.body() or b'{}')
+            if request_data.get('stream', False):
+                # 先取第一行：排队被拒或上游在响应头发出前出错时仍能返回JSON错误
+                lines = llm_gateway.stream('doubao', request_data, request_client_id(request),
+                                           cache_policy(request.headers.get('x-llm-cache')))
+                first_line = await next_item(lines)
+                return StreamingResponse(
+                    relay_event_stream(first_line, lines),
+                    media_type="text/event-stream; charset=utf-8",
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                )
+            return JSONResponse(await llm_gateway.complete(
+                'doubao', request_data, request_client_id(request), cache_policy(request.headers.get('x-llm-cache'))
+            ))
+        except GatewayOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JSONResponse(proxy_error(f"API proxy error: {str(e)}"), status_code=500)
+    
+    @app.post("/api/llm/dashscope")
+    async def dashscope_proxy(request: Request):
+        """处理DashScope API代理"""
+        try:
+            request_data = json.loads(await request.body() or b'{}')
+            return JSONResponse(await llm_gateway.complete(
+                'dashscope', request_data, request_client_id(request), cache_policy(request.headers.get('x-llm-cache'))
+            ))
+        except GatewayOverloaded as e:
+            return overloaded_response(e)
+        except Exception as e:
+            return JSONResponse(proxy_error(f"DashScope proxy error: {str(e)}"), status_code=500)
+    
+    @app.get("/api/llm/stats")
+    async def gateway_stats():
+        """上游连接池、并发排队（队列深度、排队时间）与调用指标"""
+        return llm_gateway.stats()
+    
+    @app.api_route("/{path:path}", methods=["GET", "HEAD"])
+    async def static_file(path: str, request: Request):
+        """页面和脚本优先返回构建后的预压缩版本，其余文件按原样提供"""
+        resolved = resolve_bundle(request.url.path, request.headers.get('accept-encoding'),
+                                  request.headers.get('if-none-match'))
+        if resolved is not None:
+            status, headers, file_path = resolved
+            if file_path is None:
+                return Response(status_code=status, headers=headers)
+            if os.path.isfile(file_path):
+                content_type = headers.pop('Content-Type')
+                return FileResponse(file_path, headers=headers, media_type=content_type)
+        
+        # 只提供工作目录内的文件，目录返回其中的 index.html
+        file_path = os.path.realpath(os.path.join(root, path))
+        if file_path != root and not file_path.startswith(root + os.sep):
+            return Response(status_code=HTTPStatus.NOT_FOUND)
+        if os.path.isdir(file_path):
+            file_path = os.path.join(file_path, 'index.html')
+        if not os.path.isfile(file_path):
+            return Response(status_code=HTTPStatus.NOT_FOUND)
+        return FileResponse(file_path)
+    
+    return app
+
 def start_web_server():
     """启动Web服务器"""
     print("🌐 启动Web服务器...")
@@ -192,22 +412,44 @@ def start_web_server():
     # 从环境变量获取配置
     host = os.getenv("MAIN_SERVER_HOST", "localhost")
     port = int(os.getenv("MAIN_SERVER_PORT", "8741"))
+    # 运行模式：thread（http.server，每个连接一个线程）或 asyncio（uvicorn，单进程事件循环）
+    mode = os.getenv("WEB_SERVER_MODE", "thread").lower()
+    # localhost 时监听所有网卡（两种模式一致）
+    bind_host = host if host != "localhost" else '0.0.0.0'
     
-    # 创建服务器
-    server_address = (host if host != "localhost" else '', port)
-    httpd = HTTPServer(server_address, WebHandler)
+    if mode == "asyncio":
+        app = create_app()
+    else:
+        # 创建服务器（默认每个连接一个线程，一个对话的流式响应不会阻塞其他请求）
+        server_address = (bind_host, port)
+        threaded = os.getenv("WEB_SERVER_THREADED", "true").lower() == "true"
+        server_class = ThreadingHTTPServer if threaded else HTTPServer
+        httpd = server_class(server_address, WebHandler)
+        # 上游连接池运行在后台事件循环中，各请求线程共享
+        WebHandler.gateway_loop = GatewayLoop(llm_gateway)
     
-    print(f"✅ Web服务器启动成功！")
+    print(f"✅ Web服务器启动成功！（{mode} 模式）")
     print(f"🌐 访问地址: http://{host}:{port}")
     print(f"📄 聊天界面: http://{host}:{port}/real_llm_chat.html")
     print(f"🔧 API代理: http://{host}:{port}/api/llm/")
+    if response_cache is not None:
+        print(f"🗄️  大模型响应缓存: {response_cache.cache_dir}（TTL {response_cache.ttl:.0f}秒）")
+        # 后台清理已过期的缓存文件
+        threading.Thread(target=response_cache.prune, name='llm-cache-prune', daemon=True).start()
     print(f"⏹️  按 Ctrl+C 停止服务器")
     
+    if mode == "asyncio":
+        import uvicorn
+        uvicorn.run(app, host=bind_host, port=port, log_level="warning")
+        print(f"\n🛑 Web服务器已停止")
+        return
+    
     try:
         httpd.serve_forever()
     except KeyboardInterrupt:
         print(f"\n🛑 Web服务器已停止")
         httpd.shutdown()
+        WebHandler.gateway_loop.close()
 
 if __name__ == "__main__":
-    start_web_server()
\ No newline at end of file
+    start_web_server()